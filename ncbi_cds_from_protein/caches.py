@@ -41,7 +41,17 @@ from __future__ import annotations
 
 import logging
 import sqlite3
+import time
 from collections import defaultdict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Collection, Iterable, Mapping, Sequence
+    from pathlib import Path
+
+# Seconds to wait for another thread's write transaction on the cache, as
+# pipelined stages write to the cache from several threads at once
+CACHE_TIMEOUT = 60
 
 # SQL QUERIES
 # ===========
@@ -78,6 +88,30 @@ from collections import defaultdict
 # The *:* relationship is mediated by the seq_nt table, which references
 # the seqdata accession (unique to input sequence) and the nt_uid_acc
 # accession (unique to NCBI nucleotide sequence).
+#
+# The gb_region table holds, for an input sequence, a GenBank record covering
+# only the region of a nucleotide record that contains its CDS, with that CDS
+# as its single feature. Where an input sequence has a region record, it is
+# used in place of the full GenBank record, and the input sequence does not
+# need to be linked to nucleotide UIDs.
+#
+# The fetch_checkpoint table records progress through a paged EFetch stage.
+# For each stage it holds the comma-separated list of query IDs being posted
+# to NCBI, and the retstart value of the next page to fetch, so that an
+# interrupted stage can post the same list again and resume at the last
+# committed page, although IDs fetched before the interruption are no longer
+# queried when it is rerun.
+#
+# The seq_key table maps keys identifying a protein (its input ID without any
+# Stockholm domain location, and the digest of a full-length sequence) to the
+# first input sequence with that key to be taken forward: its representative.
+# Later input sequences with the same key are duplicates, and are recorded in
+# the seq_alias table with the ID and description of their representative.
+# Only representatives are searched for; duplicates share their CDS.
+#
+# The run_state table records which stages of an ncfp run have completed,
+# keyed by a digest of the input sequences and of the arguments that affect
+# those stages, so that a restarted run can skip them.
 
 
 # Create tables
@@ -112,6 +146,41 @@ SQL_CREATEDB = """
                           record TEXT NOT NULL,
                           FOREIGN KEY (accession) REFERENCES nt_uid_acc(accession)
                          );
+    DROP TABLE IF EXISTS fetch_checkpoint;
+    DROP TABLE IF EXISTS gb_region;
+    DROP TABLE IF EXISTS run_state;
+    DROP TABLE IF EXISTS seq_key;
+    DROP TABLE IF EXISTS seq_alias;
+"""
+
+# Create tables added after the original schema, if they are not present.
+# This is run on new caches, and on old caches reused with --keepcache
+SQL_UPDATEDB = """
+    CREATE TABLE IF NOT EXISTS fetch_checkpoint (stage TEXT PRIMARY KEY NOT NULL,
+                                                 qids TEXT NOT NULL,
+                                                 retstart INTEGER NOT NULL
+                                                );
+    CREATE TABLE IF NOT EXISTS gb_region (accession TEXT PRIMARY KEY NOT NULL,
+                                          nt_acc TEXT NOT NULL,
+                                          location TEXT NOT NULL,
+                                          record TEXT NOT NULL,
+                                          FOREIGN KEY(accession) REFERENCES seqdata(accession)
+                                         );
+    CREATE TABLE IF NOT EXISTS run_state (run_key TEXT NOT NULL,
+                                          stage TEXT NOT NULL,
+                                          completed REAL NOT NULL,
+                                          PRIMARY KEY (run_key, stage)
+                                         );
+    CREATE TABLE IF NOT EXISTS seq_key (key TEXT PRIMARY KEY NOT NULL,
+                                        accession TEXT NOT NULL,
+                                        description TEXT NOT NULL,
+                                        FOREIGN KEY(accession) REFERENCES seqdata(accession)
+                                       );
+    CREATE TABLE IF NOT EXISTS seq_alias (accession TEXT PRIMARY KEY NOT NULL,
+                                          canonical TEXT NOT NULL,
+                                          description TEXT NOT NULL,
+                                          FOREIGN KEY(canonical) REFERENCES seqdata(accession)
+                                         );
 """
 
 # Add a new sequence to seqdata
@@ -121,13 +190,13 @@ SQL_ADDSEQ = """
 """
 
 SQL_ADD_GBHEADER = """
-    INSERT INTO gb_headers (accession, length, organism,
+    INSERT OR IGNORE INTO gb_headers (accession, length, organism,
                             taxonomy, date)
            VALUES (?, ?, ?, ?, ?);
 """
 
 SQL_ADD_GBFULL = """
-    INSERT INTO gb_full (accession, record)
+    INSERT OR IGNORE INTO gb_full (accession, record)
     VALUES (?, ?);
 """
 
@@ -137,7 +206,8 @@ SQL_GET_GBHEADER_LENGTHS = """
                    nt_uid_acc.accession AS nt_id FROM
                          seq_nt JOIN nt_uid_acc ON seq_nt.uid=nt_uid_acc.uid)
            JOIN
-           gb_headers ON nt_id=gb_headers.accession;
+           gb_headers ON nt_id=gb_headers.accession
+           WHERE prot_id NOT IN (SELECT accession FROM gb_region);
 """
 
 # Get the full GenBank record corresponding to input sequence accession
@@ -151,6 +221,18 @@ SQL_GET_GBRECORD_BY_SEQ = """
            WHERE prot_id=?;
 """
 
+# Get the CDS region GenBank record corresponding to input sequence accession
+SQL_GET_GBREGION_BY_SEQ = """
+    SELECT accession, nt_acc, record FROM gb_region
+           WHERE accession=?;
+"""
+
+# Add a CDS region GenBank record for an input sequence accession
+SQL_ADD_GBREGION = """
+    INSERT OR REPLACE INTO gb_region (accession, nt_acc, location, record)
+           VALUES (?, ?, ?, ?);
+"""
+
 
 # Get queries for a seqdata row
 SQL_GET_SEQDATA_QUERIES = """
@@ -158,6 +240,13 @@ SQL_GET_SEQDATA_QUERIES = """
            WHERE accession=?;
 """
 
+# Get accessions of seqdata rows with any query, in input order
+SQL_GET_QUERY_ACCESSIONS = """
+    SELECT accession FROM seqdata
+           WHERE nt_query IS NOT NULL OR aa_query IS NOT NULL
+           ORDER BY rowid;
+"""
+
 # Get nt query for a seqdata row
 SQL_GET_SEQDATA_NTQUERY = """
     SELECT nt_query FROM seqdata
@@ -207,6 +296,13 @@ SQL_GET_NOGBHEAD_UIDS = """
                  (SELECT accession FROM gb_headers);
 """
 
+# Get all nt accessions with no associated GenBank header
+SQL_GET_NOGBHEAD_ACC = """
+    SELECT accession FROM nt_uid_acc
+           WHERE accession IS NOT NULL AND accession NOT IN
+                 (SELECT accession FROM gb_headers);
+"""
+
 # Get all nt UIDs with no associated full GenBank record
 SQL_GET_NOGBFULL_UIDS = """
     SELECT uid FROM nt_uid_acc
@@ -227,6 +323,129 @@ SQL_UPDATE_UID_ACC = """
            SET accession=? WHERE uid=?;
 """
 
+# Get query IDs and next page start for a paged fetch stage
+SQL_GET_CHECKPOINT = """
+    SELECT qids, retstart FROM fetch_checkpoint
+           WHERE stage=?;
+"""
+
+# Set query IDs and next page start for a paged fetch stage
+SQL_SET_CHECKPOINT = """
+    INSERT OR REPLACE INTO fetch_checkpoint (stage, qids, retstart)
+           VALUES (?, ?, ?);
+"""
+
+# Get column names of the fetch_checkpoint table
+SQL_CHECKPOINT_COLUMNS = """
+    SELECT name FROM pragma_table_info('fetch_checkpoint');
+"""
+
+# Remove the fetch_checkpoint table
+SQL_DROP_CHECKPOINTS = """
+    DROP TABLE fetch_checkpoint;
+"""
+
+# Advance next page start for a paged fetch stage
+SQL_ADVANCE_CHECKPOINT = """
+    UPDATE fetch_checkpoint
+           SET retstart=? WHERE stage=?;
+"""
+
+# Remove checkpoint for a completed paged fetch stage
+SQL_CLEAR_CHECKPOINT = """
+    DELETE FROM fetch_checkpoint
+           WHERE stage=?;
+"""
+
+# Get the representative input sequence for a key
+SQL_GET_SEQ_KEY = """
+    SELECT accession, description FROM seq_key
+           WHERE key=?;
+"""
+
+# Add a key for a representative input sequence, if the key is new
+SQL_ADD_SEQ_KEY = """
+    INSERT OR IGNORE INTO seq_key (key, accession, description)
+           VALUES (?, ?, ?);
+"""
+
+# Get the representative of a duplicate input sequence
+SQL_GET_SEQ_ALIAS = """
+    SELECT canonical, description FROM seq_alias
+           WHERE accession=?;
+"""
+
+# Add a duplicate input sequence, with its representative
+SQL_ADD_SEQ_ALIAS = """
+    INSERT OR REPLACE INTO seq_alias (accession, canonical, description)
+           VALUES (?, ?, ?);
+"""
+
+# Get completed stages for a run
+SQL_GET_RUN_STAGES = """
+    SELECT stage FROM run_state
+           WHERE run_key=?;
+"""
+
+# Record a completed stage for a run
+SQL_SET_RUN_STAGE = """
+    INSERT OR REPLACE INTO run_state (run_key, stage, completed)
+           VALUES (?, ?, ?);
+"""
+
+# Copy rows from an attached shard cache into this cache. Rows already in
+# this cache are kept; nucleotide accessions are filled in where missing.
+# Run state and fetch checkpoints belong to the shard's own run, and are not
+# copied.
+SQL_MERGE_CACHE = """
+    INSERT OR IGNORE INTO seqdata (accession, aa_query, nt_query)
+           SELECT accession, aa_query, nt_query FROM shard.seqdata;
+    INSERT OR IGNORE INTO nt_uid_acc (uid, accession)
+           SELECT uid, accession FROM shard.nt_uid_acc;
+    UPDATE nt_uid_acc SET accession=(SELECT accession FROM shard.nt_uid_acc
+                                     WHERE shard.nt_uid_acc.uid=nt_uid_acc.uid)
+           WHERE accession IS NULL;
+    INSERT INTO seq_nt (accession, uid)
+           SELECT accession, uid FROM shard.seq_nt AS s
+           WHERE NOT EXISTS (SELECT 1 FROM seq_nt
+                             WHERE seq_nt.accession=s.accession AND seq_nt.uid=s.uid);
+    INSERT OR IGNORE INTO gb_headers (accession, length, organism, taxonomy, date)
+           SELECT accession, length, organism, taxonomy, date FROM shard.gb_headers;
+    INSERT OR IGNORE INTO gb_full (accession, record)
+           SELECT accession, record FROM shard.gb_full;
+    INSERT OR IGNORE INTO gb_region (accession, nt_acc, location, record)
+           SELECT accession, nt_acc, location, record FROM shard.gb_region;
+    INSERT OR IGNORE INTO seq_key (key, accession, description)
+           SELECT key, accession, description FROM shard.seq_key;
+    INSERT OR IGNORE INTO seq_alias (accession, canonical, description)
+           SELECT accession, canonical, description FROM shard.seq_alias;
+"""
+
+# UniProt cross-references persist across runs in a cache shared between
+# cachestems, so this table is never dropped. Entries with found = 0 have
+# no EMBL or GeneID cross-reference, and expire after a TTL.
+SQL_CREATE_UNIPROT_XREF = """
+    CREATE TABLE IF NOT EXISTS uniprot_xref (accession TEXT PRIMARY KEY NOT NULL,
+                                             embl TEXT NOT NULL,
+                                             orf TEXT NOT NULL,
+                                             geneid TEXT NOT NULL,
+                                             refseq TEXT NOT NULL,
+                                             found INTEGER NOT NULL,
+                                             fetched REAL NOT NULL
+                                            );
+"""
+
+SQL_GET_UNIPROT_XREF = """
+    SELECT embl, orf, geneid, refseq FROM uniprot_xref
+           WHERE accession=? AND (found=1 OR fetched>=?);
+"""
+
+SQL_ADD_UNIPROT_XREF = """
+    INSERT OR REPLACE INTO uniprot_xref (accession, embl, orf, geneid, refseq,
+                                         found, fetched)
+           VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+
 
 # Initialise SQLite cache
 def initialise_dbcache(path) -> None:
@@ -235,10 +454,29 @@ def initialise_dbcache(path) -> None:
     path     - path to SQLite3 database cache
     """
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(path))
+    conn = sqlite3.connect(str(path), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.executescript(SQL_CREATEDB)
+    update_dbcache(path)
+
+
+def update_dbcache(path: Path) -> None:
+    """Add any tables missing from an existing SQLite cache.
+
+    path     - path to SQLite3 database cache
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(path), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        # Checkpoints from older caches do not hold the query IDs that were
+        # posted, so a stage cannot resume from them, and they are discarded
+        cur.execute(SQL_CHECKPOINT_COLUMNS)
+        columns = {row[0] for row in cur.fetchall()}
+        if columns and "qids" not in columns:
+            cur.execute(SQL_DROP_CHECKPOINTS)
+        cur.executescript(SQL_UPDATEDB)
 
 
 def add_input_sequence(cachepath, accession, aa_query, nt_query) -> int | None:
@@ -253,7 +491,7 @@ def add_input_sequence(cachepath, accession, aa_query, nt_query) -> int | None:
 
     # Path must be string, not PosixPath, in Py3.6
     logger.debug("aa_query: %s nt_query: %s", aa_query, nt_query)
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_ADDSEQ, (accession, aa_query, nt_query))
@@ -263,7 +501,7 @@ def add_input_sequence(cachepath, accession, aa_query, nt_query) -> int | None:
 def has_query(cachepath, accession) -> bool:
     """Return True if a seqdata row has any query."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_SEQDATA_QUERIES, (accession,))
@@ -272,10 +510,20 @@ def has_query(cachepath, accession) -> bool:
     return True
 
 
+def get_query_accessions(cachepath: Path) -> list[str]:
+    """Return accessions of all input sequences with a query, in input order."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_GET_QUERY_ACCESSIONS)
+    return [row[0] for row in cur.fetchall()]
+
+
 def has_nt_query(cachepath, accession) -> bool:
     """Return True if a seqdata row has an nt query."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_SEQDATA_NTQUERY, (accession,))
@@ -287,7 +535,7 @@ def has_nt_query(cachepath, accession) -> bool:
 def has_aa_query(cachepath, accession) -> bool:
     """Return True if a seqdata row has an aa query."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_SEQDATA_AAQUERY, (accession,))
@@ -299,7 +547,7 @@ def has_aa_query(cachepath, accession) -> bool:
 def get_nt_query(cachepath, accession):
     """Return nt query for a seqdata row."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_SEQDATA_NTQUERY, (accession,))
@@ -309,7 +557,7 @@ def get_nt_query(cachepath, accession):
 def get_aa_query(cachepath, accession):
     """Return aa query for a seqdata row."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_SEQDATA_AAQUERY, (accession,))
@@ -319,7 +567,7 @@ def get_aa_query(cachepath, accession):
 def has_ncbi_uid(cachepath, accession) -> bool:
     """Return True if seq accession has at least one nt UID."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_NT_UIDS, (accession,))
@@ -333,7 +581,7 @@ def add_ncbi_uids(cachepath, accession, uids):
     logger = logging.getLogger(__name__)
 
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     results = []
     # Exclude uids that are in the database/cache
     with conn:
@@ -356,7 +604,7 @@ def add_ncbi_uids(cachepath, accession, uids):
 def get_nt_uids(cachepath):
     """Return list of nt UIDs."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_UIDS)
@@ -366,17 +614,27 @@ def get_nt_uids(cachepath):
 def get_nogbhead_nt_uids(cachepath):
     """Return list of nt UIDs with no cached GenBank header."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_NOGBHEAD_UIDS)
     return [uid[0] for uid in cur.fetchall()]
 
 
+def get_nogbhead_nt_acc(cachepath: Path) -> list[str]:
+    """Return list of nt accessions with no cached GenBank header."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_GET_NOGBHEAD_ACC)
+    return [acc[0] for acc in cur.fetchall()]
+
+
 def get_nt_noacc_uids(cachepath):
     """Return list of nt UIDs having no GenBank accession."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_NOACC_UIDS)
@@ -386,7 +644,7 @@ def get_nt_noacc_uids(cachepath):
 def update_nt_uid_acc(cachepath, uid, accession):
     """Update nt UID GenBank accession."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     results = []
     with conn:
         cur = conn.cursor()
@@ -398,7 +656,7 @@ def update_nt_uid_acc(cachepath, uid, accession):
 def add_gbheaders(cachepath, accession, length, org, taxon, date):
     """Add a new GenBank header to the cache."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_ADD_GBHEADER, (accession, length, org, taxon, date))
@@ -408,7 +666,7 @@ def add_gbheaders(cachepath, accession, length, org, taxon, date):
 def get_gbheader_lengths(cachepath):
     """Return GenBank accessions and lengths for each sequence."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_GBHEADER_LENGTHS)
@@ -420,20 +678,43 @@ def get_gbheader_lengths(cachepath):
     return result
 
 
-def find_shortest_genbank(cachepath):
-    """Return shortest GenBank entries covering all sequences."""
-    shortids = set()
+def find_shortest_genbank(
+    cachepath: Path, seqids: None | Collection[str] = None
+) -> set[str]:
+    """Return shortest GenBank entries covering all sequences.
+
+    seqids   - if not None, only cover the input sequences with these IDs
+    """
+    return {
+        shortid
+        for shortid, _ in find_shortest_genbank_by_seq(cachepath, seqids).values()
+    }
+
+
+def find_shortest_genbank_by_seq(
+    cachepath: Path, seqids: None | Collection[str] = None
+) -> dict[str, tuple[str, int]]:
+    """Return (accession, length) of shortest GenBank entry for each sequence.
+
+    seqids   - if not None, only return entries for input sequences with
+               these IDs
+
+    Sequences that have a CDS region record are not included.
+    """
     gblens = get_gbheader_lengths(cachepath)
+    shortest = {}
     for seqid in gblens:
-        shortid = sorted(gblens[seqid])[0][1]
-        shortids.add(shortid)
-    return shortids
+        if seqids is not None and seqid not in seqids:
+            continue
+        gblen, shortid = min(gblens[seqid])
+        shortest[seqid] = (shortid, gblen)
+    return shortest
 
 
 def add_gbfull(cachepath, accession, record):
     """Add a new full GenBank record to the cache."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_ADD_GBFULL, (accession, record))
@@ -443,7 +724,7 @@ def add_gbfull(cachepath, accession, record):
 def get_nogbfull_nt_uids(cachepath):
     """Return list of nt UIDs with no cached full GenBank record."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_NOGBFULL_UIDS)
@@ -453,7 +734,7 @@ def get_nogbfull_nt_uids(cachepath):
 def get_nogbfull_nt_acc(cachepath):
     """Return list of nt accessions with no cached full GenBank record."""
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
         cur.execute(SQL_GET_NOGBFULL_ACC)
@@ -461,10 +742,256 @@ def get_nogbfull_nt_acc(cachepath):
 
 
 def find_record_cds(cachepath, accession):
-    """Return CDS sequence for passed input accession."""
+    """Return CDS sequence for passed input accession.
+
+    A CDS region record for the accession is preferred to full GenBank
+    records, if one exists.
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_GET_GBREGION_BY_SEQ, (accession,))
+        result = cur.fetchall()
+        if not result:
+            cur.execute(SQL_GET_GBRECORD_BY_SEQ, (accession,))
+            result = cur.fetchall()
+    return result
+
+
+def add_gbregion(
+    cachepath: Path, accession: str, nt_acc: str, location: str, record: str
+) -> None | tuple:
+    """Add a CDS region GenBank record for an input sequence to the cache."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_ADD_GBREGION, (accession, nt_acc, location, record))
+    return cur.fetchone()
+
+
+def has_gbregion(cachepath: Path, accession: str) -> bool:
+    """Return True if seq accession has a CDS region GenBank record."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_GET_GBREGION_BY_SEQ, (accession,))
+    return cur.fetchone() is not None
+
+
+def get_fetch_checkpoint(cachepath: Path, stage: str) -> None | tuple[list[str], int]:
+    """Return (query IDs, next retstart) for a paged fetch stage, or None."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_GET_CHECKPOINT, (stage,))
+    result = cur.fetchone()
+    if result is None:
+        return None
+    qids, retstart = result
+    return (qids.split(",") if qids else []), retstart
+
+
+def set_fetch_checkpoint(
+    cachepath: Path, stage: str, qids: Sequence[str], retstart: int
+) -> None:
+    """Record query IDs and next retstart for a paged fetch stage."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_SET_CHECKPOINT, (stage, ",".join(qids), retstart))
+
+
+def advance_fetch_checkpoint(cachepath: Path, stage: str, retstart: int) -> None:
+    """Update the next retstart for a paged fetch stage."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_ADVANCE_CHECKPOINT, (retstart, stage))
+
+
+def clear_fetch_checkpoint(cachepath: Path, stage: str) -> None:
+    """Remove the checkpoint for a completed paged fetch stage."""
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_CLEAR_CHECKPOINT, (stage,))
+
+
+def find_seq_key(cachepath: Path, keys: Iterable[str]) -> None | tuple[str, str]:
+    """Return (ID, description) of the representative for any key, or None.
+
+    keys     - keys identifying an input protein, in order of preference
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        for key in keys:
+            cur.execute(SQL_GET_SEQ_KEY, (key,))
+            result = cur.fetchone()
+            if result is not None:
+                return result
+    return None
+
+
+def add_seq_keys(
+    cachepath: Path, keys: Iterable[str], accession: str, description: str
+) -> None:
+    """Record an input sequence as the representative for its new keys.
+
+    keys         - keys identifying the input protein
+    accession    - ID of the input sequence
+    description  - description of the input sequence
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.executemany(
+            SQL_ADD_SEQ_KEY, [(key, accession, description) for key in keys]
+        )
+
+
+def add_seq_alias(
+    cachepath: Path, accession: str, canonical: str, description: str
+) -> None:
+    """Record a duplicate input sequence, with its representative.
+
+    accession    - ID of the duplicate input sequence
+    canonical    - ID of the representative input sequence
+    description  - description of the representative input sequence
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_ADD_SEQ_ALIAS, (accession, canonical, description))
+
+
+def get_seq_alias(cachepath: Path, accession: str) -> None | tuple[str, str]:
+    """Return (ID, description) of a duplicate's representative, or None.
+
+    accession    - ID of the input sequence
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_GET_SEQ_ALIAS, (accession,))
+    return cur.fetchone()
+
+
+def get_completed_stages(cachepath: Path, run_key: str) -> set[str]:
+    """Return the names of stages completed for a run.
+
+    run_key  - digest of the run's input sequences and arguments
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_GET_RUN_STAGES, (run_key,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def set_stage_completed(cachepath: Path, run_key: str, stage: str) -> None:
+    """Record that a stage completed for a run.
+
+    run_key  - digest of the run's input sequences and arguments
+    stage    - name of the completed stage
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(SQL_SET_RUN_STAGE, (run_key, stage, time.time()))
+
+
+def merge_cache(cachepath: Path, shardpath: Path) -> None:
+    """Copy the rows of a shard's cache into a cache.
+
+    cachepath  - path to SQLite3 database cache to merge into
+    shardpath  - path to SQLite3 database cache written by one shard
+
+    Rows already in the cache, such as GenBank records downloaded by more
+    than one shard, are not duplicated.
+    """
+    # The shard cache may predate some tables
+    update_dbcache(shardpath)
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(cachepath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.execute("ATTACH DATABASE ? AS shard", (str(shardpath),))
+        cur.executescript(SQL_MERGE_CACHE)
+    conn.execute("DETACH DATABASE shard")
+    conn.close()
+
+
+def initialise_xrefcache(path: Path) -> None:
+    """Create the persistent UniProt cross-reference cache, if needed.
+
+    path     - path to SQLite3 cross-reference cache
+    """
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(path), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        cur.executescript(SQL_CREATE_UNIPROT_XREF)
+
+
+def get_uniprot_xrefs(
+    xrefpath: Path, accessions: Iterable[str], ttl: float
+) -> dict[str, tuple]:
+    """Return cached cross-references for the passed UniProt accessions.
+
+    xrefpath     - path to SQLite3 cross-reference cache
+    accessions   - UniProt accessions to look up
+    ttl          - age (in days) after which cached misses are ignored
+
+    Returns a dictionary of (embl, orf, geneid, refseq) tuples, keyed by
+    accession, for accessions with a current cache entry.
+    """
+    expiry = time.time() - ttl * 86400
+    results = {}
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(xrefpath), timeout=CACHE_TIMEOUT)
+    with conn:
+        cur = conn.cursor()
+        for accession in accessions:
+            cur.execute(SQL_GET_UNIPROT_XREF, (accession, expiry))
+            row = cur.fetchone()
+            if row is not None:
+                results[accession] = row
+    return results
+
+
+def add_uniprot_xrefs(xrefpath: Path, xrefs: Mapping[str, tuple]) -> None:
+    """Add or replace UniProt cross-references in the cache.
+
+    xrefpath     - path to SQLite3 cross-reference cache
+    xrefs        - dictionary of (embl, orf, geneid, refseq) tuples, keyed
+                   by accession
+
+    An entry with neither an EMBL nor a GeneID cross-reference is stored
+    as a miss, to be looked up again once it is older than the TTL.
+    """
+    fetched = time.time()
     # Path must be string, not PosixPath, in Py3.6
-    conn = sqlite3.connect(str(cachepath))
+    conn = sqlite3.connect(str(xrefpath), timeout=CACHE_TIMEOUT)
     with conn:
         cur = conn.cursor()
-        cur.execute(SQL_GET_GBRECORD_BY_SEQ, (accession,))
-    return cur.fetchall()
+        cur.executemany(
+            SQL_ADD_UNIPROT_XREF,
+            [
+                (acc, embl, orf, geneid, refseq, int(bool(embl or geneid)), fetched)
+                for acc, (embl, orf, geneid, refseq) in xrefs.items()
+            ],
+        )
@@ -0,0 +1,284 @@
+# (c) The James Hutton Institute 2017-2019
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute for Pharmacy and Biomedical Sciences,
+# Cathedral Street,
+# Glasgow,
+# G1 1XQ
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2017-2019 The James Hutton Institute
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Functions for reading compressed input and writing bgzipped output.
+
+Input streams are decompressed according to their leading magic bytes,
+so that gzip (including bgzip) and xz files, or pipes, can be read
+without relying on filename extensions.
+
+FASTA output can be written as BGZF (bgzip-compatible) files, with the
+samtools faidx .fai and bgzip .gzi indexes needed for random access to
+the compressed sequences. Compression is done in a background thread,
+so that it does not hold up the thread producing the sequences.
+"""
+
+from __future__ import annotations
+
+import gzip
+import io
+import lzma
+import queue
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, TextIO
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from typing import Self
+
+    from Bio.SeqRecord import SeqRecord
+
+# Leading magic bytes of supported compression formats (bgzip is gzip)
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
+# Maximum uncompressed data in a BGZF block, as used by bgzip
+BGZF_BLOCK_SIZE = 0xFF00
+
+# Fixed BGZF block header, up to the (variable) block size field
+BGZF_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+
+# Number of records queued for the background compression thread
+BGZF_QUEUE_SIZE = 1024
+
+# Line width of FASTA output, as written by Bio.SeqIO
+FASTA_LINE_WIDTH = 60
+
+
+def open_binary_stream(handle: BinaryIO) -> BinaryIO:
+    """Return a decompressed binary stream from a binary stream.
+
+    :param handle:  binary stream, e.g. an open file or sys.stdin.buffer
+
+    The compression format (gzip, bgzip or xz) is guessed from the magic
+    bytes at the start of the stream, which are peeked, so that
+    non-seekable streams such as pipes can be read.
+    """
+    if not hasattr(handle, "peek"):
+        handle = io.BufferedReader(handle)
+    magic = handle.peek(len(XZ_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=handle, mode="rb")
+    if magic.startswith(XZ_MAGIC):
+        return lzma.LZMAFile(handle, mode="rb")
+    return handle
+
+
+def open_text_stream(handle: BinaryIO) -> TextIO:
+    """Return a text stream from a binary stream, decompressing if needed.
+
+    :param handle:  binary stream, e.g. an open file or sys.stdin.buffer
+    """
+    return io.TextIOWrapper(open_binary_stream(handle))
+
+
+def open_text_file(path: Path, position: int = 0) -> TextIO:
+    """Return a text stream from a file, decompressing if needed.
+
+    :param path:  path to plain text, gzip, bgzip or xz compressed file
+    :param position:  byte offset in the decompressed data to start reading at
+
+    Seeking in plain text files is immediate; compressed files are
+    decompressed up to the position, but not parsed.
+    """
+    handle = open_binary_stream(path.open("rb"))
+    if position:
+        handle.seek(position)
+    return io.TextIOWrapper(handle)
+
+
+def fasta_positions(handle: BinaryIO, step: int = 1) -> Iterator[int]:
+    """Generate byte offsets of FASTA records in a decompressed binary stream.
+
+    :param handle:  decompressed binary stream, from open_binary_stream()
+    :param step:  generate the position of every step-th record
+
+    Positions are those of the header line starting each record, which
+    may be passed to open_text_file() to read from that record onwards.
+    """
+    position, count = 0, 0
+    for line in handle:
+        if line.startswith(b">"):
+            if not count % step:
+                yield position
+            count += 1
+        position += len(line)
+
+
+def bgzf_block(data: bytes, compresslevel: int = 6) -> bytes:
+    """Return data compressed as a single BGZF block.
+
+    :param data:  uncompressed data, at most BGZF_BLOCK_SIZE bytes
+    :param compresslevel:  zlib compression level
+
+    The empty block, bgzf_block(b""), is the BGZF end-of-file marker.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return (
+        BGZF_HEADER
+        + struct.pack("<H", len(compressed) + 25)
+        + compressed
+        + struct.pack("<II", zlib.crc32(data) & 0xFFFFFFFF, len(data))
+    )
+
+
+class BgzfFastaWriter:
+    """Writes SeqRecords to a BGZF compressed FASTA file, with indexes.
+
+    Records are formatted in the calling thread and queued for a
+    background thread, which compresses them into BGZF blocks. The
+    samtools faidx index (<path>.fai) is written as records are queued,
+    and the bgzip block index (<path>.gzi) when the writer is closed.
+    """
+
+    _FLUSH = object()  # queued to write a partial block, and flush the file
+
+    def __init__(self, path: Path, compresslevel: int = 6) -> None:
+        """Instantiate writer, and start the compression thread.
+
+        :param path:  path to the compressed output file
+        :param compresslevel:  zlib compression level
+        """
+        self.path = Path(path)
+        self.compresslevel = compresslevel
+        self._queue = queue.Queue(maxsize=BGZF_QUEUE_SIZE)
+        self._faifh = Path(f"{self.path}.fai").open("w")  # noqa: SIM115 - see close()
+        self._gzidx = []  # (compressed, uncompressed) offsets of BGZF blocks
+        self._offset = 0  # uncompressed bytes written so far
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._compress, name=f"bgzip-{self.path.name}", daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self) -> Self:
+        """Return the writer, to be closed on leaving the context."""
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        """Close the writer."""
+        self.close()
+
+    def write_record(self, record: SeqRecord) -> None:
+        """Queue a SeqRecord to be written in FASTA format.
+
+        :param record:  SeqRecord to write
+        """
+        text = record.format("fasta")
+        title = text[: text.index("\n") + 1]
+        name = (title[1:].split() or [""])[0]
+        length = len(record.seq)
+        linebases = min(length, FASTA_LINE_WIDTH)
+        self._faifh.write(
+            f"{name}\t{length}\t{self._offset + len(title)}\t"
+            f"{linebases}\t{linebases + 1}\n"
+        )
+        data = text.encode("latin-1")
+        self._offset += len(data)
+        self._put(data)
+
+    def flush(self) -> None:
+        """Write all queued records to the compressed file, and flush it.
+
+        This returns once the request is queued, not once it is written.
+        """
+        self._faifh.flush()
+        self._put(self._FLUSH)
+
+    def close(self) -> None:
+        """Finish writing the compressed file, then write its block index."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._faifh.close()
+        self._raise_error()
+        with Path(f"{self.path}.gzi").open("wb") as ofh:
+            ofh.write(struct.pack("<Q", len(self._gzidx)))
+            ofh.writelines(struct.pack("<QQ", *offsets) for offsets in self._gzidx)
+
+    def _put(self, item: object) -> None:
+        """Queue an item for the compression thread, if it has not failed."""
+        self._raise_error()
+        self._queue.put(item)
+
+    def _raise_error(self) -> None:
+        """Re-raise an exception from the compression thread."""
+        if self._error is not None:
+            raise self._error
+
+    def _compress(self) -> None:
+        """Compress queued data into BGZF blocks, until None is queued.
+
+        Every block but the first is recorded in the .gzi index. If writing
+        fails, the exception is kept for the writing thread, and queued
+        items are discarded so that it is never blocked.
+        """
+        buffer = bytearray()
+        coffset = uoffset = 0
+        item = b""
+        try:
+            with self.path.open("wb") as ofh:
+                while True:
+                    item = self._queue.get()
+                    if isinstance(item, bytes):
+                        buffer += item
+                    while len(buffer) >= BGZF_BLOCK_SIZE or (
+                        buffer and not isinstance(item, bytes)
+                    ):
+                        data = bytes(buffer[:BGZF_BLOCK_SIZE])
+                        del buffer[:BGZF_BLOCK_SIZE]
+                        if uoffset:
+                            self._gzidx.append((coffset, uoffset))
+                        block = bgzf_block(data, self.compresslevel)
+                        ofh.write(block)
+                        coffset += len(block)
+                        uoffset += len(data)
+                    if item is self._FLUSH:
+                        ofh.flush()
+                    elif item is None:
+                        ofh.write(bgzf_block(b""))
+                        return
+        except Exception as exc:  # noqa: BLE001 - passed to the writing thread
+            self._error = exc
+            while item is not None:
+                item = self._queue.get()
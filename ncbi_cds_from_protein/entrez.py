@@ -37,28 +37,64 @@
 # THE SOFTWARE.
 """Functions to interact with Entre."""
 
+from __future__ import annotations
+
 import logging
+from collections import defaultdict
 from io import StringIO
+from typing import TYPE_CHECKING, Any
 
 from Bio import Entrez, SeqIO
+from Bio.GenBank.Scanner import GenBankScanner
+from Bio.SeqFeature import SimpleLocation
 from tqdm import tqdm
 
 from ncbi_cds_from_protein.caches import (
     add_gbfull,
     add_gbheaders,
+    add_gbregion,
     add_ncbi_uids,
+    advance_fetch_checkpoint,
+    clear_fetch_checkpoint,
     find_shortest_genbank,
+    find_shortest_genbank_by_seq,
+    get_aa_query,
+    get_fetch_checkpoint,
     get_nogbfull_nt_acc,
+    get_nogbhead_nt_acc,
     get_nogbhead_nt_uids,
     get_nt_noacc_uids,
     get_nt_query,
     has_aa_query,
+    has_gbregion,
     has_ncbi_uid,
     has_nt_query,
+    set_fetch_checkpoint,
     update_nt_uid_acc,
 )
 
-from .sequences import strip_stockholm_from_seqid
+from .fetchers import get_fetcher
+from .indexes import get_link_index_accessions
+from .sequences import (
+    build_region_record,
+    choose_ipg_cds,
+    feature_table_location,
+    find_feature_table_cds,
+    parse_coded_by,
+    parse_feature_table,
+    parse_ipg_report,
+    strip_stockholm_from_seqid,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Collection, Iterable, Iterator, Mapping, Sequence
+    from pathlib import Path
+    from typing import TextIO
+
+    from Bio.SeqRecord import SeqRecord
+
+    from .fetchers import Fetcher
+    from .sequences import QueryRecord
 
 
 # EXCEPTIONS
@@ -103,118 +139,552 @@ class NCFPMaxretryException(Exception):
         Exception.__init__(self, msg)
 
 
-def fetch_gb_headers(cachepath, retries, batchsize, disabletqdm=True):
+def fetch_gb_headers(  # noqa: PLR0913
+    cachepath: Path,
+    retries: int,
+    batchsize: int,
+    *,
+    disabletqdm: bool = True,
+    postsize: None | int = None,
+    local_genbank: None | Mapping[str, SeqRecord] = None,
+    fetcher: None | Fetcher = None,
+) -> tuple[list, int]:
     """Update cache with NCBI GenBank headers for passed records.
 
-    cachepath - path to cache
-    retries   - number of Entrez retries
-    batchsize - number of uids per EPost query
+    cachepath     - path to cache
+    retries       - number of Entrez retries
+    batchsize     - number of uids per EPost query (or per EFetch page)
+    postsize      - if not None, number of uids per paged EPost history
+    local_genbank - if not None, index of local GenBank records
+                    (see indexes.open_local_genbank)
+    fetcher       - Fetcher backend (default: EntrezFetcher)
 
     Gets list of UIDs with no existing cached GenBank headers, and
-    batch EFetches the GenBank headers.
+    batch EFetches the GenBank headers. Records that are in the local
+    GenBank index are read from there instead.
     """
     addedrows = []
     failcount = 0
-    # Create batches and get EPost keys for each batch
-    epost_histories = []
-    nogbhead_uids = get_nogbhead_nt_uids(cachepath)
-    for batch in [
-        nogbhead_uids[idx : idx + batchsize]
-        for idx in range(0, len(nogbhead_uids), batchsize)
-    ]:
-        epost_histories.append(epost_history_with_retries(batch, "nucleotide", retries))
-    for history in tqdm(
-        epost_histories,
-        desc="4/5 Fetching GenBank headers",
-        disable=disabletqdm,
-    ):
-        try:
-            records = SeqIO.parse(
-                efetch_history_with_retries(
-                    history,
-                    "nucleotide",
-                    "gb",
-                    "text",
-                    retries,
-                ),
-                "gb",
-            )
-            for record in records:
-                taxonomy = " ".join(record.annotations["taxonomy"])
-                addedrows.append(
-                    add_gbheaders(
-                        cachepath,
-                        record.id,
-                        len(record),
-                        record.annotations["organism"],
-                        taxonomy,
-                        record.annotations["date"],
-                    ),
+    if local_genbank is not None:
+        for accession in get_nogbhead_nt_acc(cachepath):
+            if accession in local_genbank:
+                record = GenBankScanner().parse(
+                    StringIO(local_genbank.get_raw(accession).decode()),
+                    do_features=False,
                 )
-        except NCFPMaxretryException:
+                addedrows.append(add_gbheader_from_record(cachepath, record))
+    nogbhead_uids = get_nogbhead_nt_uids(cachepath)
+    if postsize is None:
+        handles = efetch_batches_with_retries(
+            nogbhead_uids,
+            "nucleotide",
+            "gb",
+            "text",
+            retries,
+            batchsize,
+            desc="4/5 Fetching GenBank headers",
+            disabletqdm=disabletqdm,
+            fetcher=fetcher,
+        )
+    else:
+        handles = efetch_pages_with_retries(
+            cachepath,
+            "gb_headers",
+            nogbhead_uids,
+            "nucleotide",
+            "gb",
+            "text",
+            retries,
+            batchsize,
+            postsize,
+            desc="4/5 Fetching GenBank headers",
+            disabletqdm=disabletqdm,
+            fetcher=fetcher,
+        )
+    for handle in handles:
+        if handle is None:
             failcount += 1
+            continue
+        addedrows.extend(add_gbheaders_from_handle(cachepath, handle))
 
     return addedrows, (failcount * batchsize)
 
 
-def fetch_shortest_genbank(cachepath, retries, batchsize, disabletqdm=True):
+def add_gbheaders_from_handle(cachepath: Path, handle: TextIO) -> list:
+    """Add GenBank headers of each record in the handle to the cache.
+
+    cachepath - path to cache
+    handle    - handle to GenBank format records
+
+    Returns the rows added to the cache.
+    """
+    return [
+        add_gbheader_from_record(cachepath, rec) for rec in SeqIO.parse(handle, "gb")
+    ]
+
+
+def add_gbheader_from_record(cachepath: Path, record: SeqRecord) -> None | tuple:
+    """Add the GenBank header of a record to the cache.
+
+    cachepath - path to cache
+    record    - GenBank SeqRecord (features and sequence are not used)
+    """
+    taxonomy = " ".join(record.annotations["taxonomy"])
+    return add_gbheaders(
+        cachepath,
+        record.id,
+        len(record),
+        record.annotations["organism"],
+        taxonomy,
+        record.annotations["date"],
+    )
+
+
+def fetch_shortest_genbank(  # noqa: PLR0913
+    cachepath: Path,
+    retries: int,
+    batchsize: int,
+    *,
+    disabletqdm: bool = True,
+    postsize: None | int = None,
+    local_genbank: None | Mapping[str, SeqRecord] = None,
+    fetcher: None | Fetcher = None,
+    seqids: None | Collection[str] = None,
+) -> tuple[list, int]:
     """Update cache with shortest full GenBank record for each input.
 
     cachepath     - path to cache database
     retries       - number of times to retry Entrez fetch
     batchsize     - number of GenBank records to fetch each time
+    postsize      - if not None, number of accessions per paged EPost history
+    local_genbank - if not None, index of local GenBank records
+                    (see indexes.open_local_genbank)
+    fetcher       - Fetcher backend (default: EntrezFetcher)
+    seqids        - if not None, only fetch records for inputs with these IDs
 
     Checks the sequence length for each GenBank record associated with
     an input sequence, and records the shortest one. This list is used
     to batch fetch full GenBank records from Entrez. Every input
-    sequence ends up with a corresponding nucleotide sequence.
+    sequence ends up with a corresponding nucleotide sequence. Records
+    that are in the local GenBank index are read from there instead.
     """
     addedrows = []
     failcount = 0
 
     # Get set of shortest GenBank accessions that cover input sequences
     # Identify those that need to be downloaded as full records
-    shortids = find_shortest_genbank(cachepath)
+    shortids = find_shortest_genbank(cachepath, seqids)
     nogbfull_acc = get_nogbfull_nt_acc(cachepath)
-    fetchaccs = list(shortids.intersection(nogbfull_acc))
-
-    # Create batches and get EPost keys
-    epost_histories = []
-    for batch in [
-        fetchaccs[idx : idx + batchsize] for idx in range(0, len(fetchaccs), batchsize)
-    ]:
-        epost_histories.append(epost_history_with_retries(batch, "nucleotide", retries))
-    for history in tqdm(
-        epost_histories,
-        desc="5/5 Fetching full GenBank records",
+    fetchaccs = sorted(shortids.intersection(nogbfull_acc))
+    if local_genbank is not None:
+        localaccs = [acc for acc in fetchaccs if acc in local_genbank]
+        for accession in localaccs:
+            raw = local_genbank.get_raw(accession).decode()
+            addedrows.append(add_gbfull(cachepath, accession, raw))
+        fetchaccs = sorted(set(fetchaccs).difference(localaccs))
+
+    if postsize is None:
+        handles = efetch_batches_with_retries(
+            fetchaccs,
+            "nucleotide",
+            "gbwithparts",
+            "text",
+            retries,
+            batchsize,
+            desc="5/5 Fetching full GenBank records",
+            disabletqdm=disabletqdm,
+            fetcher=fetcher,
+        )
+    else:
+        handles = efetch_pages_with_retries(
+            cachepath,
+            "gb_full",
+            fetchaccs,
+            "nucleotide",
+            "gbwithparts",
+            "text",
+            retries,
+            batchsize,
+            postsize,
+            desc="5/5 Fetching full GenBank records",
+            disabletqdm=disabletqdm,
+            fetcher=fetcher,
+        )
+    for handle in handles:
+        if handle is None:
+            failcount += 1
+            continue
+        addedrows.extend(
+            add_gbfull(cachepath, record.id, record.format("gb"))
+            for record in SeqIO.parse(handle, "gb")
+        )
+
+    return addedrows, (failcount * batchsize)
+
+
+def fetch_shortest_genbank_regions(  # noqa: PLR0913
+    cachepath: Path,
+    retries: int,
+    batchsize: int,
+    *,
+    padding: int = 100,
+    disabletqdm: bool = True,
+    local_genbank: None | Mapping[str, SeqRecord] = None,
+    fetcher: None | Fetcher = None,
+    seqids: None | Collection[str] = None,
+) -> tuple[list, int]:
+    """Update cache with CDS regions of the shortest GenBank record for each input.
+
+    cachepath     - path to cache database
+    retries       - number of times to retry Entrez fetch
+    batchsize     - number of feature tables to fetch each time
+    padding       - number of bases to include either side of the CDS
+    local_genbank - if not None, index of local GenBank records, which
+                    are read in full by fetch_shortest_genbank() instead
+    fetcher       - Fetcher backend (default: EntrezFetcher)
+    seqids        - if not None, only fetch regions for inputs with these IDs
+
+    For each input sequence whose shortest GenBank record has not already
+    been downloaded, the feature table of that record is fetched, and used
+    to locate the input's CDS (by protein ID, or by the locus tag in the
+    input's protein query). Only the padded region of the record spanning
+    the CDS is then fetched as GenBank, and cached as a CDS region record
+    for the input. Joined and complement locations are covered by the region.
+
+    Input sequences that are resolved in this way are excluded when finding
+    the shortest GenBank records to download in full.
+
+    Returns the added rows, and the count of inputs that could not be resolved.
+    """
+    logger = logging.getLogger(__name__)
+
+    nogbfull_acc = set(get_nogbfull_nt_acc(cachepath))
+    targets = {
+        seqid: (acc, length)
+        for seqid, (acc, length) in find_shortest_genbank_by_seq(
+            cachepath, seqids
+        ).items()
+        if acc in nogbfull_acc and (local_genbank is None or acc not in local_genbank)
+    }
+
+    # Feature tables are small, and can be fetched in batches
+    tables = {}
+    for handle in efetch_batches_with_retries(
+        sorted({acc for acc, _ in targets.values()}),
+        "nucleotide",
+        "ft",
+        "text",
+        retries,
+        batchsize,
+        desc="5/5 Fetching feature tables",
+        disabletqdm=disabletqdm,
+        fetcher=fetcher,
+    ):
+        if handle is not None:
+            tables.update(parse_feature_table(handle))
+
+    # Inputs with the same CDS (e.g. Stockholm domains) share a region
+    regions = defaultdict(list)
+    for seqid, (acc, length) in sorted(targets.items()):
+        aa_query = get_aa_query(cachepath, seqid)
+        feature = find_feature_table_cds(
+            tables.get(acc, []),
+            strip_stockholm_from_seqid(seqid),
+            None if aa_query is None else aa_query[0],
+        )
+        if feature is None:
+            logger.debug("No CDS for %s in %s feature table", seqid, acc)
+            continue
+        positions = [pos for interval in feature[1] for pos in interval]
+        start = max(1, min(positions) - padding)
+        stop = min(length, max(positions) + padding)
+        regions[(acc, start, stop, feature_table_location(feature[1]))].append(seqid)
+
+    addedrows = []
+    for (acc, start, stop, location), regionids in tqdm(
+        sorted(regions.items()),
+        desc="5/5 Fetching GenBank regions",
         disable=disabletqdm,
     ):
+        logger.debug("Fetching %s region %d..%d for %s", acc, start, stop, location)
         try:
-            records = SeqIO.parse(
-                efetch_history_with_retries(
-                    history,
+            data = efetch_with_retries(
+                acc,
+                "nucleotide",
+                "gbwithparts",
+                "text",
+                retries,
+                seq_start=start,
+                seq_stop=stop,
+                fetcher=fetcher,
+            ).read()
+        except NCFPMaxretryException:
+            logger.warning("Could not fetch %s region %d..%d", acc, start, stop)
+            continue
+        addedrows.extend(
+            add_gbregion(cachepath, seqid, acc, location, data) for seqid in regionids
+        )
+
+    return addedrows, len(targets) - len(addedrows)
+
+
+# Resolve NCBI protein inputs to CDS regions with GenPept coded_by qualifiers
+def fetch_coded_by_regions(  # noqa: PLR0913
+    records: Collection[SeqRecord | QueryRecord],
+    cachepath: Path,
+    retries: int,
+    batchsize: int,
+    *,
+    disabletqdm: bool = True,
+    fetcher: None | Fetcher = None,
+) -> tuple[list, int]:
+    """Update cache with CDS region records for NCBI protein inputs.
+
+    records       - collection of SeqRecords
+    cachepath     - path to cache database
+    retries       - number of Entrez retries
+    batchsize     - number of GenPept records to fetch each time
+    fetcher       - Fetcher backend (default: EntrezFetcher)
+
+    GenPept records for input sequences with a protein query are batch
+    fetched, and the coded_by qualifier of each CDS feature gives the
+    nucleotide accession and coordinates of the coding sequence. Only that
+    range of the nucleotide record is fetched (as FASTA), and it is cached
+    as a CDS region record for the input sequence. Input sequences resolved
+    in this way are not searched in the later stages.
+
+    Returns the added rows, and the count of protein queries that could not
+    be resolved.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Stockholm domains from the same protein share a single query
+    queries = defaultdict(list)
+    for record in records:
+        if (
+            has_gbregion(cachepath, record.id)
+            or has_ncbi_uid(cachepath, record.id)
+            or has_nt_query(cachepath, record.id)
+            or not has_aa_query(cachepath, record.id)
+        ):
+            continue
+        queries[strip_stockholm_from_seqid(record.id)].append(record.id)
+
+    addedrows = []
+    resolved = set()
+    for handle in efetch_batches_with_retries(
+        sorted(queries),
+        "protein",
+        "gp",
+        "text",
+        retries,
+        batchsize,
+        desc="2/5 Fetching GenPept coded_by regions",
+        disabletqdm=disabletqdm,
+        fetcher=fetcher,
+    ):
+        if handle is None:
+            continue
+        for gprecord in SeqIO.parse(handle, "gb"):
+            # Inputs may be given with or without a version suffix
+            query = gprecord.id if gprecord.id in queries else gprecord.name
+            cds_features = [
+                ftr
+                for ftr in gprecord.features
+                if ftr.type == "CDS" and "coded_by" in ftr.qualifiers
+            ]
+            if query not in queries or not cds_features:
+                logger.debug("No coded_by qualifier found for %s", gprecord.id)
+                continue
+            coded_by = "".join(cds_features[0].qualifiers["coded_by"][0].split())
+            location = parse_coded_by(coded_by)
+            if location is None:
+                continue
+            nt_acc = location.parts[0].ref
+            start = min(int(part.start) for part in location.parts)
+            end = max(int(part.end) for part in location.parts)
+            logger.debug("%s is coded by %s", gprecord.id, coded_by)
+            try:
+                region = SeqIO.read(
+                    efetch_with_retries(
+                        nt_acc,
+                        "nucleotide",
+                        "fasta",
+                        "text",
+                        retries,
+                        seq_start=start + 1,
+                        seq_stop=end,
+                        fetcher=fetcher,
+                    ),
+                    "fasta",
+                )
+            except (NCFPMaxretryException, ValueError):
+                logger.warning("Could not fetch %s region %s", gprecord.id, coded_by)
+                continue
+            if len(region) != end - start:
+                logger.warning(
+                    "Region %s for %s has the wrong length", coded_by, gprecord.id
+                )
+                continue
+            qualifiers = {
+                key: val
+                for key, val in cds_features[0].qualifiers.items()
+                if key != "coded_by"
+            }
+            qualifiers["protein_id"] = [gprecord.id]
+            regionrecord = build_region_record(
+                region.seq,
+                nt_acc,
+                start,
+                location,
+                qualifiers,
+            )
+            addedrows.extend(
+                add_gbregion(
+                    cachepath, seqid, nt_acc, coded_by, regionrecord.format("gb")
+                )
+                for seqid in queries[query]
+            )
+            resolved.add(query)
+
+    return addedrows, len(queries) - len(resolved)
+
+
+# Resolve WP_ inputs to a representative CDS region of their IPG
+def fetch_ipg_regions(  # noqa: PLR0913
+    records: Collection[SeqRecord | QueryRecord],
+    cachepath: Path,
+    retries: int,
+    batchsize: int,
+    *,
+    policy: str = "refseq",
+    disabletqdm: bool = True,
+    fetcher: None | Fetcher = None,
+) -> tuple[list, int]:
+    """Update cache with CDS region records for WP_ protein inputs.
+
+    records       - collection of SeqRecords
+    cachepath     - path to cache database
+    retries       - number of Entrez retries
+    batchsize     - number of proteins per IPG report request
+    policy        - policy for choosing a representative CDS (see IPG_POLICIES)
+    fetcher       - Fetcher backend (default: EntrezFetcher)
+
+    Non-redundant RefSeq (WP_) proteins may be linked to thousands of
+    nucleotide records. Instead, the Identical Protein Group report for each
+    is batch fetched; this gives the nucleotide accession, start, stop and
+    strand of every CDS encoding the protein. One representative CDS is
+    chosen, only that range of the nucleotide record is fetched (as FASTA),
+    and it is cached as a CDS region record for the input sequence.
+
+    Returns the added rows, and the count of protein queries that could not
+    be resolved.
+    """
+    logger = logging.getLogger(__name__)
+
+    queries = defaultdict(list)
+    for record in records:
+        if (
+            not record.id.startswith("WP_")
+            or has_gbregion(cachepath, record.id)
+            or has_ncbi_uid(cachepath, record.id)
+            or has_nt_query(cachepath, record.id)
+            or not has_aa_query(cachepath, record.id)
+        ):
+            continue
+        queries[strip_stockholm_from_seqid(record.id)].append(record.id)
+
+    groups = {}
+    for handle in efetch_batches_with_retries(
+        sorted(queries),
+        "protein",
+        "ipg",
+        "text",
+        retries,
+        batchsize,
+        desc="2/5 Fetching IPG reports",
+        disabletqdm=disabletqdm,
+        fetcher=fetcher,
+    ):
+        if handle is not None:
+            groups.update(parse_ipg_report(handle))
+    # Inputs may be given with or without a version suffix
+    groups.update({acc.split(".")[0]: rows for acc, rows in list(groups.items())})
+
+    addedrows = []
+    resolved = set()
+    for query in tqdm(
+        sorted(queries),
+        desc="2/5 Fetching IPG CDS regions",
+        disable=disabletqdm,
+    ):
+        row = choose_ipg_cds(groups.get(query, []), policy)
+        if row is None:
+            logger.debug("No IPG CDS found for %s", query)
+            continue
+        nt_acc = row["Nucleotide Accession"]
+        start, stop = int(row["Start"]), int(row["Stop"])
+        strand = -1 if row["Strand"] == "-" else 1
+        logger.debug(
+            "IPG CDS for %s: %s %d..%d (%s)", query, nt_acc, start, stop, row["Strand"]
+        )
+        try:
+            region = SeqIO.read(
+                efetch_with_retries(
+                    nt_acc,
                     "nucleotide",
-                    "gbwithparts",
+                    "fasta",
                     "text",
                     retries,
+                    seq_start=start,
+                    seq_stop=stop,
+                    fetcher=fetcher,
                 ),
-                "gb",
+                "fasta",
             )
-            for record in records:
-                addedrows.append(add_gbfull(cachepath, record.id, record.format("gb")))
-        except NCFPMaxretryException:
-            failcount += 1
+        except (NCFPMaxretryException, ValueError):
+            logger.warning("Could not fetch IPG CDS region for %s", query)
+            continue
+        location = SimpleLocation(start - 1, stop, strand)
+        if len(region) != len(location):
+            logger.warning("IPG CDS region for %s has the wrong length", query)
+            continue
+        regionrecord = build_region_record(
+            region.seq,
+            nt_acc,
+            start - 1,
+            location,
+            {"protein_id": [query]},
+        )
+        region_location = f"{nt_acc}:{start}..{stop}({row['Strand']})"
+        addedrows.extend(
+            add_gbregion(
+                cachepath, seqid, nt_acc, region_location, regionrecord.format("gb")
+            )
+            for seqid in queries[query]
+        )
+        resolved.add(query)
 
-    return addedrows, (failcount * batchsize)
+    return addedrows, len(queries) - len(resolved)
 
 
 # Query NCBI singly with each record, to recover nucleotide accessions
-def search_nt_ids(records, cachepath, retries, disabletqdm: bool = True):
+def search_nt_ids(  # noqa: PLR0913
+    records: Collection[SeqRecord | QueryRecord],
+    cachepath: Path,
+    retries: int,
+    *,
+    disabletqdm: bool = True,
+    max_links: None | int = None,
+    fetcher: None | Fetcher = None,
+) -> tuple[list, int]:
     """Query NCBI nucleotide database and populate cache.
 
-    records - collection of SeqRecords
-    cache   - path to cache
-    retries - number of Entrez retries
+    records   - collection of SeqRecords
+    cache     - path to cache
+    retries   - number of Entrez retries
+    max_links - maximum number of linked nucleotide UIDs to keep per record
+    fetcher   - Fetcher backend (default: EntrezFetcher)
 
     If the record's ID is in the cache, the ESearch is not
     performed - the cache is presumed to be up to date.
@@ -228,12 +698,20 @@ def search_nt_ids(records, cachepath, retries, disabletqdm: bool = True):
     an ELink query; if the record has a nucleotide query
     (nt_query is populated, but aa_query is not), then a direct
     ESearch of NCBI's nucleotide databases is performed.
+
+    If max_links is set and ELink returns more than max_links UIDs
+    for a record, the linked UIDs are ranked on their ESummary
+    (see rank_nt_summaries), and only the top max_links UIDs are
+    added to the cache, with their accessions.
     """
     logger = logging.getLogger(__name__)
 
     addedrows = []  # Holds list of added rows in nt_uid_acc
     noresult = 0  # Count of records with no result
     for record in tqdm(records, desc="2/5 Search NT IDs", disable=disabletqdm):
+        if has_gbregion(cachepath, record.id):  # CDS region already resolved
+            logger.debug("Entry has cached CDS region, not searching: %s", record.id)
+            continue
         if not has_ncbi_uid(cachepath, record.id) and has_nt_query(
             cachepath,
             record.id,
@@ -243,6 +721,7 @@ def search_nt_ids(records, cachepath, retries, disabletqdm: bool = True):
                 get_nt_query(cachepath, record.id),
                 "nucleotide",
                 retries,
+                fetcher=fetcher,
             )
             if result["IdList"]:
                 addedrows.extend(add_ncbi_uids(cachepath, record.id, result["IdList"]))
@@ -261,6 +740,7 @@ def search_nt_ids(records, cachepath, retries, disabletqdm: bool = True):
                 "protein",
                 "protein_nuccore",
                 retries,
+                fetcher=fetcher,
             )
             try:
                 idlist = [lid["Id"] for lid in result[0]["LinkSetDb"][0]["Link"]]
@@ -271,7 +751,18 @@ def search_nt_ids(records, cachepath, retries, disabletqdm: bool = True):
                     record.id,
                 )
                 idlist = None
-            if idlist:
+            if idlist and max_links and len(idlist) > max_links:
+                addedrows.extend(
+                    add_top_linked_uids(
+                        cachepath,
+                        record.id,
+                        idlist,
+                        max_links,
+                        retries,
+                        fetcher=fetcher,
+                    )
+                )
+            elif idlist:
                 addedrows.extend(add_ncbi_uids(cachepath, record.id, idlist))
                 logger.debug("record.id: %s, idlist: %s", record.id, idlist)
             else:
@@ -279,12 +770,389 @@ def search_nt_ids(records, cachepath, retries, disabletqdm: bool = True):
     return addedrows, noresult
 
 
+def get_protein_queries(
+    records: Collection[SeqRecord | QueryRecord], cachepath: Path
+) -> dict[str, list[str]]:
+    """Return IDs of records still needing nucleotide UIDs, by protein query.
+
+    records   - collection of SeqRecords
+    cachepath - path to cache
+
+    Records with a protein query (aa_query), and no cached UIDs or CDS
+    region, are included. Stockholm domains of a protein share its query.
+    """
+    queries = defaultdict(list)
+    for record in records:
+        if (
+            has_gbregion(cachepath, record.id)
+            or has_ncbi_uid(cachepath, record.id)
+            or not has_aa_query(cachepath, record.id)
+        ):
+            continue
+        queries[strip_stockholm_from_seqid(record.id)].append(record.id)
+    return queries
+
+
+# Identify linked nucleotide records from a local link index
+def search_nt_ids_index(  # noqa: PLR0913
+    records: Collection[SeqRecord | QueryRecord],
+    cachepath: Path,
+    link_index: Path,
+    retries: int,
+    *,
+    max_links: None | int = None,
+    fetcher: None | Fetcher = None,
+) -> tuple[list, int]:
+    """Populate cache with nucleotide UIDs from a local link index.
+
+    records    - collection of SeqRecords
+    cachepath  - path to cache
+    link_index - path to link index (built with ncfp-index links)
+    retries    - number of Entrez retries
+    max_links  - maximum number of linked nucleotide records to keep
+    fetcher    - Fetcher backend (default: EntrezFetcher)
+
+    For records with a protein query (aa_query) and no cached UIDs, the
+    linked nucleotide accessions are read from the index, and resolved to
+    UIDs with batched ESummary requests (which replace the ELink for each
+    protein). The UIDs are cached with their accessions already filled in.
+    Where max_links is set, records are kept in the order given by
+    rank_nt_summaries(), as for ELink results.
+
+    Returns the rows added to nt_uid_acc, and a count of the records not
+    found in the index, or whose linked accessions could not be resolved.
+    These are left for search_nt_ids() to ELink.
+    """
+    logger = logging.getLogger(__name__)
+
+    queries = get_protein_queries(records, cachepath)
+    linked = get_link_index_accessions(link_index, queries)
+
+    # Resolve every linked accession to its UID and summary at once
+    accessions = sorted({acc for accs in linked.values() for acc in accs})
+    try:
+        summaries = esummary_with_retries(
+            accessions, "nucleotide", retries, fetcher=fetcher
+        )
+    except NCFPMaxretryException:
+        logger.warning("Could not resolve %d indexed accessions", len(accessions))
+        summaries = []
+    by_accession = {
+        summary["AccessionVersion"]: (uid, summary) for uid, summary in summaries
+    }
+
+    addedrows = []  # Holds list of added rows in nt_uid_acc
+    noresult = sum(
+        len(seqids) for query, seqids in queries.items() if query not in linked
+    )
+    for query, accessions in linked.items():
+        resolved = [by_accession[acc] for acc in accessions if acc in by_accession]
+        if not resolved:
+            logger.debug("Could not resolve index links for %s", query)
+            noresult += len(queries[query])
+            continue
+        if max_links and len(resolved) > max_links:
+            resolved = rank_nt_summaries(resolved)[:max_links]
+        logger.debug("Index links %s to %s", query, [uid for uid, _ in resolved])
+        for seqid in queries[query]:
+            addedrows.extend(
+                add_ncbi_uids(cachepath, seqid, [uid for uid, _ in resolved])
+            )
+        for uid, summary in resolved:
+            update_nt_uid_acc(cachepath, uid, summary["AccessionVersion"])
+    return addedrows, noresult
+
+
+# Identify linked nucleotide records on the NCBI History server
+def search_nt_ids_history(  # noqa: PLR0913
+    records: Collection[SeqRecord | QueryRecord],
+    cachepath: Path,
+    retries: int,
+    batchsize: int,
+    *,
+    disabletqdm: bool = True,
+    max_links: None | int = None,
+    fetcher: None | Fetcher = None,
+) -> tuple[list, int]:
+    """Query NCBI with batched ELink histories, and populate cache.
+
+    records   - collection of SeqRecords
+    cachepath - path to cache
+    retries   - number of Entrez retries
+    batchsize - number of protein queries per ELink request
+    max_links - maximum number of linked nucleotide UIDs to keep per record
+    fetcher   - Fetcher backend (default: EntrezFetcher)
+
+    For records with a protein query (aa_query) and no cached UIDs, ELink
+    is run for a batch of queries at a time with cmd=neighbor_history, so
+    that the linked nucleotide UIDs for each query are held as a separate
+    query on the History server. Each query is then summarised with
+    ESummary, which populates seq_nt and the GenBank accessions in
+    nt_uid_acc, and the GenBank headers of the linked records are
+    fetched with EFetch from the same query (unless max_links is set, in
+    which case the kept records are left to stage 4). The linked UID lists
+    are never downloaded by ELink, or posted back to NCBI with EPost.
+
+    Returns the rows added to nt_uid_acc, and a count of the records for
+    which no linked UIDs could be found. These are left without UIDs, so
+    that search_nt_ids() can retry them one by one.
+    """
+    logger = logging.getLogger(__name__)
+
+    queries = get_protein_queries(records, cachepath)
+    qids = list(queries)
+
+    addedrows = []  # Holds list of added rows in nt_uid_acc
+    noresult = 0  # Count of records with no result
+    for idx in tqdm(
+        range(0, len(qids), batchsize),
+        desc="2/5 Search NT IDs (history)",
+        disable=disabletqdm,
+    ):
+        batch = qids[idx : idx + batchsize]
+        try:
+            linksets = elink_history_with_retries(
+                batch, "protein", "protein_nuccore", retries, fetcher=fetcher
+            )
+        except NCFPMaxretryException:
+            logger.warning("Batch ELink failed for %d queries", len(batch))
+            noresult += sum(len(queries[qid]) for qid in batch)
+            continue
+        matched = match_linksets(batch, linksets, retries, fetcher=fetcher)
+        for qid in batch:
+            if qid not in matched:
+                logger.debug("No ELink result matched query %s", qid)
+                noresult += len(queries[qid])
+                continue
+            history, summaries = summarise_linkset_history(
+                matched[qid], retries, fetcher=fetcher
+            )
+            if not summaries:
+                logger.debug("No linked nucleotide records for %s", qid)
+                noresult += len(queries[qid])
+                continue
+            if max_links and len(summaries) > max_links:
+                summaries = rank_nt_summaries(summaries)[:max_links]
+            for seqid in queries[qid]:
+                addedrows.extend(
+                    add_ncbi_uids(cachepath, seqid, [uid for uid, _ in summaries])
+                )
+            for uid, summary in summaries:
+                update_nt_uid_acc(cachepath, uid, summary["AccessionVersion"])
+            # Fetch headers of the linked records from the same History query
+            if not max_links and not fetch_history_gbheaders(
+                history,
+                [uid for uid, _ in summaries],
+                cachepath,
+                retries,
+                batchsize,
+                fetcher=fetcher,
+            ):
+                logger.warning("Could not fetch GenBank headers for %s", qid)
+    return addedrows, noresult
+
+
+def summarise_linkset_history(
+    linkset: dict[str, Any], retries: int, fetcher: None | Fetcher = None
+) -> tuple[dict[str, str], list[tuple[str, Any]]]:
+    """Return the History query of an ELink neighbor_history LinkSet, summarised.
+
+    linkset   - LinkSet returned by ELink with cmd=neighbor_history
+    retries   - number of Entrez retries
+    fetcher   - Fetcher backend (default: EntrezFetcher)
+
+    Returns the History query (WebEnv and QueryKey), and a list of
+    (UID, DocumentSummary) tuples for the linked records. The list is empty
+    if there are no linked records, or they could not be summarised.
+    """
+    try:
+        history = {
+            "WebEnv": linkset["WebEnv"],
+            "QueryKey": linkset["LinkSetDbHistory"][0]["QueryKey"],
+        }
+    except (IndexError, KeyError):
+        return {}, []
+    try:
+        summaries = esummary_history_with_retries(
+            history, "nucleotide", retries, fetcher=fetcher
+        )
+    except NCFPMaxretryException:
+        return history, []
+    return history, summaries
+
+
+def fetch_history_gbheaders(  # noqa: PLR0913
+    history: dict[str, str],
+    uids: list[str],
+    cachepath: Path,
+    retries: int,
+    batchsize: int,
+    *,
+    fetcher: None | Fetcher = None,
+) -> bool:
+    """Add GenBank headers of the records in a History query to the cache.
+
+    history   - dictionary with the WebEnv and QueryKey of the query
+    uids      - nucleotide UIDs of the records in the query
+    cachepath - path to cache
+    retries   - number of Entrez retries
+    batchsize - number of records per EFetch request
+    fetcher   - Fetcher backend (default: EntrezFetcher)
+
+    Headers are only fetched if any record has no cached header. Returns
+    False if they could not all be fetched, leaving them for stage 4.
+    """
+    nogbhead = set(get_nogbhead_nt_uids(cachepath))
+    if not nogbhead.intersection(uids):
+        return True
+    for retstart in range(0, len(uids), batchsize):
+        try:
+            handle = efetch_history_with_retries(
+                history,
+                "nucleotide",
+                "gb",
+                "text",
+                retries,
+                retstart=retstart,
+                retmax=batchsize,
+                fetcher=fetcher,
+            )
+        except NCFPMaxretryException:
+            return False
+        add_gbheaders_from_handle(cachepath, handle)
+    return True
+
+
+# Match batch ELink LinkSets to the protein queries that produced them
+def match_linksets(
+    qids: Sequence[str],
+    linksets: list[dict[str, Any]],
+    retries: int,
+    fetcher: None | Fetcher = None,
+) -> dict[str, dict[str, Any]]:
+    """Return dictionary of LinkSets, keyed by the query ID they belong to.
+
+    qids      - protein query IDs passed to ELink
+    linksets  - LinkSets returned by ELink
+    retries   - number of Entrez retries
+    fetcher   - Fetcher backend (default: EntrezFetcher)
+
+    Each LinkSet is matched to a query by its IdList. NCBI reports the
+    protein UID there, rather than the accession that was queried, so
+    queries that do not appear in any IdList are resolved to protein UIDs
+    with ESummary. Queries with no matching LinkSet are not returned.
+    """
+    logger = logging.getLogger(__name__)
+
+    by_id = {}  # IdList entry -> LinkSet
+    for linkset in linksets:
+        for linkid in linkset.get("IdList", []):
+            by_id[str(linkid)] = linkset
+    matched = {qid: by_id[qid] for qid in qids if qid in by_id}
+
+    unmatched = [qid for qid in qids if qid not in matched]
+    if not unmatched or len(matched) == len(by_id):
+        return matched
+    try:
+        summaries = esummary_with_retries(
+            unmatched, "protein", retries, fetcher=fetcher
+        )
+    except NCFPMaxretryException:
+        logger.warning("Could not resolve %d queries to UIDs", len(unmatched))
+        return matched
+    for uid, summary in summaries:
+        accessions = {summary.get("AccessionVersion"), summary.get("Caption")}
+        for qid in unmatched:
+            if uid in by_id and (qid in accessions or qid.split(".")[0] in accessions):
+                matched[qid] = by_id[uid]
+    return matched
+
+
+# Keep only the best-ranked linked UIDs for a record
+def add_top_linked_uids(  # noqa: PLR0913
+    cachepath: Path,
+    seqid: str,
+    idlist: Sequence[str],
+    max_links: int,
+    retries: int,
+    *,
+    fetcher: None | Fetcher = None,
+) -> list:
+    """Add the top max_links of the passed UIDs to the cache for seqid.
+
+    cachepath - path to cache database
+    seqid     - input sequence ID
+    idlist    - nucleotide UIDs linked to the input sequence
+    max_links - maximum number of UIDs to keep
+    retries   - number of Entrez retries
+    fetcher   - Fetcher backend (default: EntrezFetcher)
+
+    The UIDs are ranked by rank_nt_summaries() on their ESummary, and
+    the accession of each kept UID is written to the cache directly, so
+    that it need not be fetched in stage 3. If the ESummary fails, the
+    first max_links UIDs returned by ELink are kept instead.
+
+    Returns the rows added to nt_uid_acc.
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        summaries = rank_nt_summaries(
+            esummary_with_retries(idlist, "nucleotide", retries, fetcher=fetcher)
+        )[:max_links]
+    except NCFPMaxretryException:
+        logger.warning(
+            "ESummary failed for %s: keeping first %d of %d linked UIDs",
+            seqid,
+            max_links,
+            len(idlist),
+        )
+        return add_ncbi_uids(cachepath, seqid, idlist[:max_links])
+
+    logger.debug(
+        "Keeping %d of %d linked UIDs for %s", len(summaries), len(idlist), seqid
+    )
+    addedrows = add_ncbi_uids(cachepath, seqid, [uid for uid, _ in summaries])
+    for uid, summary in summaries:
+        update_nt_uid_acc(cachepath, uid, summary["AccessionVersion"])
+    return addedrows
+
+
+def rank_nt_summaries(
+    summaries: Iterable[tuple[str, dict[str, Any]]],
+) -> list[tuple[str, dict[str, Any]]]:
+    """Return nucleotide (UID, ESummary) pairs, best candidate first.
+
+    summaries - collection of (UID, ESummary document) tuples
+
+    Records annotated as partial are ranked last; otherwise records
+    are ranked by sequence length (shortest first, as these are the
+    cheapest to download, and stage 5 keeps the shortest record), then
+    RefSeq records are preferred over INSDC records.
+    """
+    return sorted(
+        summaries,
+        key=lambda item: (
+            item[1].get("Completeness", "") == "partial",
+            int(item[1].get("Slen", 0)),
+            item[1].get("SourceDb", "") != "refseq",
+        ),
+    )
+
+
 # Update existing cache nt_uid_acc table with accessions from NCBI
-def update_gb_accessions(cachepath, retries, disabletqdm=True):
+def update_gb_accessions(
+    cachepath: Path,
+    retries: int,
+    *,
+    disabletqdm: bool = True,
+    fetcher: None | Fetcher = None,
+) -> tuple[list, int]:
     """Update cache table with GenBank accession for each UID.
 
     cachepath     - path to cache database
     retries       - number of Entres retries
+    fetcher       - Fetcher backend (default: EntrezFetcher)
 
     For each UID in nt_uid_acc where there is no GenBank accession,
     obtain the GenBank accession and update the row.
@@ -299,7 +1167,9 @@ def update_gb_accessions(cachepath, retries, disabletqdm=True):
         disable=disabletqdm,
     ):
         result = (
-            efetch_with_retries(uid, "nucleotide", "acc", "text", retries)
+            efetch_with_retries(
+                uid, "nucleotide", "acc", "text", retries, fetcher=fetcher
+            )
             .read()
             .strip()
         )
@@ -313,24 +1183,27 @@ def update_gb_accessions(cachepath, retries, disabletqdm=True):
 
 
 # Run an ESearch on a single ID
-def esearch_with_retries(query_id, dbname, maxretries):
+def esearch_with_retries(
+    query_id: str, dbname: str, maxretries: int, fetcher: None | Fetcher = None
+) -> dict[str, Any]:
     """Entrez ESearch for single query ID.
 
     query_id    - query term for search
     dbname      - NCBI target database name
     maxretries  - maximum number of attempts to make
+    fetcher     - Fetcher backend (default: EntrezFetcher)
 
     Returns the parsed record resulting from the ESearch,
     after trying the ESearch up to a maximum number of times.
     """
     logger = logging.getLogger(__name__)
     logger.debug("ESearch query: %s (db: %s)", query_id, dbname)
+    fetcher = fetcher or get_fetcher()
 
     tries = 0
     while tries < maxretries:
         try:
-            handle = Entrez.esearch(db=dbname, term=query_id)
-            return Entrez.read(handle)
+            return fetcher.search(dbname, query_id)
         except Exception:
             tries += 1
             logger.warning(
@@ -342,16 +1215,164 @@ def esearch_with_retries(query_id, dbname, maxretries):
     raise NCFPMaxretryException("Query ID %s ESearch failed\n%s" % query_id)
 
 
-def elink_fetch_with_retries(query_id, dbname, linkdbname, maxretries):
+# Run a batched ESummary on a list of IDs
+def esummary_with_retries(
+    qids: Sequence[str],
+    dbname: str,
+    maxretries: int,
+    batchsize: int = 500,
+    fetcher: None | Fetcher = None,
+) -> list[tuple[str, Any]]:
+    """Entrez ESummary (version 2.0) for a collection of query IDs.
+
+    qids        - collection of query IDs
+    dbname      - NCBI target database name
+    maxretries  - maximum number of attempts to make for each batch
+    batchsize   - number of IDs to summarise in each request
+    fetcher     - Fetcher backend (default: EntrezFetcher)
+
+    Returns a list of (UID, DocumentSummary) tuples.
+    """
+    summaries = []
+    for idx in range(0, len(qids), batchsize):
+        summaries.extend(
+            esummary_docs_with_retries(
+                dbname,
+                maxretries,
+                fetcher=fetcher,
+                id=",".join(qids[idx : idx + batchsize]),
+            )
+        )
+    return summaries
+
+
+# Page through ESummary (version 2.0) of a History server query
+def esummary_history_with_retries(
+    history: dict[str, str],
+    dbname: str,
+    maxretries: int,
+    batchsize: int = 500,
+    fetcher: None | Fetcher = None,
+) -> list[tuple[str, Any]]:
+    """Entrez ESummary (version 2.0) for every record of a History query.
+
+    history     - History server query, with WebEnv and QueryKey
+    dbname      - NCBI target database name
+    maxretries  - maximum number of attempts to make for each page
+    batchsize   - number of records to summarise in each request
+    fetcher     - Fetcher backend (default: EntrezFetcher)
+
+    Returns a list of (UID, DocumentSummary) tuples.
+    """
+    summaries = []
+    retstart = 0
+    while True:
+        page = esummary_docs_with_retries(
+            dbname,
+            maxretries,
+            fetcher=fetcher,
+            webenv=history["WebEnv"],
+            query_key=history["QueryKey"],
+            retstart=retstart,
+            retmax=batchsize,
+        )
+        summaries.extend(page)
+        if len(page) < batchsize:
+            return summaries
+        retstart += batchsize
+
+
+def esummary_docs_with_retries(
+    dbname: str, maxretries: int, fetcher: None | Fetcher = None, **params: object
+) -> list[tuple[str, Any]]:
+    """Run a single Entrez ESummary (version 2.0) request.
+
+    dbname      - NCBI target database name
+    maxretries  - maximum number of attempts to make
+    fetcher     - Fetcher backend (default: EntrezFetcher)
+    params      - identifiers (id, or webenv/query_key) and paging parameters
+
+    Returns a list of (UID, DocumentSummary) tuples.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug("ESummary query: %s (db: %s)", params, dbname)
+    fetcher = fetcher or get_fetcher()
+
+    tries = 0
+    while tries < maxretries:
+        try:
+            return fetcher.summary(dbname, **params)
+        except Exception:  # noqa: PERF203
+            tries += 1
+            logger.warning(
+                "ESummary query (db: %s) failed (retry %d)",
+                dbname,
+                tries,
+                exc_info=True,
+            )
+    msg = "ESummary failed"
+    raise NCFPMaxretryException(msg)
+
+
+def elink_history_with_retries(
+    query_ids: Sequence[str],
+    dbname: str,
+    linkdbname: str,
+    maxretries: int,
+    fetcher: None | Fetcher = None,
+) -> list[dict[str, Any]]:
+    """Entrez ELink to the History server, for a batch of query IDs.
+
+    query_ids       - collection of query terms
+    dbname          - NCBI target database name for primary query
+    linkdbname      - NCBI target database name for link query
+    maxretries      - maximum number of attempts to make
+    fetcher         - Fetcher backend (default: EntrezFetcher)
+
+    The query IDs are passed as separate id parameters, so that NCBI
+    returns one LinkSet (and History query) per query ID. LinkSets are
+    matched to their queries with match_linksets().
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug("ELink history query: %d IDs", len(query_ids))
+    fetcher = fetcher or get_fetcher()
+
+    tries = 0
+    while tries < maxretries:
+        try:
+            return fetcher.link(
+                dbname, linkdbname, list(query_ids), cmd="neighbor_history"
+            )
+        except Exception:  # noqa: PERF203
+            tries += 1
+            logger.warning(
+                "ELink history query (%d IDs) failed (retry %d)",
+                len(query_ids),
+                tries,
+                exc_info=True,
+            )
+    msg = "Batch ELink history query failed"
+    raise NCFPMaxretryException(msg)
+
+
+def elink_fetch_with_retries(
+    query_id: str,
+    dbname: str,
+    linkdbname: str,
+    maxretries: int,
+    fetcher: None | Fetcher = None,
+) -> list[dict[str, Any]]:
     """Entrez ELink fetch for a single query_id.
 
     query_id        - query term for search
     dbname          - NCBI target database name for primary query
     linkdbname      - NCBI target database name for link query
     maxretries      - maximum number of attempts to make
+    fetcher         - Fetcher backend (default: EntrezFetcher)
     """
     logger = logging.getLogger(__name__)
     logger.debug("ELink query: %s", query_id)
+    fetcher = fetcher or get_fetcher()
 
     tries = 0
     while tries < maxretries:
@@ -362,9 +1383,7 @@ def elink_fetch_with_retries(query_id, dbname, linkdbname, maxretries):
                 linkdbname,
                 query_id,
             )
-            matches = Entrez.read(
-                Entrez.elink(dbfrom=dbname, linkname=linkdbname, id=query_id),
-            )
+            matches = fetcher.link(dbname, linkdbname, query_id)
             logger.debug("matches: %s", matches)
             return matches
         except Exception:
@@ -379,7 +1398,18 @@ def elink_fetch_with_retries(query_id, dbname, linkdbname, maxretries):
 
 
 # Run an EFetch on a single ID
-def efetch_with_retries(query_id, dbname, rettype, retmode, maxretries):
+def efetch_with_retries(  # noqa: PLR0913
+    query_id: str,
+    dbname: str,
+    rettype: str,
+    retmode: str,
+    maxretries: int,
+    *,
+    seq_start: None | int = None,
+    seq_stop: None | int = None,
+    strand: None | int = None,
+    fetcher: None | Fetcher = None,
+) -> StringIO:
     """Entrez EFetch for a single query ID.
 
     query_id      - query term for search
@@ -387,21 +1417,29 @@ def efetch_with_retries(query_id, dbname, rettype, retmode, maxretries):
     rettype       - requested return type
     retmode       - format of data to be returned
     maxretries    - maximum number of attempts to make
+    seq_start     - first (1-based) position of sequence to fetch
+    seq_stop      - last (1-based) position of sequence to fetch
+    strand        - strand of sequence to fetch (1: plus, 2: minus)
+    fetcher       - Fetcher backend (default: EntrezFetcher)
 
     Returns a handle to a completely buffered string, after a read()
     operation, sanity check, and retokenising.
     """
     logger = logging.getLogger(__name__)
+    fetcher = fetcher or get_fetcher()
 
     tries = 0
     while tries < maxretries:
         try:
-            data = Entrez.efetch(
-                db=dbname,
-                rettype=rettype,
-                retmode=retmode,
+            data = fetcher.fetch(
+                dbname,
+                rettype,
+                retmode,
                 id=query_id,
-            ).read()
+                seq_start=seq_start,
+                seq_stop=seq_stop,
+                strand=strand,
+            )
             if rettype in ["gb", "gbwithparts"] and retmode == "text":
                 if not data.startswith("LOCUS"):
                     msg = "Data does not begin with expected LOCUS string"
@@ -420,20 +1458,25 @@ def efetch_with_retries(query_id, dbname, rettype, retmode, maxretries):
 
 
 # Batch EPost to get history for a set of query IDs
-def epost_history_with_retries(qids, dbname, maxretries):
+def epost_history_with_retries(
+    qids: Sequence[str], dbname: str, maxretries: int, fetcher: None | Fetcher = None
+) -> dict[str, Any]:
     """Entrez EPost for a batch of queryids.
 
     qids            - Collection of query IDs
     dbname          - target NCBI database
     maxretries      - maximum download attempts
+    fetcher         - Fetcher backend (default: EntrezFetcher)
 
     Returns the generated history, as parsed by Entrez.read()
     """
+    fetcher = fetcher or get_fetcher()
+
     tries = 0
     while tries < maxretries:
         try:
             # Get and return history
-            return Entrez.read(Entrez.epost(dbname, id=",".join(qids)))
+            return fetcher.post(dbname, qids)
         except Exception:
             tries += 1
 
@@ -441,7 +1484,17 @@ def epost_history_with_retries(qids, dbname, maxretries):
     raise NCFPMaxretryException(errmsg)
 
 
-def efetch_history_with_retries(history, dbname, rettype, retmode, maxretries):
+def efetch_history_with_retries(  # noqa: PLR0913
+    history: dict[str, str],
+    dbname: str,
+    rettype: str,
+    retmode: str,
+    maxretries: int,
+    *,
+    retstart: None | int = None,
+    retmax: None | int = None,
+    fetcher: None | Fetcher = None,
+) -> StringIO:
     """Run Entrez EFetch on a passed EPost history.
 
     history          - EPost history
@@ -449,19 +1502,26 @@ def efetch_history_with_retries(history, dbname, rettype, retmode, maxretries):
     rettype          - return datatype
     retmode          - return data mode
     maxretries       - maximum download attempts
+    retstart         - index of first record in the history to fetch
+    retmax           - maximum number of records to fetch
+    fetcher          - Fetcher backend (default: EntrezFetcher)
 
     Returns the result data as a tokenised string.
     """
+    fetcher = fetcher or get_fetcher()
+
     tries = 0
     while tries < maxretries:
         try:
-            data = Entrez.efetch(
-                db=dbname,
-                rettype=rettype,
-                retmode=retmode,
+            data = fetcher.fetch(
+                dbname,
+                rettype,
+                retmode,
                 webenv=history["WebEnv"],
                 query_key=history["QueryKey"],
-            ).read()
+                retstart=retstart,
+                retmax=retmax,
+            )
             if rettype in ["gb", "gbwithparts"] and retmode == "text":
                 if not data.startswith("LOCUS"):
                     errmsg = "Returned data does not begin with string LOCUS"
@@ -474,6 +1534,147 @@ def efetch_history_with_retries(history, dbname, rettype, retmode, maxretries):
     raise NCFPMaxretryException(errmsg)
 
 
+# Batch EPost and EFetch a list of query IDs, one history per batch
+def efetch_batches_with_retries(  # noqa: PLR0913, PLR0917
+    qids: Sequence[str],
+    dbname: str,
+    rettype: str,
+    retmode: str,
+    maxretries: int,
+    batchsize: int,
+    *,
+    desc: None | str = None,
+    disabletqdm: bool = True,
+    fetcher: None | Fetcher = None,
+) -> Iterator[None | StringIO]:
+    """Generate EFetch results for batches of query IDs.
+
+    qids            - list of query IDs
+    dbname          - target NCBI database
+    rettype         - return datatype
+    retmode         - return data mode
+    maxretries      - maximum download attempts
+    batchsize       - number of query IDs per EPost history
+    fetcher         - Fetcher backend (default: EntrezFetcher)
+
+    Creates one EPost history per batch of query IDs, then yields the
+    EFetch result for each history in turn. None is yielded in place of
+    any batch that could not be downloaded.
+    """
+    epost_histories = [
+        epost_history_with_retries(
+            qids[idx : idx + batchsize], dbname, maxretries, fetcher=fetcher
+        )
+        for idx in range(0, len(qids), batchsize)
+    ]
+    for history in tqdm(epost_histories, desc=desc, disable=disabletqdm):
+        try:
+            yield efetch_history_with_retries(
+                history, dbname, rettype, retmode, maxretries, fetcher=fetcher
+            )
+        except NCFPMaxretryException:  # noqa: PERF203
+            yield None
+
+
+# Page through large EPost histories, checkpointing progress in the cache
+def efetch_pages_with_retries(  # noqa: PLR0913, PLR0917
+    cachepath: Path,
+    stage: str,
+    qids: Sequence[str],
+    dbname: str,
+    rettype: str,
+    retmode: str,
+    maxretries: int,
+    pagesize: int,
+    postsize: int,
+    *,
+    desc: None | str = None,
+    disabletqdm: bool = True,
+    fetcher: None | Fetcher = None,
+) -> Iterator[None | StringIO]:
+    """Generate paged EFetch results for a list of query IDs.
+
+    cachepath       - path to cache database
+    stage           - name of the stage, used to key the checkpoint
+    qids            - list of query IDs
+    dbname          - target NCBI database
+    rettype         - return datatype
+    retmode         - return data mode
+    maxretries      - maximum download attempts
+    pagesize        - number of records per EFetch (retmax)
+    postsize        - number of query IDs per EPost history
+    fetcher         - Fetcher backend (default: EntrezFetcher)
+
+    The query IDs are posted to NCBI in as few histories as postsize allows,
+    and each history is paged through with retstart/retmax. The position of
+    the next page is written to the cache, with the list of query IDs, once
+    the caller has consumed the current page. If the stage is interrupted,
+    the rerun posts the recorded list again and resumes from the last
+    committed page, so long as every query ID passed is in that list (IDs
+    fetched before the interruption need not be). A checkpoint for other
+    query IDs is discarded. None is yielded in place of any page that could
+    not be downloaded.
+    """
+    logger = logging.getLogger(__name__)
+
+    checkpoint = get_fetch_checkpoint(cachepath, stage)
+    if checkpoint is not None and (not qids or not set(qids).issubset(checkpoint[0])):
+        logger.warning("Discarding %s checkpoint for different query IDs", stage)
+        checkpoint = None
+    if checkpoint is None:
+        offset = 0
+        set_fetch_checkpoint(cachepath, stage, qids, offset)
+    else:
+        # Pages are fetched from histories of the IDs posted when the stage
+        # started, which include those that were fetched before it stopped
+        qids, offset = checkpoint
+        logger.info("Resuming %s fetch at record %d/%d", stage, offset, len(qids))
+
+    with tqdm(
+        total=len(qids),
+        initial=offset,
+        desc=desc,
+        disable=disabletqdm,
+    ) as pbar:
+        while offset < len(qids):
+            # Histories are not kept between runs, so (re-)post the chunk
+            # containing the next page
+            poststart = offset - (offset % postsize)
+            chunk = qids[poststart : poststart + postsize]
+            try:
+                history = epost_history_with_retries(
+                    chunk, dbname, maxretries, fetcher=fetcher
+                )
+            except NCFPMaxretryException:
+                # Without a history no page in this chunk can be fetched, but
+                # each is reported as failed so counts stay consistent
+                logger.warning("Batch EPost failed for %s", stage)
+                history = None
+            while offset < poststart + len(chunk):
+                retmax = min(pagesize, poststart + len(chunk) - offset)
+                if history is None:
+                    yield None
+                else:
+                    try:
+                        yield efetch_history_with_retries(
+                            history,
+                            dbname,
+                            rettype,
+                            retmode,
+                            maxretries,
+                            retstart=offset - poststart,
+                            retmax=retmax,
+                            fetcher=fetcher,
+                        )
+                    except NCFPMaxretryException:
+                        yield None
+                offset += retmax
+                advance_fetch_checkpoint(cachepath, stage, offset)
+                pbar.update(retmax)
+
+    clear_fetch_checkpoint(cachepath, stage)
+
+
 def set_entrez_email(email: str) -> None:
     """Set Entrez email address."""
     Entrez.email = email
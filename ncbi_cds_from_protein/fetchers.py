@@ -0,0 +1,490 @@
+# (c) The James Hutton Institute 2017-2019
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute for Pharmacy and Biomedical Sciences,
+# Cathedral Street,
+# Glasgow,
+# G1 1XQ
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2017-2019 The James Hutton Institute
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Backends that carry out Entrez E-utility requests for ncfp stages.
+
+Stage functions in ncbi_cds_from_protein.entrez do not call Bio.Entrez
+directly. They take a fetcher - any object implementing the Fetcher
+protocol below - and leave retries and checkpointing to the caller.
+EntrezFetcher is the default, and talks to NCBI via Biopython.
+Alternative backends are registered by name in FETCHERS, so that they
+can be selected with the --fetcher command-line option.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import Counter
+from io import BytesIO, StringIO, TextIOWrapper
+from typing import IO, TYPE_CHECKING, Any, TextIO
+from urllib.parse import urlencode, urlparse
+from urllib.request import Request, urlopen
+
+from Bio import Entrez
+
+from ncbi_cds_from_protein import NCFPException
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Hashable, Sequence
+
+    from .httpcache import ResponseCache
+
+try:
+    from typing import Protocol
+except ImportError:  # Python < 3.8
+    Protocol = object  # type: ignore[assignment,misc]
+
+
+class Fetcher(Protocol):
+    """Interface for E-utility backends.
+
+    Search, link, post and summary results are returned parsed, in the
+    structures produced by Bio.Entrez.read(). EFetch results are returned
+    as text, either fully read (fetch) or as an open stream (fetch_stream).
+    History queries are dicts with "WebEnv" and "QueryKey" keys.
+    """
+
+    def search(self, db: str, term: str) -> dict[str, Any]:
+        """ESearch db for term."""
+
+    def link(
+        self,
+        dbfrom: str,
+        linkname: str,
+        ids: str | Sequence[str],
+        cmd: None | str = None,
+    ) -> list[dict[str, Any]]:
+        """ELink ids (one ID, or a list of IDs) from dbfrom via linkname."""
+
+    def post(self, db: str, ids: Sequence[str]) -> dict[str, Any]:
+        """EPost ids to the History server for db."""
+
+    def summary(self, db: str, **params: object) -> list[tuple[str, Any]]:
+        """ESummary (version 2.0), returning (UID, DocumentSummary) tuples."""
+
+    def fetch(self, db: str, rettype: str, retmode: str, **params: object) -> str:
+        """EFetch records from db, returning the text of the response."""
+
+    def fetch_stream(
+        self, db: str, rettype: str, retmode: str, **params: object
+    ) -> TextIO:
+        """EFetch records from db, returning an open stream of the response."""
+
+    def fetch_batch(
+        self, db: str, ids: Sequence[str], rettype: str, retmode: str, **params: object
+    ) -> str:
+        """EPost ids and EFetch them in a single History query."""
+
+
+# Request options for each E-utility, used with a base URL override: EPost
+# is sent as a POST request, and ELink IDs as separate id parameters, so
+# that NCBI returns one LinkSet per ID
+ENTREZ_REQUEST_OPTIONS = {"epost": {"post": True}, "elink": {"join_ids": False}}
+
+
+# NCBI E-utility request rate limits (requests/second), without and with an
+# API key
+ENTREZ_RATE = 3
+ENTREZ_RATE_API_KEY = 10
+
+
+class RateLimiter:
+    """Spaces out E-utility requests made from any thread of this process.
+
+    Bio.Entrez's own rate limiting is not thread-safe, so concurrent stages
+    (e.g. with --pipeline) could together exceed NCBI's limit. Each call to
+    wait() reserves the next request slot under a lock, then sleeps until
+    that slot, so requests are never sent faster than the limit.
+    """
+
+    def __init__(self) -> None:
+        """Instantiate class."""
+        self._lock = threading.Lock()
+        self._next = 0.0  # time.monotonic() of the next free request slot
+
+    def interval(self) -> float:
+        """Return seconds between requests, for the current Entrez.api_key."""
+        if Entrez.api_key:
+            return 1 / ENTREZ_RATE_API_KEY
+        return 1 / ENTREZ_RATE
+
+    def wait(self) -> None:
+        """Block until this thread may send a request."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval()
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Rate limiter shared by every EntrezFetcher in this process
+RATE_LIMITER = RateLimiter()
+
+
+def check_efetch_text(data: str, rettype: str, retmode: str) -> str:
+    """Return EFetch response text, raising NCFPException if it is not valid.
+
+    data        - text of the EFetch response
+    rettype     - requested return type
+    retmode     - requested return mode
+
+    Empty responses, XML/HTML error pages in place of text, and GenBank
+    flatfiles that do not start with LOCUS or end with // (truncated) are
+    not valid.
+    """
+    msg = None
+    if not data.strip():
+        msg = "EFetch returned an empty response"
+    elif retmode == "text" and data.lstrip().startswith("<"):
+        msg = "EFetch returned markup in place of text"
+    elif rettype in ("gb", "gbwithparts") and retmode == "text":
+        if not data.startswith("LOCUS"):
+            msg = "EFetch data does not begin with LOCUS"
+        elif not data.rstrip().endswith("//"):
+            msg = "EFetch data does not end with //"
+    if msg is not None:
+        raise NCFPException(msg)
+    return data
+
+
+def is_volatile(service: str, params: dict[str, Any]) -> bool:
+    """Return True if a request creates or uses NCBI History server state.
+
+    service     - name of the Bio.Entrez function (e.g. "efetch")
+    params      - request parameters
+    """
+    return (
+        service == "epost"
+        or (service == "elink" and params.get("cmd") == "neighbor_history")
+        or params.get("webenv") is not None
+    )
+
+
+class EntrezFetcher:
+    """Fetcher that sends requests to NCBI with Bio.Entrez.
+
+    Bio.Entrez functions are looked up at call time, so Entrez.email,
+    Entrez.api_key and any patched functions are respected. If an
+    http_cache is given, responses are read from and stored in it.
+
+    Bio.Entrez has the NCBI E-utilities URL built in. If base_url is given,
+    requests are instead built with urllib, and sent to
+    <base_url>/<utility>.fcgi with the email, tool and api_key parameters
+    that Bio.Entrez would send. This is used to point ncfp at a mirror or a
+    mock server. Failed requests raise urllib's HTTPError or URLError, and
+    are retried by the caller.
+    """
+
+    name = "entrez"
+
+    def __init__(
+        self, http_cache: None | ResponseCache = None, base_url: None | str = None
+    ) -> None:
+        """Instantiate class.
+
+        http_cache  - if not None, ResponseCache for E-utility responses
+        base_url    - if not None, http(s) URL to use in place of the NCBI
+                      E-utilities
+        """
+        if base_url and urlparse(base_url).scheme not in ("http", "https"):
+            msg = f"E-utilities URL {base_url} is not an http(s) URL"
+            raise NCFPException(msg)
+        self.http_cache = http_cache
+        self.base_url = base_url.rstrip("/") if base_url else None
+
+    def send(self, service: str, **params: object) -> IO:
+        """Send an E-utility request to NCBI or base_url, returning the handle.
+
+        Requests from all threads are spaced out by the shared RATE_LIMITER.
+        """
+        RATE_LIMITER.wait()
+        if self.base_url is None:
+            return getattr(Entrez, service)(**params)
+        # base_url is checked to be http(s) on instantiation
+        handle = urlopen(self.build_request(service, params))  # noqa: S310
+        # As with Bio.Entrez, EFetch responses are read as text
+        if service == "efetch":
+            return TextIOWrapper(handle, encoding="utf-8")
+        return handle
+
+    def build_request(self, service: str, params: dict[str, Any]) -> Request:
+        """Return the urllib Request for an E-utility at base_url.
+
+        service     - name of the Bio.Entrez function (e.g. "efetch")
+        params      - request parameters
+
+        Parameters with no value are left out, and lists of values are
+        joined with commas, unless ENTREZ_REQUEST_OPTIONS asks for them to
+        be sent as repeated parameters.
+        """
+        options = ENTREZ_REQUEST_OPTIONS.get(service, {})
+        query = {"tool": Entrez.tool, "email": Entrez.email, "api_key": Entrez.api_key}
+        query.update(params)
+        query = {key: value for key, value in query.items() if value is not None}
+        if options.get("join_ids", True) and isinstance(query.get("id"), list):
+            query["id"] = ",".join(query["id"])
+        data = urlencode(query, doseq=True)
+        url = f"{self.base_url}/{service}.fcgi"
+        if options.get("post", False):
+            return Request(url, data=data.encode())  # noqa: S310
+        return Request(f"{url}?{data}")  # noqa: S310
+
+    def request(
+        self, service: str, parse: Callable[[IO], Any], **params: object
+    ) -> Any:  # noqa: ANN401
+        """Send an E-utility request, returning the parsed response.
+
+        service     - name of the Bio.Entrez function (e.g. "efetch")
+        parse       - callable parsing a handle to the response, raising an
+                      exception if it is not valid
+        params      - request parameters
+
+        Responses are only stored in the http_cache once parsed. Cached
+        EFetch responses are parsed from text handles, and other (XML)
+        responses from binary handles, as Bio.Entrez.read() expects.
+        """
+        if self.http_cache is None:
+            return parse(self.send(service, **params))
+        if service == "efetch":
+            parse_data = lambda data: parse(StringIO(data.decode()))  # noqa: E731
+        else:
+            parse_data = lambda data: parse(BytesIO(data))  # noqa: E731
+        return self.http_cache.fetch(
+            "entrez." + service,
+            params,
+            lambda: self.send(service, **params).read(),
+            parse=parse_data,
+            volatile=is_volatile(service, params),
+        )
+
+    def search(self, db: str, term: str) -> dict[str, Any]:
+        """ESearch db for term."""
+        return self.request("esearch", Entrez.read, db=db, term=term)
+
+    def link(
+        self,
+        dbfrom: str,
+        linkname: str,
+        ids: str | Sequence[str],
+        cmd: None | str = None,
+    ) -> list[dict[str, Any]]:
+        """ELink ids (one ID, or a list of IDs) from dbfrom via linkname."""
+        params = {"dbfrom": dbfrom, "linkname": linkname, "id": ids}
+        if cmd is not None:
+            params["cmd"] = cmd
+        return self.request("elink", Entrez.read, **params)
+
+    def post(self, db: str, ids: Sequence[str]) -> dict[str, Any]:
+        """EPost ids to the History server for db."""
+        return self.request("epost", Entrez.read, db=db, id=",".join(ids))
+
+    def summary(self, db: str, **params: object) -> list[tuple[str, Any]]:
+        """ESummary (version 2.0), returning (UID, DocumentSummary) tuples."""
+        result = self.request("esummary", Entrez.read, db=db, version="2.0", **params)
+        docs = result["DocumentSummarySet"].get("DocumentSummary", [])
+        return [(doc.attributes["uid"], doc) for doc in docs]
+
+    def fetch(self, db: str, rettype: str, retmode: str, **params: object) -> str:
+        """EFetch records from db, returning the checked text of the response."""
+        return self.request(
+            "efetch",
+            lambda handle: check_efetch_text(handle.read(), rettype, retmode),
+            db=db,
+            rettype=rettype,
+            retmode=retmode,
+            **params,
+        )
+
+    def fetch_stream(
+        self, db: str, rettype: str, retmode: str, **params: object
+    ) -> TextIO:
+        """EFetch records from db, returning an open stream of the response.
+
+        Without an http_cache, the response is not read before it is
+        returned, so it is not checked.
+        """
+        if self.http_cache is None:
+            return self.send(
+                "efetch", db=db, rettype=rettype, retmode=retmode, **params
+            )
+        return StringIO(self.fetch(db, rettype, retmode, **params))
+
+    def fetch_batch(
+        self, db: str, ids: Sequence[str], rettype: str, retmode: str, **params: object
+    ) -> str:
+        """EPost ids and EFetch them in a single History query."""
+        history = self.post(db, ids)
+        return self.fetch(
+            db,
+            rettype,
+            retmode,
+            webenv=history["WebEnv"],
+            query_key=history["QueryKey"],
+            **params,
+        )
+
+
+class SingleFlight:
+    """Share the result of a call with concurrent callers using the same key.
+
+    The first caller for a key makes the call; callers arriving while it is
+    in flight wait for, and are given, the same result (or exception). Keys
+    are forgotten once the call completes, so later callers make a new call.
+    """
+
+    def __init__(self) -> None:
+        """Instantiate class."""
+        self._lock = threading.Lock()
+        self._inflight: dict[Hashable, _FlightCall] = {}
+        self.calls = Counter()  # calls made, by kind
+        self.hits = Counter()  # calls shared with an in-flight call, by kind
+
+    def do(self, key: tuple, func: Callable[[], Any]) -> Any:  # noqa: ANN401
+        """Return func(), shared with any in-flight call for key.
+
+        key     - hashable key; key[0] is counted as the kind of call
+        func    - callable making the call
+        """
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _FlightCall()
+                self.calls[key[0]] += 1
+            else:
+                self.hits[key[0]] += 1
+        if leader:
+            try:
+                call.result = func()
+            except Exception as exc:  # noqa: BLE001 - raised for every caller below
+                call.error = exc
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _FlightCall:
+    """In-flight call held by SingleFlight."""
+
+    def __init__(self) -> None:
+        """Instantiate class."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlightFetcher:
+    """Fetcher that coalesces concurrent identical EFetch and ESummary requests.
+
+    Requests are keyed on the database, return type and all other request
+    parameters (e.g. id, seq_start/seq_stop). Other requests, and streamed
+    EFetch results (which can only be read once), are passed straight to the
+    wrapped fetcher. Counts of requests made and shared are held in flight.
+    """
+
+    def __init__(self, fetcher: Fetcher) -> None:
+        """Instantiate class.
+
+        fetcher     - Fetcher to send requests to
+        """
+        self.fetcher = fetcher
+        self.flight = SingleFlight()
+
+    @property
+    def name(self) -> str:
+        """Name of the wrapped fetcher."""
+        return self.fetcher.name
+
+    def __getattr__(self, attr: str) -> Any:  # noqa: ANN401
+        """Pass other requests to the wrapped fetcher."""
+        return getattr(self.fetcher, attr)
+
+    def fetch(self, db: str, rettype: str, retmode: str, **params: object) -> str:
+        """EFetch records from db, sharing the text with identical requests."""
+        key = ("efetch", db, rettype, retmode, flight_params(params))
+        return self.flight.do(
+            key, lambda: self.fetcher.fetch(db, rettype, retmode, **params)
+        )
+
+    def summary(self, db: str, **params: object) -> list[tuple[str, Any]]:
+        """ESummary (version 2.0), sharing the result with identical requests."""
+        key = ("esummary", db, flight_params(params))
+        return self.flight.do(key, lambda: self.fetcher.summary(db, **params))
+
+
+def flight_params(params: dict[str, Any]) -> tuple[tuple[str, Any], ...]:
+    """Return request parameters as a hashable, order-independent key."""
+    return tuple(
+        sorted(
+            (key, tuple(value) if isinstance(value, list) else str(value))
+            for key, value in params.items()
+            if value is not None
+        )
+    )
+
+
+# Fetcher classes available to the --fetcher option, by name
+FETCHERS = {EntrezFetcher.name: EntrezFetcher}
+
+
+def register_fetcher(name: str, fetcher_class: type[Fetcher]) -> None:
+    """Make a Fetcher class available by name.
+
+    name            - name used to select the fetcher
+    fetcher_class   - class implementing the Fetcher protocol
+    """
+    FETCHERS[name] = fetcher_class
+
+
+def get_fetcher(name: str = EntrezFetcher.name, **kwargs: object) -> Fetcher:
+    """Return a new instance of the named fetcher.
+
+    name    - name of a registered fetcher
+    kwargs  - passed to the fetcher class on instantiation
+    """
+    if name not in FETCHERS:
+        msg = f"Unknown fetcher {name} (expected one of {', '.join(FETCHERS)})"
+        raise NCFPException(msg)
+    return FETCHERS[name](**kwargs)
@@ -0,0 +1,281 @@
+# (c) The James Hutton Institute 2017-2019
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute for Pharmacy and Biomedical Sciences,
+# Cathedral Street,
+# Glasgow,
+# G1 1XQ
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2017-2019 The James Hutton Institute
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Record and replay E-utility and UniProt responses on disk.
+
+Each response is stored as a gzip-compressed blob, named by the SHA-256
+digest of its service name and normalised request parameters. The cache
+has three modes:
+
+- read-through: cached responses are returned, and missing responses are
+  requested and stored
+- record: every response is requested, and stored (replacing any cached
+  response)
+- replay: only cached responses are returned; a missing response raises
+  NCFPCacheMissException, and no request is made
+
+Responses are only stored once the caller has parsed them without error,
+so that an empty, truncated or error response is requested again rather
+than replayed. A cached response that no longer parses is discarded.
+
+NCBI History server (WebEnv) values expire on the server, so EPost and
+ELink neighbor_history responses, and requests that use their WebEnv, are
+volatile: they are not cached in read-through mode. In record and replay
+modes they are kept, so that a rerun of the same job replays the requests
+that use them.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from bioservices import UniProt
+
+from ncbi_cds_from_protein import NCFPException
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+HTTP_CACHE_MODES = ("read-through", "record", "replay")
+
+
+class NCFPCacheMissException(Exception):  # noqa: N818 - as NCFPException
+    """Exception raised when a response is not in a replay-only cache."""
+
+    def __init__(self, msg: str = "Response not found in HTTP cache") -> None:
+        """Instantiate class."""
+        Exception.__init__(self, msg)
+
+
+def normalise_params(params: dict[str, Any]) -> dict[str, Any]:
+    """Return request parameters in a canonical form for keying the cache.
+
+    :param params:  request parameters
+
+    Parameters with value None are not sent, so are dropped. Sequences of
+    values are kept in order, and all values are converted to strings.
+    """
+    normalised = {}
+    for key, value in params.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            normalised[key] = [str(_) for _ in value]
+        else:
+            normalised[key] = str(value)
+    return normalised
+
+
+class ResponseCache:
+    """Directory of gzip-compressed responses, keyed by request."""
+
+    def __init__(self, dirpath: Path, mode: str = "read-through") -> None:
+        """Instantiate class.
+
+        :param dirpath:  path to cache directory (created if necessary)
+        :param mode:  one of HTTP_CACHE_MODES
+        """
+        if mode not in HTTP_CACHE_MODES:
+            msg = f"Unknown HTTP cache mode {mode}"
+            raise NCFPException(msg)
+        self.dirpath = Path(dirpath)
+        self.mode = mode
+        self.hits = 0
+        self.requests = 0
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+
+    def key(self, service: str, params: dict[str, Any]) -> str:
+        """Return the cache key for a request.
+
+        :param service:  name of the requested service (e.g. entrez.efetch)
+        :param params:  request parameters
+        """
+        request = json.dumps([service, normalise_params(params)], sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        """Return the path to the blob for a cache key."""
+        return self.dirpath / key[:2] / f"{key}.gz"
+
+    def get(self, key: str) -> bytes | None:
+        """Return the cached response for a key, or None if not cached."""
+        try:
+            with gzip.open(self.path(key), "rb") as ifh:
+                return ifh.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        """Store the response for a key.
+
+        The blob is written to a temporary file and renamed, so that an
+        interrupted write never leaves a truncated response in the cache.
+        """
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmppath = path.with_suffix(f".{os.getpid()}.partial")
+        with gzip.open(tmppath, "wb") as ofh:
+            ofh.write(data)
+        tmppath.replace(path)
+
+    def discard(self, key: str) -> None:
+        """Remove the stored response for a key, if there is one."""
+        self.path(key).unlink(missing_ok=True)
+
+    def fetch(
+        self,
+        service: str,
+        params: dict[str, Any],
+        request: Callable[[], Any],
+        *,
+        parse: None | Callable[[bytes], Any] = None,
+        volatile: bool = False,
+    ) -> Any:  # noqa: ANN401 - as returned by request or parse
+        """Return the response to a request, from the cache if the mode allows.
+
+        :param service:  name of the requested service (e.g. entrez.efetch)
+        :param params:  request parameters
+        :param request:  callable that makes the request, returning str or bytes
+        :param parse:  callable returning the parsed response bytes, raising an
+            exception if they are not a valid response
+        :param volatile:  if True, the response refers to NCBI History server
+            state, and is not cached in read-through mode
+
+        Returns parse(response), or the response as bytes if parse is None.
+        A response is only stored once it has been parsed; if parsing raises,
+        the exception is passed to the caller, so that it can retry. Responses
+        that are neither str nor bytes (e.g. an HTTP status code reporting an
+        error) are returned without being parsed or cached.
+        """
+        if parse is None:
+            parse = bytes
+        key = self.key(service, params)
+        if volatile and self.mode == "read-through":
+            self.requests += 1
+            data = request()
+            return parse(data.encode() if isinstance(data, str) else data)
+        if self.mode != "record":
+            hit, result = self._parse_cached(service, key, parse)
+            if hit:
+                return result
+            if self.mode == "replay":
+                msg = f"No cached response for {service} {normalise_params(params)}"
+                raise NCFPCacheMissException(msg)
+        self.requests += 1
+        data = request()
+        if isinstance(data, str):
+            data = data.encode()
+        if not isinstance(data, bytes):
+            return data
+        result = parse(data)
+        self.put(key, data)
+        return result
+
+    def _parse_cached(
+        self, service: str, key: str, parse: Callable[[bytes], Any]
+    ) -> tuple[bool, Any]:
+        """Return (True, parsed response) for a stored response, or (False, None).
+
+        :param service:  name of the requested service, for logging
+        :param key:  cache key of the request
+        :param parse:  callable returning the parsed response bytes
+
+        A stored response that does not parse is discarded, except in replay
+        mode, where the exception is raised.
+        """
+        logger = logging.getLogger(__name__)
+        data = self.get(key)
+        if data is None:
+            return False, None
+        try:
+            result = parse(data)
+        except Exception:
+            if self.mode == "replay":
+                raise
+            logger.warning(
+                "Discarding invalid cached response: %s %s",
+                service,
+                key,
+                exc_info=True,
+            )
+            self.discard(key)
+            return False, None
+        logger.debug("HTTP cache hit: %s %s", service, key)
+        self.hits += 1
+        return True, result
+
+
+class CachedUniProt:
+    """UniProt service whose search() responses are held in a ResponseCache.
+
+    The underlying bioservices UniProt object is only created when a
+    response has to be requested.
+    """
+
+    def __init__(
+        self, http_cache: ResponseCache, factory: Callable[[], Any] = UniProt
+    ) -> None:
+        """Instantiate class.
+
+        :param http_cache:  ResponseCache holding responses
+        :param factory:  callable returning a UniProt service object
+        """
+        self.http_cache = http_cache
+        self.factory = factory
+        self._service = None
+
+    @property
+    def service(self) -> UniProt:
+        """Return the UniProt service object, creating it if necessary."""
+        if self._service is None:
+            self._service = self.factory()
+        return self._service
+
+    def search(self, query: str, **kwargs: object) -> str:
+        """Run a UniProt search, returning the (cached) TSV response."""
+        return self.http_cache.fetch(
+            "uniprot.search",
+            dict(query=query, **kwargs),
+            lambda: self.service.search(query, **kwargs),
+            parse=bytes.decode,
+        )
@@ -0,0 +1,430 @@
+# (c) The James Hutton Institute 2017-2019
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute for Pharmacy and Biomedical Sciences,
+# Cathedral Street,
+# Glasgow,
+# G1 1XQ
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2017-2019 The James Hutton Institute
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Functions for building and querying offline identifier indexes.
+
+Indexes are SQLite databases with a single WITHOUT ROWID table, so that
+each lookup is a primary key B-tree search on disk. They are built by
+streaming the source file in batches, so memory use does not depend on
+the size of the source.
+"""
+
+from __future__ import annotations
+
+import gzip
+import logging
+import sqlite3
+from pathlib import Path
+from typing import TYPE_CHECKING, TextIO
+
+from Bio import SeqIO
+from tqdm import tqdm
+
+from ncbi_cds_from_protein import NCFPException
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator, Mapping
+
+    from Bio.SeqRecord import SeqRecord
+
+# Columns (0-based) of UniProt's idmapping_selected.tab
+IDMAP_ACCESSION = 0
+IDMAP_GENEID = 2
+IDMAP_REFSEQ = 3
+IDMAP_EMBL = 16
+IDMAP_EMBL_CDS = 17
+
+# Columns (0-based) of protein and nucleotide accessions in link source files
+GENE2ACCESSION_PROTEIN = 5
+GENE2ACCESSION_NUCLEOTIDES = (3, 7)  # RNA, genomic
+IPG_PROTEIN = 6
+IPG_NUCLEOTIDE = 2
+
+# File extensions of GenBank flatfiles in a local mirror, optionally followed
+# by a compression extension (compressed files must be BGZF)
+LOCAL_GENBANK_EXTENSIONS = (".gb", ".gbk", ".gbff", ".seq")
+LOCAL_GENBANK_COMPRESSION = (".gz", ".bgz")
+
+# Size of memory map used for link index lookups
+LINK_INDEX_MMAP_SIZE = 2**30
+
+# Settings for index builds: no rollback journal, and a bounded page cache
+SQL_BUILD_PRAGMAS = """
+    PRAGMA journal_mode = OFF;
+    PRAGMA synchronous = OFF;
+    PRAGMA cache_size = -65536;
+"""
+
+SQL_CREATE_UNIPROT_INDEX = """
+    CREATE TABLE uniprot_idmap (accession TEXT PRIMARY KEY NOT NULL,
+                                embl TEXT NOT NULL,
+                                embl_cds TEXT NOT NULL,
+                                geneid TEXT NOT NULL,
+                                refseq TEXT NOT NULL
+                               ) WITHOUT ROWID;
+"""
+
+SQL_ADD_UNIPROT_INDEX = """
+    INSERT OR REPLACE INTO uniprot_idmap (accession, embl, embl_cds, geneid, refseq)
+           VALUES (?, ?, ?, ?, ?);
+"""
+
+SQL_GET_UNIPROT_INDEX = """
+    SELECT embl, embl_cds, geneid, refseq FROM uniprot_idmap WHERE accession=?;
+"""
+
+SQL_CREATE_LINK_INDEX = """
+    CREATE TABLE protein_nuccore (protein TEXT NOT NULL,
+                                  nt_acc TEXT NOT NULL,
+                                  PRIMARY KEY (protein, nt_acc)
+                                 ) WITHOUT ROWID;
+"""
+
+SQL_ADD_LINK_INDEX = """
+    INSERT OR IGNORE INTO protein_nuccore (protein, nt_acc) VALUES (?, ?);
+"""
+
+SQL_GET_LINK_INDEX = """
+    SELECT nt_acc FROM protein_nuccore WHERE protein=?;
+"""
+
+
+def open_text(path: Path) -> TextIO:
+    """Return a text handle to path, decompressing gzip files.
+
+    :param path:  path to plain text or gzip-compressed file
+    """
+    with Path(path).open("rb") as ifh:
+        magic = ifh.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rt")
+    return Path(path).open()
+
+
+def open_index(indexpath: Path) -> sqlite3.Connection:
+    """Return a read-only connection to the index at indexpath.
+
+    :param indexpath:  path to index
+
+    Opening read-only means that a missing index is an error, rather
+    than being created as a new, empty, database.
+    """
+    return sqlite3.connect(Path(indexpath).resolve().as_uri() + "?mode=ro", uri=True)
+
+
+def build_index(
+    indexpath: Path,
+    sql_create: str,
+    sql_add: str,
+    rows: Iterable[tuple],
+    batchsize: int = 100000,
+) -> int:
+    """Write rows to a new SQLite index at indexpath, in batches.
+
+    :param indexpath:  path to write index
+    :param sql_create:  SQL to create the index table
+    :param sql_add:  SQL to add a row to the index table
+    :param rows:  iterable of rows to add
+    :param batchsize:  number of rows to hold in memory between writes
+
+    The index is built in a temporary file alongside indexpath, which
+    replaces any existing index only when the build is complete.
+
+    Returns the number of rows written.
+    """
+    tmppath = indexpath.with_name(indexpath.name + ".partial")
+    tmppath.unlink(missing_ok=True)
+    count = 0
+    # Path must be string, not PosixPath, in Py3.6
+    conn = sqlite3.connect(str(tmppath))
+    try:
+        conn.executescript(SQL_BUILD_PRAGMAS + sql_create)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batchsize:
+                with conn:
+                    conn.executemany(sql_add, batch)
+                count += len(batch)
+                batch = []
+        with conn:
+            conn.executemany(sql_add, batch)
+        count += len(batch)
+    finally:
+        conn.close()
+    tmppath.replace(indexpath)
+    return count
+
+
+def iter_uniprot_idmapping(handle: Iterable[str]) -> Iterator[tuple]:
+    """Yield UniProt index rows from idmapping_selected.tab lines.
+
+    :param handle:  handle to idmapping_selected.tab
+
+    Multiple values in a column are separated by semicolons, without
+    spaces. Entries with no EMBL, GeneID or RefSeq cross-reference are
+    not indexed.
+    """
+    for line in handle:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) <= IDMAP_EMBL_CDS:
+            continue
+        embl, geneid, refseq = (
+            fields[IDMAP_EMBL].replace(" ", ""),
+            fields[IDMAP_GENEID].replace(" ", ""),
+            fields[IDMAP_REFSEQ].replace(" ", ""),
+        )
+        if embl or geneid or refseq:
+            yield (
+                fields[IDMAP_ACCESSION],
+                embl,
+                fields[IDMAP_EMBL_CDS].replace(" ", ""),
+                geneid,
+                refseq,
+            )
+
+
+def build_uniprot_index(
+    srcpath: Path,
+    indexpath: Path,
+    batchsize: int = 100000,
+    *,
+    disabletqdm: bool = True,
+) -> int:
+    """Build UniProt accession index from idmapping_selected.tab(.gz).
+
+    :param srcpath:  path to UniProt idmapping_selected.tab, optionally gzipped
+    :param indexpath:  path to write index
+    :param batchsize:  number of rows to hold in memory between writes
+    :param disabletqdm:  turn off tqdm progress bar
+
+    Returns the number of accessions indexed.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("Building UniProt index %s from %s", indexpath, srcpath)
+
+    with open_text(srcpath) as ifh:
+        lines = tqdm(ifh, desc="Indexing UniProt", unit=" lines", disable=disabletqdm)
+        return build_index(
+            indexpath,
+            SQL_CREATE_UNIPROT_INDEX,
+            SQL_ADD_UNIPROT_INDEX,
+            iter_uniprot_idmapping(lines),
+            batchsize,
+        )
+
+
+def iter_gene2accession_links(handle: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """Yield (protein, nucleotide) accessions from NCBI gene2accession lines.
+
+    :param handle:  handle to gene2accession or gene2refseq
+
+    Each protein is linked to its RNA and genomic nucleotide accessions,
+    where these are given ("-" marks a missing accession).
+    """
+    for line in handle:
+        if line.startswith("#"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) <= max(GENE2ACCESSION_NUCLEOTIDES):
+            continue
+        protein = fields[GENE2ACCESSION_PROTEIN]
+        if protein == "-":
+            continue
+        for column in GENE2ACCESSION_NUCLEOTIDES:
+            if fields[column] != "-":
+                yield protein, fields[column]
+
+
+def iter_ipg_links(handle: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """Yield (protein, nucleotide) accessions from IPG report lines.
+
+    :param handle:  handle to Identical Protein Group report(s)
+    """
+    for line in handle:
+        fields = line.rstrip("\n").split("\t")
+        if fields[0] == "Id" or len(fields) <= IPG_PROTEIN:  # header
+            continue
+        if fields[IPG_PROTEIN] and fields[IPG_NUCLEOTIDE]:
+            yield fields[IPG_PROTEIN], fields[IPG_NUCLEOTIDE]
+
+
+# Parsers for each link index source format
+LINK_FORMATS = {
+    "gene2accession": iter_gene2accession_links,
+    "ipg": iter_ipg_links,
+}
+
+
+def build_link_index(
+    srcpaths: list[Path],
+    indexpath: Path,
+    fmt: str = "gene2accession",
+    batchsize: int = 100000,
+    *,
+    disabletqdm: bool = True,
+) -> int:
+    """Build protein to nucleotide accession index from NCBI mapping files.
+
+    :param srcpaths:  paths to mapping files, optionally gzipped
+    :param indexpath:  path to write index
+    :param fmt:  format of the mapping files (a key of LINK_FORMATS)
+    :param batchsize:  number of rows to hold in memory between writes
+    :param disabletqdm:  turn off tqdm progress bar
+
+    Returns the number of links read from the mapping files.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("Building %s link index %s", fmt, indexpath)
+
+    def iter_links() -> Iterator[tuple[str, str]]:
+        """Yield links from each mapping file in turn."""
+        for srcpath in srcpaths:
+            logger.info("Indexing links in %s", srcpath)
+            with open_text(srcpath) as ifh:
+                lines = tqdm(
+                    ifh,
+                    desc=f"Indexing {srcpath.name}",
+                    unit=" lines",
+                    disable=disabletqdm,
+                )
+                yield from LINK_FORMATS[fmt](lines)
+
+    return build_index(
+        indexpath, SQL_CREATE_LINK_INDEX, SQL_ADD_LINK_INDEX, iter_links(), batchsize
+    )
+
+
+def get_link_index_accessions(
+    indexpath: Path, proteins: Iterable[str]
+) -> dict[str, list[str]]:
+    """Return indexed nucleotide accessions for the passed protein accessions.
+
+    :param indexpath:  path to link index
+    :param proteins:  protein accessions to look up
+
+    The index is read through a memory map. Returns a dictionary of lists
+    of nucleotide accessions, keyed by protein accession, for proteins in
+    the index.
+    """
+    results = {}
+    conn = open_index(indexpath)
+    conn.execute(f"PRAGMA mmap_size = {LINK_INDEX_MMAP_SIZE};")
+    with conn:
+        cur = conn.cursor()
+        for protein in proteins:
+            cur.execute(SQL_GET_LINK_INDEX, (protein,))
+            accessions = [row[0] for row in cur.fetchall()]
+            if accessions:
+                results[protein] = accessions
+    conn.close()
+    return results
+
+
+def get_uniprot_index_xrefs(
+    indexpath: Path, accessions: Iterable[str]
+) -> dict[str, tuple]:
+    """Return indexed cross-references for the passed UniProt accessions.
+
+    :param indexpath:  path to UniProt index
+    :param accessions:  UniProt accessions to look up
+
+    Returns a dictionary of (embl, embl_cds, geneid, refseq) tuples, keyed
+    by accession, for accessions in the index.
+    """
+    results = {}
+    conn = open_index(indexpath)
+    with conn:
+        cur = conn.cursor()
+        for accession in accessions:
+            cur.execute(SQL_GET_UNIPROT_INDEX, (accession,))
+            row = cur.fetchone()
+            if row is not None:
+                results[accession] = row
+    conn.close()
+    return results
+
+
+def find_local_genbank_files(dirpath: Path) -> list[Path]:
+    """Return sorted paths to GenBank flatfiles under dirpath.
+
+    :param dirpath:  path to local GenBank mirror
+    """
+    paths = []
+    for path in Path(dirpath).rglob("*"):
+        suffixes = path.suffixes[-2:]
+        if suffixes and suffixes[-1] in LOCAL_GENBANK_COMPRESSION:
+            suffixes = suffixes[:-1]
+        if path.is_file() and suffixes and suffixes[-1] in LOCAL_GENBANK_EXTENSIONS:
+            paths.append(path)
+    return sorted(paths)
+
+
+def open_local_genbank(dirpath: Path, indexpath: Path) -> Mapping[str, SeqRecord]:
+    """Return accession-keyed random access to GenBank flatfiles under dirpath.
+
+    :param dirpath:  path to local GenBank mirror
+    :param indexpath:  path to SQLite index of the mirror's records
+
+    The index is built with Bio.SeqIO.index_db() the first time it is
+    needed, and reused afterwards. If the files in the mirror have changed
+    since the index was built, it is rebuilt. Compressed files must be
+    BGZF (e.g. compressed with bgzip), so that records can be read by
+    random access.
+
+    Returns a read-only dictionary of SeqRecords, keyed by accession.version,
+    which also provides the unparsed text of each record with get_raw().
+    """
+    logger = logging.getLogger(__name__)
+
+    filenames = [str(path) for path in find_local_genbank_files(dirpath)]
+    if not filenames:
+        msg = f"No GenBank files found in {dirpath}"
+        raise NCFPException(msg)
+    if Path(indexpath).is_file():
+        try:
+            return SeqIO.index_db(str(indexpath), filenames, "gb")
+        except ValueError:
+            logger.warning("Local GenBank files have changed, rebuilding index")
+            Path(indexpath).unlink()
+    logger.info("Indexing %d local GenBank files in %s", len(filenames), indexpath)
+    try:
+        return SeqIO.index_db(str(indexpath), filenames, "gb")
+    except ValueError as exc:  # e.g. gzip files that are not BGZF
+        Path(indexpath).unlink(missing_ok=True)
+        msg = f"Could not index local GenBank files: {exc}"
+        raise NCFPException(msg) from exc
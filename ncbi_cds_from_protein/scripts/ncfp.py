@@ -39,14 +39,23 @@
 
 from __future__ import annotations
 
+import hashlib
+import json
 import logging
 import os
 import re
+import shutil
+import socket
 import sys
 import time
+from argparse import Namespace
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import StringIO
+from itertools import chain, islice, zip_longest
 from pathlib import Path
-from typing import TYPE_CHECKING, Iterable
+from typing import TYPE_CHECKING, NamedTuple, TypeVar
 
 from Bio import SeqIO
 
@@ -54,44 +63,127 @@ from ncbi_cds_from_protein import NCFPException, __version__
 from ncbi_cds_from_protein.caches import (
     find_record_cds,
     get_aa_query,
+    get_completed_stages,
+    get_query_accessions,
+    get_seq_alias,
     initialise_dbcache,
+    initialise_xrefcache,
+    set_stage_completed,
+    update_dbcache,
+)
+from ncbi_cds_from_protein.compression import (
+    BgzfFastaWriter,
+    fasta_positions,
+    open_binary_stream,
+    open_text_file,
+    open_text_stream,
 )
 from ncbi_cds_from_protein.entrez import (
+    fetch_coded_by_regions,
     fetch_gb_headers,
+    fetch_ipg_regions,
     fetch_shortest_genbank,
+    fetch_shortest_genbank_regions,
     search_nt_ids,
+    search_nt_ids_history,
+    search_nt_ids_index,
     set_entrez_email,
     update_gb_accessions,
 )
+from ncbi_cds_from_protein.fetchers import SingleFlightFetcher, get_fetcher
+from ncbi_cds_from_protein.httpcache import ResponseCache
+from ncbi_cds_from_protein.indexes import open_local_genbank
 from ncbi_cds_from_protein.logger import config_logger
 from ncbi_cds_from_protein.scripts.parsers import parse_cmdline
 from ncbi_cds_from_protein.sequences import (
+    InputRecord,
+    QueryRecord,
+    as_seqrecord,
     extract_feature_by_gene_id,
     extract_feature_by_locus_tag,
     extract_feature_by_protein_id,
     extract_feature_cds,
+    parse_input_fasta,
     process_sequences,
     re_uniprot_gn,
+    select_shard,
     strip_stockholm_from_seqid,
 )
+from ncbi_cds_from_protein.workqueue import (
+    Batch,
+    Lease,
+    claim_batch,
+    complete_batch,
+    count_batches,
+    get_extract_batches,
+    initialise_queue,
+    release_batch,
+)
 
 if TYPE_CHECKING:
-    from argparse import Namespace
+    from collections.abc import Callable, Iterable, Iterator, Mapping
+    from concurrent.futures import Future
+    from typing import Self
 
     from Bio.SeqRecord import SeqRecord
 
+    from ncbi_cds_from_protein.fetchers import Fetcher
+
+# Return type of a pipeline stage
+T = TypeVar("T")
+
+
+# Number of input sequences triaged at a time with --stream
+STREAM_CHUNKSIZE = 10000
+
+# Number of input sequences whose CDS are extracted together, grouped by
+# GenBank record, with --cpus
+EXTRACT_CHUNKSIZE = 1000
+
+# Number of matched sequence pairs written between flushes of the output files
+WRITE_FLUSH_INTERVAL = 100
+
+# Number of input sequences in each batch passed through the stages, and
+# maximum number of batches in flight at once, with --pipeline
+PIPELINE_BATCHSIZE = 100
+PIPELINE_QUEUE_SIZE = 8
+
+# Seconds between checks of the work queue by a worker waiting for batches
+# claimed by other workers, with --worker
+QUEUE_POLL_INTERVAL = 10
+
+# Arguments that change the results of the triage, search and download
+# stages. Stages completed by an earlier run are only skipped if these match
+RUN_STATE_ARGS = (
+    "coded_by",
+    "ipg",
+    "ipg_policy",
+    "link_index",
+    "link_history",
+    "max_links",
+    "region_fetch",
+    "region_padding",
+    "local_genbank",
+    "uniprot_index",
+    "fetcher",
+    "eutils_url",
+)
+
 
 # Process input sequences
-def load_input_sequences(args: Namespace) -> list:
+def load_input_sequences(args: Namespace) -> list[InputRecord]:
     """Load input FASTA sequences.
 
     :param args:  CLI arguments
+
+    Sequences are parsed into compact InputRecords, rather than SeqRecords.
+    Input compressed with gzip, bgzip or xz is decompressed.
     """
     logger = logging.getLogger(__name__)
     logger.info("Parsing sequence input...")
 
     if args.infname is None or args.infname == "-":
-        instream = sys.stdin
+        instream = open_text_stream(sys.stdin.buffer)
         logger.info("Reading sequences from stdin")
     else:
         if not args.infname.is_file():
@@ -99,13 +191,16 @@ def load_input_sequences(args: Namespace) -> list:
             logger.error(msg)
             raise NCFPException(msg)
         try:
-            instream = args.infname.open("r")
+            instream = open_text_file(args.infname)
         except OSError:
             logger.error("Could not open input file %s", args.infname, exc_info=True)
             raise SystemExit(1)
         logger.info("Reading sequences from %s", args.infname)
+    records = parse_input_fasta(instream)
+    if args.shard is not None:
+        records = select_shard(records, args.shard)
     try:
-        records = list(SeqIO.parse(instream, "fasta"))
+        records = list(records)
     except IOError:
         logger.error("Could not parse sequence file %s", args.infname, exc_info=True)
         raise SystemExit(1)
@@ -114,9 +209,121 @@ def load_input_sequences(args: Namespace) -> list:
         len(records),
         args.infname,
     )
+    if args.shard is not None:
+        logger.info("Processing only shard %d/%d of the input", *args.shard)
     return records
 
 
+# Stream input sequences, rather than load them all at once
+def stream_input_path(args: Namespace) -> Path:
+    """Return path to the input FASTA file, which can be read more than once.
+
+    :param args:  CLI arguments
+
+    With --stream, input sequences are read once to triage them, and again
+    to extract their CDS. Sequences from stdin are first copied to a file
+    in the cache directory.
+    """
+    logger = logging.getLogger(__name__)
+
+    if args.infname is None or args.infname == "-":
+        inpath = args.cachedir / f"stdin_{args.cachestem}.fasta"
+        logger.info("Copying sequences from stdin to %s", inpath)
+        with inpath.open("wb") as ofh:
+            shutil.copyfileobj(sys.stdin.buffer, ofh)
+        return inpath
+    if not args.infname.is_file():
+        msg = f"Input sequence file {args.infname} does not exist"
+        logger.error(msg)
+        raise NCFPException(msg)
+    return args.infname
+
+
+def iter_input_sequences(
+    inpath: Path, shard: None | tuple[int, int] = None
+) -> Iterable[InputRecord]:
+    """Generate input FASTA sequences, one at a time.
+
+    :param inpath:  path to input FASTA file, which may be compressed
+    :param shard:  (i, N) to generate only the ith of N shards, or None
+    """
+    with open_text_file(inpath) as instream:
+        if shard is None:
+            yield from parse_input_fasta(instream)
+        else:
+            yield from select_shard(parse_input_fasta(instream), shard)
+
+
+def shard_suffix(shard: None | tuple[int, int]) -> str:
+    """Return suffix for the cache and output filenames of a shard.
+
+    :param shard:  (i, N) for the ith of N shards, or None
+    """
+    if shard is None:
+        return ""
+    return "_shard_{}_of_{}".format(*shard)
+
+
+def iter_paired_records(
+    aaseqs: Iterable[SeqRecord], ntseqs: Iterable[SeqRecord]
+) -> Iterator[tuple[SeqRecord, SeqRecord]]:
+    """Generate (aa, nt) pairs from the records of matched output files.
+
+    :param aaseqs:  records of an '_aa.fasta' output file
+    :param ntseqs:  records of the matching '_nt.fasta' output file
+
+    An NCFPException is raised if either file has more records than the
+    other, as the files were not written together.
+    """
+    for aaseq, ntseq in zip_longest(aaseqs, ntseqs):
+        if aaseq is None or ntseq is None:
+            msg = "Matched aa and nt output files have different numbers of records"
+            raise NCFPException(msg)
+        yield aaseq, ntseq
+
+
+def stream_process_sequences(
+    inpath: Path, cachepath: Path, args: Namespace, **kwargs: object
+) -> tuple[list[QueryRecord], int, int]:
+    """Triage streamed input sequences into the cache, in chunks.
+
+    :param inpath:  path to input FASTA file
+    :param cachepath:  path to local cache
+    :param args:  CLI arguments
+    :param kwargs:  passed to process_sequences()
+
+    Input sequences are triaged with process_sequences() STREAM_CHUNKSIZE
+    at a time. Skipped sequences are written to the skipped sequences file
+    as each chunk is processed, and only the IDs of kept sequences are
+    returned, with the counts of skipped and of all input sequences.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("Streaming sequence input from %s...", inpath)
+
+    kept, nread, nskipped = [], 0, 0
+    skippedpath = args.outdirname / args.skippedfname
+    skippedfh = None
+    records = iter_input_sequences(inpath, args.shard)
+    while True:
+        chunk = list(islice(records, STREAM_CHUNKSIZE))
+        if not chunk:
+            break
+        nread += len(chunk)
+        chunk_kept, chunk_skipped = process_sequences(
+            chunk, cachepath, args.disabletqdm, **kwargs
+        )
+        kept.extend(QueryRecord(record.id) for record in chunk_kept)
+        if chunk_skipped:
+            if skippedfh is None:
+                skippedfh = skippedpath.open("w")
+            SeqIO.write(map(as_seqrecord, chunk_skipped), skippedfh, "fasta")
+            nskipped += len(chunk_skipped)
+    if skippedfh is not None:
+        skippedfh.close()
+    logger.info("%d sequence records read successfully from %s", nread, inpath)
+    return kept, nskipped, nread
+
+
 # Extract CDS sequences from cached GenBank records
 def extract_cds_features(
     seqrecords: Iterable[SeqRecord],
@@ -129,15 +336,122 @@ def extract_cds_features(
     :param cachepath:  path to local cache
     :param args:  CLI script arguments
     """
+    return list(iter_cds_features(seqrecords, cachepath, args))
+
+
+def iter_cds_features(
+    seqrecords: Iterable[SeqRecord],
+    cachepath: Path,
+    args: Namespace,
+    executor: None | Executor = None,
+) -> Iterator[tuple[SeqRecord | InputRecord, SeqRecord]]:
+    """Generate corresponding aa and nt sequences from cached records.
+
+    :param seqrecords:  collection of input sequence records
+    :param cachepath:  path to local cache
+    :param args:  CLI script arguments
+    :param executor:  process pool for CDS extraction, or None
+
+    Pairs of (input record, CDS record) are generated in input order.
+
+    Input sequences that duplicate another input protein are matched to the
+    CDS of their representative, which is looked up with the representative's
+    ID and description. Stockholm domain locations are taken from each input
+    sequence's own ID, so each domain is trimmed from the shared CDS.
+
+    With --cpus greater than one, or an executor, input sequences are taken
+    EXTRACT_CHUNKSIZE at a time, and those matching the same GenBank record
+    are passed together to a worker process, so that each record is parsed
+    once per chunk. If the process pool cannot be used, CDS are extracted in
+    this process.
+    """
     logger = logging.getLogger(__name__)
     logger.info("Extracting CDS features...")
 
-    nt_sequences = []  # Holds extracted nucleotide sequences
+    options = extract_options(args)
+    queries = iter_cds_queries(seqrecords, cachepath)
+    # Arguments from callers other than run_main() may not set --cpus
+    cpus = getattr(args, "cpus", 1)
+    if executor is None and cpus > 1:
+        executor = start_extractor(cpus)
+        if executor is not None:
+            with executor:
+                yield from iter_pooled_cds(queries, options, executor)
+            return
+    if executor is None:
+        yield from iter_serial_cds(queries, options)
+    else:
+        yield from iter_pooled_cds(queries, options, executor)
+
+
+def start_extractor(cpus: int) -> None | ProcessPoolExecutor:
+    """Return a process pool for CDS extraction, or None if it cannot start.
+
+    :param cpus:  number of worker processes
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        return ProcessPoolExecutor(cpus)
+    except (ImportError, NotImplementedError, OSError):
+        logger.warning(
+            "Could not start %d processes (extracting CDS serially)",
+            cpus,
+            exc_info=True,
+        )
+    return None
+
+
+def extract_options(args: Namespace) -> Namespace:
+    """Return the CLI arguments used for CDS extraction.
+
+    :param args:  CLI script arguments
+
+    Only these arguments are passed to worker processes.
+    """
+    return Namespace(
+        stockholm=args.stockholm,
+        unify_seqid=args.unify_seqid,
+        use_protein_ids=args.use_protein_ids,
+        alternative_start_codon=args.alternative_start_codon,
+    )
+
+
+class CDSQuery(NamedTuple):
+    """Cached data needed to extract the CDS for an input sequence."""
+
+    record: InputRecord | SeqRecord
+    queryid: str
+    querydesc: str
+    aaqueryid: None | tuple
+    gbtext: None | str
+
+
+def iter_cds_queries(
+    seqrecords: Iterable[SeqRecord], cachepath: Path
+) -> Iterator[CDSQuery]:
+    """Generate a CDSQuery for each input sequence, from the cache.
+
+    :param seqrecords:  collection of input sequence records
+    :param cachepath:  path to local cache
+
+    The GenBank record text is None if there is not exactly one GenBank
+    record for the input sequence.
+    """
+    logger = logging.getLogger(__name__)
+
     for record in seqrecords:
         logger.debug("Processing sequence %s", record.id)
-        result = find_record_cds(cachepath, record.id)
-        aaqueryid = get_aa_query(cachepath, record.id)
+        alias = get_seq_alias(cachepath, record.id)
+        if alias is None:
+            queryid, querydesc = record.id, record.description
+        else:
+            queryid, querydesc = alias
+            logger.debug("Using CDS of %s for duplicate %s", queryid, record.id)
+        result = find_record_cds(cachepath, queryid)
+        aaqueryid = get_aa_query(cachepath, queryid)
         logger.debug("Found AA query ID %s for this sequence in cache", aaqueryid)
+        gbtext = None
         if not result:
             logger.warning(
                 "No record found for sequence input %s - please check this sequence manually",
@@ -153,136 +467,251 @@ def extract_cds_features(
             )
             if record.id.startswith("WP_"):
                 logger.warning(
-                    "\tThis record looks like it may be an Identical Protein Group (IPG)",
+                    "\tThis record looks like it may be an Identical Protein Group (IPG): try --ipg",
                 )
         else:
-            gbrecord = SeqIO.read(StringIO(result[0][-1]), "gb")
-            logger.info("Sequence %s matches GenBank entry %s", record.id, gbrecord.id)
-            match = re.search(re_uniprot_gn, record.description)
-            # If we have a match, we can use the UniProt gene name (GN=) to extract the
-            # CDS. In some cases (e.g. A0A127QBK9) the UniProt gene name is
-            # ambiguous, and the CDS will not be extracted correctly. If we have one,
-            # we prefer to use the AA query ID to extract the CDS.
-            feature = None
-            logger.debug("AA query ID: %s", aaqueryid)
-            if aaqueryid is not None:
-                logger.info(
-                    "Extracting CDS by locus tag with AA query ID: %s",
-                    aaqueryid,
-                )
-                feature = extract_feature_by_locus_tag(gbrecord, aaqueryid[0])
-                if feature is None:
-                    logger.info(
-                        "Did not find feature with locus tag %s, trying GN field",
-                        aaqueryid,
-                    )
-            # For Uniprot sequences, we extract the gene name
-            if (match is not None) and (feature is None):
-                logger.debug("Matched %s to %s", record.id, match.group())
-                # Get the matching CDS
-                gene_name = match.group(0)
-                logger.info("Searching for CDS: %s", gene_name)
-                feature = extract_feature_by_locus_tag(gbrecord, gene_name)
-                if feature is None:
-                    logger.debug(
-                        "Could not find feature with locus tag, trying protein ID",
-                    )
-                    feature = extract_feature_by_protein_id(gbrecord, gene_name)
-            elif feature is None:  # NCBI sequences
-                # Get the matching CDS - note we have to remove the Stockholm
-                # domain info, if that is present
-                logger.debug(
-                    "Extracting NCBI sequence by protein id: %s",
-                    strip_stockholm_from_seqid(record.id),
-                )
-                feature = extract_feature_by_protein_id(
-                    gbrecord,
-                    strip_stockholm_from_seqid(record.id),
-                )
-                gene_name = None  # explicitly note that there is no gene_name
-            # Nearly a last-ditch effort - try gene ID
-            if (feature is None) and (gene_name is not None):
-                logger.debug(
-                    "Could not find feature by locus tag or protein ID, trying gene ID (%s)",
-                    gene_name,
+            gbtext = result[0][-1]
+        yield CDSQuery(record, queryid, querydesc, aaqueryid, gbtext)
+
+
+def iter_pooled_cds(
+    queries: Iterable[CDSQuery], options: Namespace, executor: Executor
+) -> Iterator[tuple[SeqRecord | InputRecord, SeqRecord]]:
+    """Generate (input record, CDS record) pairs, extracted in worker processes.
+
+    :param queries:  iterable of CDSQuery for the input sequences
+    :param options:  CLI arguments used for CDS extraction
+    :param executor:  process pool for CDS extraction
+
+    Each chunk of EXTRACT_CHUNKSIZE queries is grouped by GenBank record, and
+    the pairs for the chunk are generated in input order once all its groups
+    are extracted. If the pool breaks, the chunk and all later chunks are
+    extracted in this process.
+    """
+    logger = logging.getLogger(__name__)
+
+    queries = iter(queries)
+    while True:
+        chunk = list(islice(queries, EXTRACT_CHUNKSIZE))
+        if not chunk:
+            break
+        groups = {}
+        for idx, query in enumerate(chunk):
+            if query.gbtext is not None:
+                groups.setdefault(query.gbtext, []).append(idx)
+        matches = {}
+        try:
+            futures = [
+                (
+                    idxs,
+                    executor.submit(
+                        extract_record_group,
+                        gbtext,
+                        [chunk[idx] for idx in idxs],
+                        options,
+                    ),
                 )
-                feature = extract_feature_by_gene_id(gbrecord, gene_name)
-            # A very, very final attempt - if there is a single CDS feature,
-            # we'll try to use that. We might want to allow looping over all
-            # CDS features of a small GenBank file in a future version
+                for gbtext, idxs in groups.items()
+            ]
+            for idxs, future in futures:
+                pairs = future.result()
+                # Pairs are returned for the group's queries, in order, with
+                # None where no CDS was matched
+                matches.update(zip(idxs, pairs))
+        except BrokenProcessPool:
+            logger.warning(
+                "CDS extraction worker process failed (extracting CDS serially)",
+                exc_info=True,
+            )
+            yield from iter_serial_cds(chain(chunk, queries), options)
+            return
+        for idx in range(len(chunk)):
+            pair = matches.get(idx)
+            if pair is not None:
+                yield pair
+
+
+def iter_serial_cds(
+    queries: Iterable[CDSQuery], options: Namespace
+) -> Iterator[tuple[SeqRecord | InputRecord, SeqRecord]]:
+    """Generate (input record, CDS record) pairs, extracted in this process.
+
+    :param queries:  iterable of CDSQuery for the input sequences
+    :param options:  CLI arguments used for CDS extraction
+    """
+    for query in queries:
+        if query.gbtext is not None:
+            (pair,) = extract_record_group(query.gbtext, [query], options)
+            if pair is not None:
+                yield pair
+
+
+def extract_record_group(
+    gbtext: str, queries: list[CDSQuery], options: Namespace
+) -> list[None | tuple[SeqRecord | InputRecord, SeqRecord]]:
+    """Return the (input record, CDS record) pair, or None, for each query.
+
+    :param gbtext:  GenBank record text shared by the queries
+    :param queries:  list of CDSQuery matching the GenBank record
+    :param options:  CLI arguments used for CDS extraction
+
+    The GenBank record is parsed once for all queries. This function is run
+    in worker processes with --cpus; the pairs are in the order of queries.
+    """
+    logger = logging.getLogger(__name__)
+
+    gbrecord = SeqIO.read(StringIO(gbtext), "gb")
+    pairs = []
+    for query in queries:
+        ntseq = match_record_cds(query, gbrecord, options)
+        if ntseq is None:
+            logger.debug("No CDS matched for %s", query.record.id)
+            pairs.append(None)
+        else:
+            pairs.append((query.record, ntseq))
+    return pairs
+
+
+def match_record_cds(  # noqa: C901, PLR0912, PLR0915
+    query: CDSQuery, gbrecord: SeqRecord, options: Namespace
+) -> None | SeqRecord:
+    """Return the CDS in a GenBank record for a query, if its translation matches.
+
+    :param query:  CDSQuery for the input sequence
+    :param gbrecord:  parsed GenBank record for the input sequence
+    :param options:  CLI arguments used for CDS extraction
+
+    Returns None if no CDS feature is found for the input sequence, or the
+    conceptual translation of the CDS does not match the input sequence.
+    """
+    logger = logging.getLogger(__name__)
+
+    record, queryid, querydesc, aaqueryid, _ = query
+    logger.info("Sequence %s matches GenBank entry %s", record.id, gbrecord.id)
+    match = re.search(re_uniprot_gn, querydesc)
+    # If we have a match, we can use the UniProt gene name (GN=) to extract the
+    # CDS. In some cases (e.g. A0A127QBK9) the UniProt gene name is
+    # ambiguous, and the CDS will not be extracted correctly. If we have one,
+    # we prefer to use the AA query ID to extract the CDS.
+    feature = None
+    logger.debug("AA query ID: %s", aaqueryid)
+    if aaqueryid is not None:
+        logger.info(
+            "Extracting CDS by locus tag with AA query ID: %s",
+            aaqueryid,
+        )
+        feature = extract_feature_by_locus_tag(gbrecord, aaqueryid[0])
+        # AA queries from the UniProt index, or from RefSeq, are protein IDs
+        for protein_id in (aaqueryid[0] or "").split(";"):
             if feature is None:
-                logger.debug(
-                    "Could not find feature by gene ID, checking if there is a single CDS feature as last resort",
-                )
-                cds_features = [_ for _ in gbrecord.features if _.type == "CDS"]
-                if len(cds_features) == 1:
-                    protein_id = cds_features[0].qualifiers["protein_id"][0]
-                    logger.debug(
-                        "Found a single CDS feature, trying that: %s",
-                        protein_id,
-                    )
-                    feature = extract_feature_by_protein_id(gbrecord, protein_id)
-            if feature is None:  # If even the last ditch fails, we give up
-                logger.info("Could not identify CDS feature for %s", record.id)
-            else:
-                logger.info(
-                    "\tSequence %s matches CDS feature %s",
-                    record.id,
-                    feature.qualifiers["protein_id"][0],
-                )
-                logger.info("\tExtracting coding sequence...")
-                logger.debug("args.stockholm: %s", args.stockholm)
-                if args.stockholm:
-                    locdata = record.id.split("/")[-1]
-                    logger.debug(
-                        "Adding Stockholm domain info %s to sequence ID",
-                        locdata,
-                    )
-                    stockholm = [int(e) for e in locdata.split("-")]
-                else:
-                    stockholm = []
-                ntseq, aaseq = extract_feature_cds(
-                    feature,
-                    gbrecord,
-                    tuple(stockholm),
-                    args,
-                )
-                # Could not extract feature for some reason, skip
-                if ntseq is None and aaseq is None:
-                    logger.warning("Could not extract CDS for %s (skipping)", record.id)
-                    continue
-
-                if args.unify_seqid:
-                    # Make recovered sequence ID the same as the query sequence ID
-                    # Move the complete recovered sequence description to the new sequence
-                    # description
-                    tmp_description = ntseq.description
-                    ntseq.id = record.id
-                    ntseq.description = tmp_description
-                # Otherwise, if we have stockholm format append locations to the ntseq IDs
-                elif args.stockholm:
-                    ntseq.id = f"{ntseq.id}/{stockholm[0] * 3 - 2}-{stockholm[1] * 3}"
-                if aaseq.seq == record.seq.replace("-", "").upper():
-                    logger.info("\t\tTranslated sequence matches input sequence")
-                    nt_sequences.append((record, ntseq))
-                elif (
-                    args.alternative_start_codon
-                    and aaseq.seq[1:] == record.seq.replace("-", "").upper()[1:]
-                ):
-                    logger.info(
-                        "\t\tTranslated sequence matches input sequence with alternative start codon %s -> %s",
-                        aaseq.seq[0],
-                        record.seq.replace("-", "").upper()[0],
-                    )
-                    nt_sequences.append((record, ntseq))
-                else:
-                    logger.warning(
-                        "\t\tTranslated sequence does not match " + "input sequence!",
-                    )
-                    logger.warning("\t\t%s", aaseq.seq)
-                    logger.warning("\t\t%s", record.seq.replace("-", "").upper())
+                feature = extract_feature_by_protein_id(gbrecord, protein_id)
+        if feature is None:
+            logger.info(
+                "Did not find feature with locus tag or protein ID %s, trying GN field",
+                aaqueryid,
+            )
+    # For Uniprot sequences, we extract the gene name
+    if (match is not None) and (feature is None):
+        logger.debug("Matched %s to %s", record.id, match.group())
+        # Get the matching CDS
+        gene_name = match.group(0)
+        logger.info("Searching for CDS: %s", gene_name)
+        feature = extract_feature_by_locus_tag(gbrecord, gene_name)
+        if feature is None:
+            logger.debug(
+                "Could not find feature with locus tag, trying protein ID",
+            )
+            feature = extract_feature_by_protein_id(gbrecord, gene_name)
+    elif feature is None:  # NCBI sequences
+        # Get the matching CDS - note we have to remove the Stockholm
+        # domain info, if that is present
+        logger.debug(
+            "Extracting NCBI sequence by protein id: %s",
+            strip_stockholm_from_seqid(queryid),
+        )
+        feature = extract_feature_by_protein_id(
+            gbrecord,
+            strip_stockholm_from_seqid(queryid),
+        )
+        gene_name = None  # explicitly note that there is no gene_name
+    # Nearly a last-ditch effort - try gene ID
+    if (feature is None) and (gene_name is not None):
+        logger.debug(
+            "Could not find feature by locus tag or protein ID, trying gene ID (%s)",
+            gene_name,
+        )
+        feature = extract_feature_by_gene_id(gbrecord, gene_name)
+    # A very, very final attempt - if there is a single CDS feature,
+    # we'll try to use that. We might want to allow looping over all
+    # CDS features of a small GenBank file in a future version
+    if feature is None:
+        logger.debug(
+            "Could not find feature by gene ID, checking if there is a single CDS feature as last resort",
+        )
+        cds_features = [_ for _ in gbrecord.features if _.type == "CDS"]
+        if len(cds_features) == 1:
+            protein_id = cds_features[0].qualifiers["protein_id"][0]
+            logger.debug(
+                "Found a single CDS feature, trying that: %s",
+                protein_id,
+            )
+            feature = extract_feature_by_protein_id(gbrecord, protein_id)
+    if feature is None:  # If even the last ditch fails, we give up
+        logger.info("Could not identify CDS feature for %s", record.id)
+    else:
+        logger.info(
+            "\tSequence %s matches CDS feature %s",
+            record.id,
+            feature.qualifiers["protein_id"][0],
+        )
+        logger.info("\tExtracting coding sequence...")
+        logger.debug("args.stockholm: %s", options.stockholm)
+        if options.stockholm:
+            locdata = record.id.split("/")[-1]
+            logger.debug(
+                "Adding Stockholm domain info %s to sequence ID",
+                locdata,
+            )
+            stockholm = [int(e) for e in locdata.split("-")]
+        else:
+            stockholm = []
+        ntseq, aaseq = extract_feature_cds(
+            feature,
+            gbrecord,
+            tuple(stockholm),
+            options,
+        )
+        # Could not extract feature for some reason, skip
+        if ntseq is None and aaseq is None:
+            logger.warning("Could not extract CDS for %s (skipping)", record.id)
+            return None
 
-    return nt_sequences
+        if options.unify_seqid:
+            # Make recovered sequence ID the same as the query sequence ID
+            # Move the complete recovered sequence description to the new sequence
+            # description
+            tmp_description = ntseq.description
+            ntseq.id = record.id
+            ntseq.description = tmp_description
+        # Otherwise, if we have stockholm format append locations to the ntseq IDs
+        elif options.stockholm:
+            ntseq.id = f"{ntseq.id}/{stockholm[0] * 3 - 2}-{stockholm[1] * 3}"
+        # Input sequence, ungapped and uppercase, for comparison
+        queryseq = record.seq.replace("-", "").upper()
+        if aaseq.seq == queryseq:
+            logger.info("\t\tTranslated sequence matches input sequence")
+            return ntseq
+        if options.alternative_start_codon and aaseq.seq[1:] == queryseq[1:]:
+            logger.info(
+                "\t\tTranslated sequence matches input sequence with alternative start codon %s -> %s",
+                aaseq.seq[0],
+                queryseq[0],
+            )
+            return ntseq
+        logger.warning("\t\tTranslated sequence does not match input sequence!")
+        logger.warning("\t\t%s", aaseq.seq)
+        logger.warning("\t\t%s", queryseq)
+    return None
 
 
 def initialise_cache(args: Namespace) -> Path:
@@ -294,19 +723,597 @@ def initialise_cache(args: Namespace) -> Path:
     logger.info("Initialising cache...")
 
     # Get paths in order
-    cachepath = args.cachedir / f"ncfpcache_{args.cachestem}.sqlite3"
+    suffix = shard_suffix(args.shard)
+    # Workers may share a cache directory, and a new cache would drop the
+    # tables of another worker's cache, so each worker has its own file
+    if args.worker:
+        suffix = f"{suffix}_{worker_name()}"
+    cachepath = args.cachedir / f"ncfpcache_{args.cachestem}{suffix}.sqlite3"
     args.cachedir.mkdir(parents=True, exist_ok=True)
 
     # Use the old SQLite3 database if --keepcache set
     if args.keepcache and cachepath.is_file():
         logger.warning("Not overwriting old cache at %s...", cachepath)
+        update_dbcache(cachepath)
     else:
         logger.info("Setting up SQLite3 database cache at %s...", cachepath)
         initialise_dbcache(cachepath)
 
+    # UniProt cross-references are shared between all caches in cachedir
+    initialise_xrefcache(args.cachedir / "uniprot_xref.sqlite3")
+
     return cachepath
 
 
+# Record and resume the stages of a run
+def input_digest(records: Iterable[InputRecord]) -> tuple[str, int]:
+    """Return SHA-256 digest of input sequences, and the number of sequences.
+
+    :param records:  iterable of input sequence records
+
+    The digest covers the header and sequence of each record, so it does
+    not depend on line wrapping or compression of the input file.
+    """
+    digest, count = hashlib.sha256(), 0
+    for record in records:
+        digest.update(f">{record.description}\n{record.seq}\n".encode())
+        count += 1
+    return digest.hexdigest(), count
+
+
+def run_state_key(digest: str, args: Namespace) -> str:
+    """Return key for the recorded state of a run.
+
+    :param digest:  digest of input sequences, from input_digest()
+    :param args:  CLI arguments; those named in RUN_STATE_ARGS are used
+    """
+    stage_args = {name: str(getattr(args, name, None)) for name in RUN_STATE_ARGS}
+    data = json.dumps([digest, stage_args], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class RunState:
+    """Stages of a run completed by earlier runs, recorded in the cache.
+
+    Each stage of a run adds to the cache what it needs to, so a restarted
+    run can skip stages that completed without failures. Once a stage is
+    run, all later stages are run, as they may use its new results. Paged
+    EFetch stages that were interrupted resume from their last committed
+    page (see entrez.efetch_pages_with_retries()).
+    """
+
+    def __init__(self, cachepath: Path, run_key: str) -> None:
+        """Instantiate with the stages completed for run_key.
+
+        :param cachepath:  path to local cache
+        :param run_key:  key for the run, from run_state_key()
+        """
+        self.cachepath = cachepath
+        self.run_key = run_key
+        self.completed = get_completed_stages(cachepath, run_key)
+        self.resuming = True
+
+    def skip(self, stage: str) -> bool:
+        """Return True if a stage can be skipped, as it already completed.
+
+        :param stage:  name of stage
+        """
+        if self.resuming and stage in self.completed:
+            logger = logging.getLogger(__name__)
+            logger.info("Stage %s completed by an earlier run (skipping)", stage)
+            return True
+        self.resuming = False
+        return False
+
+    def complete(self, stage: str, countfail: int = 0) -> None:
+        """Record that a stage completed, if it had no failures.
+
+        :param stage:  name of stage
+        :param countfail:  number of failed queries in the stage
+        """
+        if not countfail:
+            set_stage_completed(self.cachepath, self.run_key, stage)
+            self.completed.add(stage)
+
+
+# Pass batches of input sequences through overlapping stages
+def run_after(
+    future: Future, func: Callable[..., T], *args: object, **kwargs: object
+) -> T:
+    """Call func once future has completed, raising any exception from it.
+
+    :param future:  Future for the previous stage of a batch
+    :param func:  function running the next stage of the batch
+    """
+    future.result()
+    return func(*args, **kwargs)
+
+
+def pipeline_search(
+    qrecords: list[QueryRecord], cachepath: Path, args: Namespace, fetcher: Fetcher
+) -> None:
+    """Find nucleotide records for a batch of input sequences (stage 2).
+
+    :param qrecords:  input sequences taken forward from the batch
+    :param cachepath:  path to local cache
+    :param args:  CLI arguments
+    :param fetcher:  Fetcher backend
+
+    CDS regions are resolved first with --coded_by and --ipg, as in
+    run_main(), and UIDs from --link_index and --link_history.
+    """
+    logger = logging.getLogger(__name__)
+
+    if args.coded_by:
+        fetch_coded_by_regions(
+            qrecords,
+            cachepath,
+            args.retries,
+            args.batchsize,
+            disabletqdm=True,
+            fetcher=fetcher,
+        )
+    if args.ipg:
+        fetch_ipg_regions(
+            qrecords,
+            cachepath,
+            args.retries,
+            args.batchsize,
+            policy=args.ipg_policy,
+            disabletqdm=True,
+            fetcher=fetcher,
+        )
+    if args.link_index is not None:
+        search_nt_ids_index(
+            qrecords,
+            cachepath,
+            args.link_index,
+            args.retries,
+            max_links=args.max_links,
+            fetcher=fetcher,
+        )
+    if args.link_history:
+        search_nt_ids_history(
+            qrecords,
+            cachepath,
+            args.retries,
+            args.batchsize,
+            max_links=args.max_links,
+            disabletqdm=True,
+            fetcher=fetcher,
+        )
+    _, countfail = search_nt_ids(
+        qrecords,
+        cachepath,
+        args.retries,
+        disabletqdm=True,
+        max_links=args.max_links,
+        fetcher=fetcher,
+    )
+    if countfail:
+        logger.warning(
+            "NCBI nucleotide accession search failed for %d records", countfail
+        )
+
+
+def pipeline_download(
+    qrecords: list[QueryRecord],
+    cachepath: Path,
+    args: Namespace,
+    fetcher: Fetcher,
+    local_genbank: None | Mapping[str, SeqRecord] = None,
+) -> None:
+    """Download GenBank data for a batch of input sequences (stages 3 to 5).
+
+    :param qrecords:  input sequences taken forward from the batch
+    :param cachepath:  path to local cache
+    :param args:  CLI arguments
+    :param fetcher:  Fetcher backend
+    :param local_genbank:  index of local GenBank records, or None
+
+    GenBank accessions and headers are fetched for every nucleotide record
+    in the cache that needs them, which may include records found for later
+    batches. The shortest GenBank records (or their CDS regions) are only
+    chosen for this batch, as all of its nucleotide records are known.
+    """
+    logger = logging.getLogger(__name__)
+
+    seqids = {record.id for record in qrecords}
+    _, countfail = update_gb_accessions(
+        cachepath, args.retries, disabletqdm=True, fetcher=fetcher
+    )
+    if countfail:
+        logger.warning("Unable to update GenBank accessions for %d UIDs", countfail)
+    _, countfail = fetch_gb_headers(
+        cachepath,
+        args.retries,
+        args.batchsize,
+        postsize=args.postsize,
+        local_genbank=local_genbank,
+        disabletqdm=True,
+        fetcher=fetcher,
+    )
+    if countfail:
+        logger.warning("Unable to update GenBank headers for %d UIDs", countfail)
+    if args.region_fetch:
+        fetch_shortest_genbank_regions(
+            cachepath,
+            args.retries,
+            args.batchsize,
+            padding=args.region_padding,
+            local_genbank=local_genbank,
+            disabletqdm=True,
+            fetcher=fetcher,
+            seqids=seqids,
+        )
+    _, countfail = fetch_shortest_genbank(
+        cachepath,
+        args.retries,
+        args.batchsize,
+        postsize=args.postsize,
+        local_genbank=local_genbank,
+        disabletqdm=True,
+        fetcher=fetcher,
+        seqids=seqids,
+    )
+    if countfail:
+        logger.warning("Unable to get complete GenBank files for %d UIDs", countfail)
+
+
+def pipeline_extract(
+    seqrecords: Iterable[InputRecord],
+    cachepath: Path,
+    args: Namespace,
+    writer: PairedSequenceWriter,
+    executor: None | Executor = None,
+) -> int:
+    """Extract and write CDS for a batch of input sequences.
+
+    :param seqrecords:  all input sequences in the batch
+    :param cachepath:  path to local cache
+    :param args:  CLI arguments
+    :param writer:  PairedSequenceWriter for matched pairs
+    :param executor:  process pool for CDS extraction, or None
+
+    Returns the number of matched pairs written.
+    """
+    logger = logging.getLogger(__name__)
+
+    count = 0
+    for aaseq, ntseq in iter_cds_features(seqrecords, cachepath, args, executor):
+        logger.info("\t%-40s to CDS: %s", aaseq.id, ntseq.id)
+        writer.write(aaseq, ntseq)
+        count += 1
+    return count
+
+
+def run_pipeline(
+    seqrecords: Iterable[InputRecord],
+    cachepath: Path,
+    args: Namespace,
+    local_genbank: None | Mapping[str, SeqRecord] = None,
+    **kwargs: object,
+) -> tuple[int, int, int]:
+    """Find and write CDS for batches of input sequences, overlapping stages.
+
+    :param seqrecords:  iterable of input sequence records
+    :param cachepath:  path to local cache
+    :param args:  CLI arguments
+    :param local_genbank:  index of local GenBank records, or None
+    :param kwargs:  passed to process_sequences(), including the fetcher
+
+    Input sequences are taken PIPELINE_BATCHSIZE at a time. Each batch is
+    triaged in this thread, and passed to a pool of args.pipeline_workers
+    threads to be searched for, while earlier batches are downloaded and
+    extracted. Downloads for each batch start once its search completes, in
+    a single thread, because each download stage works on every record in
+    the cache that needs it. CDS extraction also runs in a single thread,
+    so that matched pairs are written in input order, and with --cpus it
+    shares one process pool between batches. At most
+    PIPELINE_QUEUE_SIZE batches are in flight: triage waits for the oldest
+    batch to be written before starting another.
+
+    Returns the numbers of input, skipped, and matched sequences.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("Passing input sequences through stages in batches...")
+
+    fetcher = kwargs["fetcher"]
+    ninputs, nskipped, nmatched = 0, 0, 0
+    skippedpath = args.outdirname / args.skippedfname
+    skippedfh = None
+    # The process pool is started before any threads
+    extractor = start_extractor(args.cpus) if args.cpus > 1 else None
+    pools = (
+        ThreadPoolExecutor(args.pipeline_workers, thread_name_prefix="ncfp-search"),
+        ThreadPoolExecutor(1, thread_name_prefix="ncfp-download"),
+        ThreadPoolExecutor(1, thread_name_prefix="ncfp-extract"),
+    )
+    searchpool, downloadpool, extractpool = pools
+    pending = deque()
+    records = iter(seqrecords)
+    with PairedSequenceWriter(
+        args.outdirname, args.filestem, bgzip=args.bgzip
+    ) as writer:
+        logger.info("\tWriting matched input sequences to %s", writer.aafilename)
+        logger.info("\tWriting matched output sequences to %s", writer.ntfilename)
+        try:
+            while True:
+                batch = list(islice(records, PIPELINE_BATCHSIZE))
+                if not batch:
+                    break
+                ninputs += len(batch)
+                kept, skipped = process_sequences(
+                    batch, cachepath, disabletqdm=True, **kwargs
+                )
+                if skipped:
+                    if skippedfh is None:
+                        skippedfh = skippedpath.open("w")
+                    SeqIO.write(map(as_seqrecord, skipped), skippedfh, "fasta")
+                    nskipped += len(skipped)
+                searched = searchpool.submit(
+                    pipeline_search, kept, cachepath, args, fetcher
+                )
+                downloaded = downloadpool.submit(
+                    run_after,
+                    searched,
+                    pipeline_download,
+                    kept,
+                    cachepath,
+                    args,
+                    fetcher,
+                    local_genbank,
+                )
+                extracted = extractpool.submit(
+                    run_after,
+                    downloaded,
+                    pipeline_extract,
+                    batch,
+                    cachepath,
+                    args,
+                    writer,
+                    extractor,
+                )
+                pending.append((searched, downloaded, extracted))
+                while len(pending) >= PIPELINE_QUEUE_SIZE:
+                    nmatched += pending.popleft()[-1].result()
+                logger.info("%d sequences passed to pipeline", ninputs)
+            while pending:
+                nmatched += pending.popleft()[-1].result()
+        finally:
+            shutdown_pipeline(pending, (*pools, extractor))
+            if skippedfh is not None:
+                skippedfh.close()
+    return ninputs, nskipped, nmatched
+
+
+def shutdown_pipeline(
+    pending: Iterable[tuple[Future, ...]], pools: Iterable[None | Executor]
+) -> None:
+    """Cancel pipeline batches that have not started, and shut down the pools.
+
+    :param pending:  futures for the stages of each batch in flight
+    :param pools:  executors running the stages, or None where not started
+
+    If any stage failed, batches that have not started are dropped.
+    """
+    for futures in pending:
+        for future in futures:
+            future.cancel()
+    for pool in pools:
+        if pool is not None:
+            pool.shutdown()
+
+
+# Claim batches of input sequences from a work queue shared between workers
+def worker_name() -> str:
+    """Return a name for this worker that is unique between hosts."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def run_worker_batch(  # noqa: PLR0913
+    batch: Batch,
+    inpath: Path,
+    cachepath: Path,
+    args: Namespace,
+    worker: str,
+    *,
+    local_genbank: None | Mapping[str, SeqRecord] = None,
+    **kwargs: object,
+) -> tuple[int, int, int]:
+    """Run the pipeline on a batch from the work queue, committing its output.
+
+    :param batch:  Batch claimed from the work queue
+    :param inpath:  path to input FASTA file
+    :param cachepath:  path to local cache
+    :param args:  CLI arguments
+    :param worker:  name of this worker
+    :param local_genbank:  index of local GenBank records, or None
+    :param kwargs:  passed to process_sequences()
+
+    Output files are written to the 'batches' subdirectory of the output
+    directory under temporary names, and renamed once complete, so that the
+    output of a batch reclaimed from a worker that died is never half-written.
+    Returns the numbers of input, skipped, and matched sequences.
+    """
+    batchdir = args.outdirname / "batches"
+    batchdir.mkdir(parents=True, exist_ok=True)
+    stem = f"{args.filestem}_batch_{batch.batch:06d}"
+    tmpstem = f"{stem}.{worker}"
+    batchargs = Namespace(**vars(args))
+    batchargs.outdirname = batchdir
+    batchargs.filestem = tmpstem
+    batchargs.skippedfname = f"{tmpstem}_skipped.fasta"
+    batchargs.bgzip = False
+
+    # Read from the batch's first sequence, rather than parsing the input
+    # from the start
+    with open_text_file(inpath, batch.position) as instream:
+        records = islice(parse_input_fasta(instream), batch.size)
+        counts = run_pipeline(
+            records, cachepath, batchargs, local_genbank=local_genbank, **kwargs
+        )
+    for suffix in ("_aa.fasta", "_nt.fasta", "_skipped.fasta"):
+        tmppath = batchdir / f"{tmpstem}{suffix}"
+        if tmppath.is_file():
+            tmppath.replace(batchdir / f"{stem}{suffix}")
+    return counts
+
+
+def merge_worker_batches(batches: list[int], args: Namespace) -> tuple[int, int]:
+    """Write the output of all work queue batches to the output directory.
+
+    :param batches:  numbers of the batches, in input order
+    :param args:  CLI arguments
+
+    Returns the numbers of matched and skipped sequences written.
+    """
+    logger = logging.getLogger(__name__)
+
+    batchdir = args.outdirname / "batches"
+    stems = [batchdir / f"{args.filestem}_batch_{batch:06d}" for batch in batches]
+    with PairedSequenceWriter(
+        args.outdirname, args.filestem, bgzip=args.bgzip
+    ) as writer:
+        logger.info("\tWriting matched input sequences to %s", writer.aafilename)
+        logger.info("\tWriting matched output sequences to %s", writer.ntfilename)
+        for stem in stems:
+            aaseqs = SeqIO.parse(f"{stem}_aa.fasta", "fasta")
+            ntseqs = SeqIO.parse(f"{stem}_nt.fasta", "fasta")
+            for aaseq, ntseq in iter_paired_records(aaseqs, ntseqs):
+                writer.write(aaseq, ntseq)
+
+    # Batches write skipped sequences only if there are any
+    skipped = [Path(f"{stem}_skipped.fasta") for stem in stems]
+    skipped = [path for path in skipped if path.is_file()]
+    nskipped = 0
+    if skipped:
+        skippedpath = args.outdirname / args.skippedfname
+        logger.info("\tWriting skipped sequences to %s", skippedpath)
+        nskipped = SeqIO.write(
+            chain.from_iterable(SeqIO.parse(path, "fasta") for path in skipped),
+            skippedpath,
+            "fasta",
+        )
+    return writer.count, nskipped
+
+
+def run_worker(
+    cachepath: Path,
+    args: Namespace,
+    local_genbank: None | Mapping[str, SeqRecord] = None,
+    **kwargs: object,
+) -> int:
+    """Claim and process batches from the work queue until all are done.
+
+    :param cachepath:  path to local cache
+    :param args:  CLI arguments
+    :param local_genbank:  index of local GenBank records, or None
+    :param kwargs:  passed to process_sequences()
+
+    The first worker to start splits the input into batches in the work
+    queue; later workers check that their input matches. Each claimed batch
+    is passed through the pipeline (as with --pipeline), while its lease is
+    renewed. A batch whose worker dies is claimed again once its lease
+    expires. When every batch is done, one worker claims the final merge,
+    writing the output of all batches to the output directory in input
+    order. Workers wait for batches claimed by other workers, in case they
+    must be reclaimed. Returns the number of batches this worker processed.
+    """
+    logger = logging.getLogger(__name__)
+
+    worker = worker_name()
+    queuepath = args.queue
+    if queuepath is None:
+        queuepath = args.outdirname / "ncfp_queue.sqlite3"
+    inpath = stream_input_path(args)
+    digest, ninputs = input_digest(iter_input_sequences(inpath))
+    with open_binary_stream(inpath.open("rb")) as instream:
+        positions = list(fasta_positions(instream, args.queue_batchsize))
+    nbatches = initialise_queue(
+        queuepath, digest, ninputs, args.queue_batchsize, positions
+    )
+    logger.info(
+        "Worker %s using work queue %s (%d batches)", worker, queuepath, nbatches
+    )
+
+    nclaimed = 0
+    while True:
+        batch = claim_batch(queuepath, worker, args.lease)
+        if batch is None:
+            # The merge batch is the last to be done
+            if count_batches(queuepath).get("done", 0) > nbatches:
+                break
+            logger.info("Waiting for batches claimed by other workers...")
+            time.sleep(QUEUE_POLL_INTERVAL)
+            continue
+        logger.info("Claimed %s batch %d", batch.stage, batch.batch)
+        try:
+            with Lease(queuepath, batch.batch, worker, args.lease):
+                if batch.stage == "merge":
+                    nmatched, nskipped = merge_worker_batches(
+                        get_extract_batches(queuepath), args
+                    )
+                    logger.info(
+                        "Merged %d matched and %d skipped sequences", nmatched, nskipped
+                    )
+                else:
+                    nread, nskipped, nmatched = run_worker_batch(
+                        batch,
+                        inpath,
+                        cachepath,
+                        args,
+                        worker,
+                        local_genbank=local_genbank,
+                        **kwargs,
+                    )
+                    logger.info(
+                        "Batch %d: matched %d/%d records (%d skipped)",
+                        batch.batch,
+                        nmatched,
+                        nread,
+                        nskipped,
+                    )
+        except BaseException:
+            # Return the batch at once, rather than when its lease expires
+            release_batch(queuepath, batch.batch, worker)
+            raise
+        if not complete_batch(queuepath, batch.batch, worker):
+            logger.warning(
+                "Batch %d was reclaimed by another worker, which will commit it",
+                batch.batch,
+            )
+        nclaimed += 1
+    return nclaimed
+
+
+def log_run_summary(
+    fetcher: SingleFlightFetcher, http_cache: None | ResponseCache, time0: float
+) -> None:
+    """Log request statistics, and time taken, at the end of a run.
+
+    :param fetcher:  SingleFlightFetcher used for the run
+    :param http_cache:  ResponseCache used for the run, or None
+    :param time0:  time the run started
+    """
+    logger = logging.getLogger(__name__)
+    logger.info(
+        "Coalesced %d duplicate in-flight requests (%d EFetch, %d ESummary)",
+        sum(fetcher.flight.hits.values()),
+        fetcher.flight.hits["efetch"],
+        fetcher.flight.hits["esummary"],
+    )
+    if http_cache is not None:
+        logger.info(
+            "HTTP cache: %d responses from cache, %d requested",
+            http_cache.hits,
+            http_cache.requests,
+        )
+
+    # Report success
+    logger.info("Completed. Time taken: %.3f", (time.time() - time0))
+
+
 # Main script function
 def run_main(argv=None):
     """Run main process for ncfp script.
@@ -337,6 +1344,29 @@ def run_main(argv=None):
     # Set email address at Entrez
     set_entrez_email(args.email)
 
+    # All E-utility requests are made through the selected fetcher backend,
+    # and E-utility and UniProt responses may be recorded to/replayed from disk
+    http_cache, fetcher_kwargs = None, {}
+    if args.http_cache is not None:
+        logger.info(
+            "Using HTTP response cache %s (%s)", args.http_cache, args.http_cache_mode
+        )
+        http_cache = ResponseCache(args.http_cache, args.http_cache_mode)
+        fetcher_kwargs["http_cache"] = http_cache
+    if args.eutils_url is not None:
+        logger.info("Sending E-utility requests to %s", args.eutils_url)
+        fetcher_kwargs["base_url"] = args.eutils_url
+    # Identical EFetch/ESummary requests that are in flight at the same time
+    # are coalesced into a single request
+    fetcher = SingleFlightFetcher(get_fetcher(args.fetcher, **fetcher_kwargs))
+
+    # Each shard writes its own output files, to be combined with ncfp-merge
+    if args.shard is not None:
+        suffix = shard_suffix(args.shard)
+        args.filestem = f"{args.filestem}{suffix}"
+        skippedpath = Path(args.skippedfname)
+        args.skippedfname = f"{skippedpath.stem}{suffix}{skippedpath.suffix}"
+
     # Make sure we can write to the output directory
     try:
         os.makedirs(args.outdirname, exist_ok=True)
@@ -348,9 +1378,8 @@ def run_main(argv=None):
         )
         raise SystemExit(1)
 
-    # Initialise local cache, get input sequences, and set format
+    # Initialise local cache
     cachepath = initialise_cache(args)
-    seqrecords = load_input_sequences(args)
 
     # Rather than subclass the Biopython SeqRecord class, we use the cache
     # database and query it to obtain relevant query terms and NCBI database
@@ -360,102 +1389,381 @@ def run_main(argv=None):
     # These accessions are taken from the FASTA header and, if we can't
     # parse that appropriately, we can't search - so we skip those
     # sequences
-    logger.debug("seqrecords: %s", seqrecords)
-    qrecords, qskipped = process_sequences(seqrecords, cachepath, args.disabletqdm)
-    if qskipped:
-        logger.warning("Skipped %d sequences (no query term found)", len(qskipped))
-        skippedpath = args.outdirname / args.skippedfname
-        SeqIO.write(qskipped, skippedpath, "fasta")
+    process_kwargs = {
+        "xrefpath": args.cachedir / "uniprot_xref.sqlite3",
+        "xref_ttl": args.uniprot_ttl,
+        "uniprot_index": args.uniprot_index,
+        "fetcher": fetcher,
+        "http_cache": http_cache,
+    }
+    # GenBank records in a local mirror are read from there, rather than
+    # downloaded
+    local_genbank = None
+    if args.local_genbank is not None:
+        logger.info("Opening local GenBank records in %s...", args.local_genbank)
+        try:
+            local_genbank = open_local_genbank(
+                args.local_genbank,
+                args.cachedir / "local_genbank.idx",
+            )
+        except NCFPException:
+            logger.exception("Could not use local GenBank records (exiting)")
+            raise SystemExit(1) from None
+        logger.info("Local GenBank index has %d records", len(local_genbank))
+
+    # With --worker, batches of input sequences are claimed from a work queue
+    # shared with other workers, and passed through all stages
+    if args.worker:
+        try:
+            nclaimed = run_worker(
+                cachepath, args, local_genbank=local_genbank, **process_kwargs
+            )
+        except NCFPException:
+            logger.exception("Could not use work queue (exiting)")
+            raise SystemExit(1) from None
+        logger.info("Worker processed %d batches", nclaimed)
+        log_run_summary(fetcher, http_cache, time0)
+        return 0
+
+    # With --pipeline, batches of input sequences pass through all stages
+    # independently, so that stages overlap
+    if args.pipeline:
+        if args.stream:
+            seqrecords = iter_input_sequences(stream_input_path(args), args.shard)
+        else:
+            seqrecords = load_input_sequences(args)
+        ninputs, nskipped, nmatched = run_pipeline(
+            seqrecords,
+            cachepath,
+            args,
+            local_genbank=local_genbank,
+            **process_kwargs,
+        )
+        if nskipped:
+            logger.warning("Skipped %d sequences (no query term found)", nskipped)
+            logger.warning(
+                "Skipped sequences were written to %s",
+                args.outdirname / args.skippedfname,
+            )
+        logger.info("Matched %d/%d records", nmatched, ninputs)
+        log_run_summary(fetcher, http_cache, time0)
+        return 0
+
+    # Stages completed by an earlier run on the same input, with the same
+    # stage arguments, are recorded in the cache and skipped (--keepcache)
+    skippedpath = args.outdirname / args.skippedfname
+    if args.stream:
+        # Input sequences are triaged in chunks, and read again for extraction
+        inpath = stream_input_path(args)
+        digest, ninputs = input_digest(iter_input_sequences(inpath, args.shard))
+    else:
+        seqrecords = load_input_sequences(args)
+        logger.debug("seqrecords: %s", seqrecords)
+        digest, ninputs = input_digest(seqrecords)
+    runstate = RunState(cachepath, run_state_key(digest, args))
+
+    nskipped = 0
+    if runstate.skip("process"):
+        # Input sequences were triaged into the cache by an earlier run
+        qrecords = [QueryRecord(acc) for acc in get_query_accessions(cachepath)]
+    elif args.stream:
+        qrecords, nskipped, ninputs = stream_process_sequences(
+            inpath, cachepath, args, **process_kwargs
+        )
+        runstate.complete("process")
+    else:
+        qrecords, qskipped = process_sequences(
+            seqrecords, cachepath, args.disabletqdm, **process_kwargs
+        )
+        nskipped = len(qskipped)
+        if qskipped:
+            SeqIO.write(map(as_seqrecord, qskipped), skippedpath, "fasta")
+        runstate.complete("process")
+    if nskipped:
+        logger.warning("Skipped %d sequences (no query term found)", nskipped)
         logger.warning("Skipped sequences were written to %s", skippedpath)
     logger.info("%d sequences taken forward with query", len(qrecords))
     if not qrecords:
         logger.warning("No new input sequences were found! (in cache?)")
 
+    # NCBI protein inputs can be resolved directly to the region of the
+    # nucleotide record that codes for them, from GenPept records. These
+    # inputs are not searched for in later stages.
+    if args.coded_by and not runstate.skip("coded_by"):
+        logger.info("Resolving CDS regions from GenPept coded_by qualifiers...")
+        addedrows, countfail = fetch_coded_by_regions(
+            qrecords,
+            cachepath,
+            args.retries,
+            args.batchsize,
+            disabletqdm=args.disabletqdm,
+            fetcher=fetcher,
+        )
+        logger.info("Added %d CDS region records to cache", len(addedrows))
+        if countfail:
+            logger.info(
+                "No coded_by region found for %d protein queries (searching)",
+                countfail,
+            )
+        runstate.complete("coded_by")
+
+    # WP_ inputs can be linked to very many nucleotide records, so they can
+    # instead be resolved to a single representative CDS from their IPG
+    if args.ipg and not runstate.skip("ipg"):
+        logger.info("Resolving CDS regions from Identical Protein Groups...")
+        addedrows, countfail = fetch_ipg_regions(
+            qrecords,
+            cachepath,
+            args.retries,
+            args.batchsize,
+            policy=args.ipg_policy,
+            disabletqdm=args.disabletqdm,
+            fetcher=fetcher,
+        )
+        logger.info("Added %d IPG CDS region records to cache", len(addedrows))
+        if countfail:
+            logger.info("No IPG CDS found for %d WP_ queries (searching)", countfail)
+        runstate.complete("ipg")
+
     # Identify nucleotide accessions corresponding to the input sequences,
     # and cache them.
     logger.info("Identifying nucleotide accessions...")
-    addedrows, countfail = search_nt_ids(
-        qrecords,
-        cachepath,
-        args.retries,
-        disabletqdm=args.disabletqdm,
-    )
-    logger.info("Added %d new UIDs to cache", len(addedrows))
-    if countfail:
-        logger.warning(
-            "NCBI nucleotide accession search failed for " + "%d records",
-            countfail,
+    if args.link_index is not None and not runstate.skip("link_index"):
+        addedrows, countfail = search_nt_ids_index(
+            qrecords,
+            cachepath,
+            args.link_index,
+            args.retries,
+            max_links=args.max_links,
+            fetcher=fetcher,
+        )
+        logger.info("Added %d new UIDs to cache from link index", len(addedrows))
+        if countfail:
+            logger.info("%d protein queries not in link index (searching)", countfail)
+        runstate.complete("link_index")
+    if args.link_history and not runstate.skip("link_history"):
+        addedrows, countfail = search_nt_ids_history(
+            qrecords,
+            cachepath,
+            args.retries,
+            args.batchsize,
+            disabletqdm=args.disabletqdm,
+            max_links=args.max_links,
+            fetcher=fetcher,
         )
-    if not addedrows and countfail == 0:
-        logger.warning("No nucleotide accession downloads were required! (in cache?)")
+        logger.info("Added %d new UIDs to cache from ELink histories", len(addedrows))
+        if countfail:
+            logger.info("No ELink history result for %d records (retrying)", countfail)
+        runstate.complete("link_history")
+    if not runstate.skip("search"):
+        addedrows, countfail = search_nt_ids(
+            qrecords,
+            cachepath,
+            args.retries,
+            disabletqdm=args.disabletqdm,
+            max_links=args.max_links,
+            fetcher=fetcher,
+        )
+        logger.info("Added %d new UIDs to cache", len(addedrows))
+        if countfail:
+            logger.warning(
+                "NCBI nucleotide accession search failed for %d records", countfail
+            )
+        if not addedrows and countfail == 0:
+            logger.warning(
+                "No nucleotide accession downloads were required! (in cache?)"
+            )
+        runstate.complete("search", countfail)
 
     # At this point, we want to retrieve all records that are
     # queryable against the NCBI nt database.
     # First, we associate GenBank accessions with a UID. This can be done
     # without reference to the records, using only the cache.
-    logger.info("Collecting GenBank accessions...")
-    updatedrows, countfail = update_gb_accessions(
-        cachepath,
-        args.retries,
-        disabletqdm=args.disabletqdm,
-    )
-    logger.info("Updated GenBank accessions for %d UIDs", len(updatedrows))
-    if countfail:
-        logger.warning("Unable to update GenBank accessions for %d UIDs", countfail)
-    if not updatedrows and countfail == 0:
-        logger.warning("No GenBank accession downloads were required! (in cache?)")
+    if not runstate.skip("accessions"):
+        logger.info("Collecting GenBank accessions...")
+        updatedrows, countfail = update_gb_accessions(
+            cachepath,
+            args.retries,
+            disabletqdm=args.disabletqdm,
+            fetcher=fetcher,
+        )
+        logger.info("Updated GenBank accessions for %d UIDs", len(updatedrows))
+        if countfail:
+            logger.warning("Unable to update GenBank accessions for %d UIDs", countfail)
+        if not updatedrows and countfail == 0:
+            logger.warning("No GenBank accession downloads were required! (in cache?)")
+        runstate.complete("accessions", countfail)
 
     # Next we recover GenBank headers and extract useful information -
     # sequence length, taxonomy, and so on.
-    logger.info("Fetching GenBank headers...")
-    addedrows, countfail = fetch_gb_headers(
-        cachepath,
-        args.retries,
-        args.batchsize,
-        disabletqdm=args.disabletqdm,
-    )
-    logger.info("Fetched GenBank headers for %d UIDs", len(addedrows))
-    if countfail:
-        logger.warning("Unable to update GenBank headers for %d UIDs", countfail)
-    if not addedrows and countfail == 0:
-        logger.warning("No GenBank header downloads were required! (in cache?)")
+    if not runstate.skip("headers"):
+        logger.info("Fetching GenBank headers...")
+        addedrows, countfail = fetch_gb_headers(
+            cachepath,
+            args.retries,
+            args.batchsize,
+            disabletqdm=args.disabletqdm,
+            postsize=args.postsize,
+            local_genbank=local_genbank,
+            fetcher=fetcher,
+        )
+        logger.info("Fetched GenBank headers for %d UIDs", len(addedrows))
+        if countfail:
+            logger.warning("Unable to update GenBank headers for %d UIDs", countfail)
+        if not addedrows and countfail == 0:
+            logger.warning("No GenBank header downloads were required! (in cache?)")
+        runstate.complete("headers", countfail)
+
+    # Where the CDS can be located in the shortest GenBank record from its
+    # feature table, only the region of the record containing it is needed
+    if args.region_fetch and not runstate.skip("regions"):
+        logger.info("Fetching CDS regions of shortest GenBank records...")
+        addedrows, countfail = fetch_shortest_genbank_regions(
+            cachepath,
+            args.retries,
+            args.batchsize,
+            padding=args.region_padding,
+            disabletqdm=args.disabletqdm,
+            local_genbank=local_genbank,
+            fetcher=fetcher,
+        )
+        logger.info("Fetched GenBank regions for %d sequences", len(addedrows))
+        if countfail:
+            logger.info(
+                "Could not fetch GenBank regions for %d sequences (fetching records)",
+                countfail,
+            )
+        runstate.complete("regions")
 
     # Next we recover the shortest complete GenBank record for each input
     # sequence
-    logger.info("Fetching shortest complete GenBank records...")
-    addedrows, countfail = fetch_shortest_genbank(
-        cachepath,
-        args.retries,
-        args.batchsize,
-        disabletqdm=args.disabletqdm,
-    )
-    logger.info("Fetched GenBank records for %d UIDs", len(addedrows))
-    if countfail:
-        logger.warning("Unable to get complete GenBank files for %d UIDs", countfail)
-    if not addedrows and countfail == 0:
-        logger.warning("No complete GenBank downloads were required! (in cache?)")
+    if not runstate.skip("records"):
+        logger.info("Fetching shortest complete GenBank records...")
+        addedrows, countfail = fetch_shortest_genbank(
+            cachepath,
+            args.retries,
+            args.batchsize,
+            disabletqdm=args.disabletqdm,
+            postsize=args.postsize,
+            local_genbank=local_genbank,
+            fetcher=fetcher,
+        )
+        logger.info("Fetched GenBank records for %d UIDs", len(addedrows))
+        if countfail:
+            logger.warning(
+                "Unable to get complete GenBank files for %d UIDs", countfail
+            )
+        if not addedrows and countfail == 0:
+            logger.warning("No complete GenBank downloads were required! (in cache?)")
+        runstate.complete("records", countfail)
 
     # Now that all the required GenBank nucleotide information is in the
     # local cache, we extract the CDS for each of the input sequences
     logger.info("Extracting CDS for each input sequence...")
     if args.stockholm:
         logger.info("Expecting Stockholm format location data for each sequence")
-    nt_sequences = extract_cds_features(seqrecords, cachepath, args)
-    logger.info("Matched %d/%d records", len(nt_sequences), len(seqrecords))
-    for record, cds in nt_sequences:
-        logger.info("\t%-40s to CDS: %s", record.id, cds.id)
+    if args.stream:
+        # Input sequences are read again, so that they are not held in memory
+        seqrecords = iter_input_sequences(inpath, args.shard)
 
-    # Write matched pairs to output directory, in files ending
-    # '_aa.fasta' and '_nt.fasta'. The pairs will be in the same order,
+    # Write matched pairs to output directory as they are extracted, in files
+    # ending '_aa.fasta' and '_nt.fasta'. The pairs will be in the same order,
     # so can be used for backtranslation
     logger.info("Writing paired sequence files to %s", args.outdirname)
-    write_sequences(nt_sequences, args)
+    nmatched = write_sequence_pairs(
+        iter_cds_features(seqrecords, cachepath, args), args
+    )
+    logger.info("Matched %d/%d records", nmatched, ninputs)
 
-    # Report success
-    logger.info("Completed. Time taken: %.3f", (time.time() - time0))
+    log_run_summary(fetcher, http_cache, time0)
     return 0
 
 
+# Write paired aa and nt sequences to output directory, as they are matched
+class PairedSequenceWriter:
+    """Writes paired aa and nt sequences to output files, in lock-step.
+
+    Each (aa, nt) pair is written to the files ending '_aa.fasta' and
+    '_nt.fasta' as soon as it is passed to write(), so that the nth
+    sequence in each file belongs to the same pair, and the files can be
+    used for backtranslation. Both files are flushed every flush_interval
+    pairs, so that the pairs written before an interruption are kept.
+
+    With bgzip, the files are BGZF compressed (ending '.fasta.gz') in
+    background threads, and indexed for samtools faidx.
+    """
+
+    def __init__(
+        self,
+        outdirname: Path,
+        filestem: str,
+        flush_interval: int = WRITE_FLUSH_INTERVAL,
+        *,
+        bgzip: bool = False,
+    ) -> None:
+        """Instantiate writer.
+
+        :param outdirname:  path to output directory
+        :param filestem:  stem for output filenames
+        :param flush_interval:  number of pairs written between flushes
+        :param bgzip:  write BGZF compressed files, with .fai and .gzi indexes
+        """
+        suffix = ".fasta.gz" if bgzip else ".fasta"
+        self.aafilename = outdirname / Path(filestem + "_aa" + suffix)
+        self.ntfilename = outdirname / Path(filestem + "_nt" + suffix)
+        self.bgzip = bgzip
+        self.flush_interval = flush_interval
+        self.count = 0
+        self._aafh = None
+        self._ntfh = None
+
+    def __enter__(self) -> Self:
+        """Open the output files, to be closed on leaving the context."""
+        self.open()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        """Close the output files."""
+        self.close()
+
+    def open(self) -> None:
+        """Open (and truncate) the paired output files."""
+        if self.bgzip:
+            self._aafh = BgzfFastaWriter(self.aafilename)
+            self._ntfh = BgzfFastaWriter(self.ntfilename)
+        else:
+            self._aafh = self.aafilename.open("w")
+            self._ntfh = self.ntfilename.open("w")
+
+    def write(self, aaseq: SeqRecord | InputRecord, ntseq: SeqRecord) -> None:
+        """Write a matched pair of sequences to the output files.
+
+        :param aaseq:  input sequence (SeqRecord or InputRecord)
+        :param ntseq:  SeqRecord of the matching CDS
+        """
+        if self.bgzip:
+            self._aafh.write_record(as_seqrecord(aaseq))
+            self._ntfh.write_record(ntseq)
+        else:
+            SeqIO.write(as_seqrecord(aaseq), self._aafh, "fasta")
+            SeqIO.write(ntseq, self._ntfh, "fasta")
+        self.count += 1
+        if self.count % self.flush_interval == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        """Flush both output files."""
+        self._aafh.flush()
+        self._ntfh.flush()
+
+    def close(self) -> None:
+        """Close both output files."""
+        for handle in (self._aafh, self._ntfh):
+            if handle is not None:
+                handle.close()
+        self._aafh = self._ntfh = None
+
+
 # Write paired aa and nt sequences to output directory
 def write_sequences(aa_nt_seqs, args: Namespace):
     """Write aa and nt sequences to output directory.
@@ -463,22 +1771,30 @@ def write_sequences(aa_nt_seqs, args: Namespace):
     :param aa_nt_seqs:  List of paired (aa, nt) SeqRecord tuples
     :param args:  script arguments
     """
-    logger = logging.getLogger(__name__)
+    write_sequence_pairs(aa_nt_seqs, args)
 
-    # Write input sequences that were matched
-    aafilename = args.outdirname / Path(args.filestem + "_aa.fasta")
-    logger.info(
-        "\tWriting %d matched input sequences to %s",
-        len(aa_nt_seqs),
-        aafilename,
-    )
-    SeqIO.write([aaseq for (aaseq, ntseq) in aa_nt_seqs], aafilename, "fasta")
 
-    # Write coding sequences
-    ntfilename = args.outdirname / Path(args.filestem + "_nt.fasta")
-    logger.info(
-        "\tWriting %d matched output sequences to %s",
-        len(aa_nt_seqs),
-        ntfilename,
-    )
-    SeqIO.write([ntseq for (aaseq, ntseq) in aa_nt_seqs], ntfilename, "fasta")
+# Write paired aa and nt sequences to output directory as they are generated
+def write_sequence_pairs(
+    aa_nt_seqs: Iterable[tuple[SeqRecord | InputRecord, SeqRecord]], args: Namespace
+) -> int:
+    """Write aa and nt sequences to output directory, one pair at a time.
+
+    :param aa_nt_seqs:  iterable of paired (aa, nt) SeqRecord tuples
+    :param args:  script arguments
+
+    Pairs are written with a PairedSequenceWriter as they are generated.
+    Returns the number of pairs written.
+    """
+    logger = logging.getLogger(__name__)
+
+    with PairedSequenceWriter(
+        args.outdirname, args.filestem, bgzip=args.bgzip
+    ) as writer:
+        logger.info("\tWriting matched input sequences to %s", writer.aafilename)
+        logger.info("\tWriting matched output sequences to %s", writer.ntfilename)
+        for aaseq, ntseq in aa_nt_seqs:
+            logger.info("\t%-40s to CDS: %s", aaseq.id, ntseq.id)
+            writer.write(aaseq, ntseq)
+    logger.info("\tWrote %d matched sequence pairs", writer.count)
+    return writer.count
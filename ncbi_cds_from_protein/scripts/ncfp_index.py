@@ -0,0 +1,112 @@
+# (c) The James Hutton Institute 2017-2019
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute for Pharmacy and Biomedical Sciences,
+# Cathedral Street,
+# Glasgow,
+# G1 1XQ
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2017-2019 The James Hutton Institute
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Implements the ncfp-index script for building offline lookup indexes."""
+
+from __future__ import annotations
+
+import logging
+import time
+from typing import TYPE_CHECKING
+
+from ncbi_cds_from_protein.indexes import build_link_index, build_uniprot_index
+from ncbi_cds_from_protein.logger import config_logger
+from ncbi_cds_from_protein.scripts.parsers import parse_index_cmdline
+
+if TYPE_CHECKING:
+    from argparse import Namespace
+
+
+def subcmd_uniprot(args: Namespace) -> int:
+    """Build UniProt accession index from idmapping_selected.tab.
+
+    :param args:  CLI arguments
+    """
+    return build_uniprot_index(
+        args.infnames[0],
+        args.indexpath,
+        args.batchsize,
+        disabletqdm=args.disabletqdm,
+    )
+
+
+def subcmd_links(args: Namespace) -> int:
+    """Build protein to nucleotide link index from NCBI mapping files.
+
+    :param args:  CLI arguments
+    """
+    return build_link_index(
+        args.infnames,
+        args.indexpath,
+        args.format,
+        args.batchsize,
+        disabletqdm=args.disabletqdm,
+    )
+
+
+SUBCOMMANDS = {"uniprot": subcmd_uniprot, "links": subcmd_links}
+
+
+# Main script function
+def run_main(argv: None | list[str] | Namespace = None) -> int:
+    """Run main process for ncfp-index script.
+
+    - argv      arguments for program. If None, parse command-line; if list
+                pass the list to the parser; if a Namespace, use it directly
+    """
+    # Parse command-line if no namespace provided
+    if argv is None:
+        args = parse_index_cmdline()
+    elif isinstance(argv, list):
+        args = parse_index_cmdline(argv)
+    else:
+        args = argv
+
+    # Set up logging
+    time0 = time.time()
+    logger = logging.getLogger(__name__)
+    config_logger(args)
+
+    for infname in args.infnames:
+        if not infname.is_file():
+            logger.error("Input file %s does not exist (exiting)", infname)
+            raise SystemExit(1)
+
+    count = SUBCOMMANDS[args.subcommand](args)
+    logger.info("Indexed %d entries in %s", count, args.indexpath)
+    logger.info("Completed. Time taken: %.3f", (time.time() - time0))
+    return 0
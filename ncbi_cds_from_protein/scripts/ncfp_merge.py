@@ -0,0 +1,247 @@
+# (c) The James Hutton Institute 2017-2019
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute for Pharmacy and Biomedical Sciences,
+# Cathedral Street,
+# Glasgow,
+# G1 1XQ
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2017-2019 The James Hutton Institute
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Implements the ncfp-merge script for combining the shards of a run."""
+
+from __future__ import annotations
+
+import logging
+import re
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from Bio import SeqIO
+
+from ncbi_cds_from_protein import NCFPException
+from ncbi_cds_from_protein.caches import initialise_dbcache, merge_cache
+from ncbi_cds_from_protein.compression import open_text_file
+from ncbi_cds_from_protein.logger import config_logger
+from ncbi_cds_from_protein.scripts.ncfp import (
+    PairedSequenceWriter,
+    iter_paired_records,
+    shard_suffix,
+)
+from ncbi_cds_from_protein.scripts.parsers import parse_merge_cmdline
+from ncbi_cds_from_protein.sequences import parse_input_fasta, shard_index
+
+if TYPE_CHECKING:
+    from argparse import Namespace
+    from collections.abc import Callable, Iterable, Iterator
+
+    from ncbi_cds_from_protein.sequences import InputRecord
+
+
+def find_shard_outputs(sharddirs: list[Path], filestem: str) -> dict:
+    """Return paths to the paired output files of each shard, by shard.
+
+    :param sharddirs:  directories holding shard output files
+    :param filestem:  stem of the output files given to each shard
+
+    Every shard from 1 to N must have written its output files, where N is
+    taken from the filenames.
+    """
+    pattern = re.compile(
+        rf"^{re.escape(filestem)}_shard_(\d+)_of_(\d+)_aa\.fasta(\.gz)?$"
+    )
+    outputs, nshards = {}, set()
+    for sharddir in sharddirs:
+        for path in sorted(sharddir.iterdir()):
+            match = pattern.match(path.name)
+            if match is None:
+                continue
+            idx, total = int(match.group(1)), int(match.group(2))
+            ntpath = path.with_name(path.name.replace("_aa.fasta", "_nt.fasta"))
+            outputs[idx] = (path, ntpath)
+            nshards.add(total)
+    if len(nshards) != 1:
+        msg = f"Expected output files from one sharded run, found {sorted(nshards)} shards"
+        raise NCFPException(msg)
+    (total,) = nshards
+    missing = sorted(set(range(1, total + 1)) - set(outputs))
+    if missing:
+        msg = f"No output files for shards {missing} of {total}"
+        raise NCFPException(msg)
+    return outputs
+
+
+def iter_merged_records(
+    records: Iterable[InputRecord],
+    streams: dict[int, Iterator],
+    nshards: int,
+    key: Callable[[object], str] = lambda _: _.id,
+) -> Iterator:
+    """Generate items from shard streams in the order of the input records.
+
+    :param records:  iterable of input sequence records, in input order
+    :param streams:  iterators of items written by each shard, by shard
+    :param nshards:  number of shards
+    :param key:  function returning the input sequence ID of an item
+
+    Each shard wrote items for a subset of its input sequences, in input
+    order, so the next item from a sequence's shard is taken if it belongs
+    to that sequence. An NCFPException is raised if any items are left over,
+    as the shards were not run on these input sequences.
+    """
+    heads = {idx: next(stream, None) for idx, stream in streams.items()}
+    for record in records:
+        idx = shard_index(record.id, nshards) + 1
+        head = heads.get(idx)
+        if head is not None and key(head) == record.id:
+            yield head
+            heads[idx] = next(streams[idx], None)
+    leftover = sorted(idx for idx, head in heads.items() if head is not None)
+    if leftover:
+        msg = f"Output of shards {leftover} does not match the input sequences"
+        raise NCFPException(msg)
+
+
+def iter_fasta(path: Path) -> Iterable:
+    """Generate SeqRecords from a (possibly compressed) FASTA file.
+
+    :param path:  path to FASTA file
+    """
+    with open_text_file(path) as instream:
+        yield from SeqIO.parse(instream, "fasta")
+
+
+def iter_input_records(path: Path) -> Iterable:
+    """Generate input sequence records from a (possibly compressed) FASTA file.
+
+    :param path:  path to input FASTA file
+    """
+    with open_text_file(path) as instream:
+        yield from parse_input_fasta(instream)
+
+
+def merge_outputs(args: Namespace) -> tuple[int, int]:
+    """Write shard outputs to the output directory, in input order.
+
+    :param args:  CLI arguments
+
+    Returns the numbers of matched and skipped sequences written.
+    """
+    logger = logging.getLogger(__name__)
+
+    outputs = find_shard_outputs(args.sharddirs, args.filestem)
+    nshards = len(outputs)
+    logger.info("Merging output files of %d shards", nshards)
+    pairs = {
+        idx: iter_paired_records(iter_fasta(aapath), iter_fasta(ntpath))
+        for idx, (aapath, ntpath) in outputs.items()
+    }
+    with PairedSequenceWriter(
+        args.outdirname, args.filestem, bgzip=args.bgzip
+    ) as writer:
+        logger.info("\tWriting matched input sequences to %s", writer.aafilename)
+        logger.info("\tWriting matched output sequences to %s", writer.ntfilename)
+        for aaseq, ntseq in iter_merged_records(
+            iter_input_records(args.infname),
+            pairs,
+            nshards,
+            key=lambda pair: pair[0].id,
+        ):
+            writer.write(aaseq, ntseq)
+
+    # Skipped sequences are written by shards only if there are any
+    skippedpath = Path(args.skippedfname)
+    skipped = {}
+    for idx in outputs:
+        fname = f"{skippedpath.stem}{shard_suffix((idx, nshards))}{skippedpath.suffix}"
+        for sharddir in args.sharddirs:
+            if (sharddir / fname).is_file():
+                skipped[idx] = iter_fasta(sharddir / fname)
+    nskipped = 0
+    if skipped:
+        outpath = args.outdirname / args.skippedfname
+        logger.info("\tWriting skipped sequences to %s", outpath)
+        nskipped = SeqIO.write(
+            iter_merged_records(iter_input_records(args.infname), skipped, nshards),
+            outpath,
+            "fasta",
+        )
+    return writer.count, nskipped
+
+
+# Main script function
+def run_main(argv: None | list[str] | Namespace = None) -> int:
+    """Run main process for ncfp-merge script.
+
+    - argv      arguments for program. If None, parse command-line; if list
+                pass the list to the parser; if a Namespace, use it directly
+    """
+    # Parse command-line if no namespace provided
+    if argv is None:
+        args = parse_merge_cmdline()
+    elif isinstance(argv, list):
+        args = parse_merge_cmdline(argv)
+    else:
+        args = argv
+
+    # Set up logging
+    time0 = time.time()
+    logger = logging.getLogger(__name__)
+    config_logger(args)
+
+    if not args.infname.is_file():
+        logger.error("Input file %s does not exist (exiting)", args.infname)
+        raise SystemExit(1)
+    if args.caches and args.cachepath is None:
+        logger.error("--cachepath is required to merge --caches (exiting)")
+        raise SystemExit(1)
+
+    # Shard caches are merged into a new cache, with no duplicated rows
+    if args.caches:
+        logger.info("Merging %d shard caches into %s", len(args.caches), args.cachepath)
+        args.cachepath.parent.mkdir(parents=True, exist_ok=True)
+        initialise_dbcache(args.cachepath)
+        for shardpath in args.caches:
+            if not shardpath.is_file():
+                logger.error("Shard cache %s does not exist (exiting)", shardpath)
+                raise SystemExit(1)
+            logger.info("\tMerging %s", shardpath)
+            merge_cache(args.cachepath, shardpath)
+
+    args.outdirname.mkdir(parents=True, exist_ok=True)
+    try:
+        nmatched, nskipped = merge_outputs(args)
+    except NCFPException:
+        logger.exception("Could not merge shard outputs (exiting)")
+        raise SystemExit(1) from None
+    logger.info("Merged %d matched and %d skipped sequences", nmatched, nskipped)
+    logger.info("Completed. Time taken: %.3f", (time.time() - time0))
+    return 0
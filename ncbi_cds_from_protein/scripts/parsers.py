@@ -38,12 +38,35 @@
 # THE SOFTWARE.
 """Provides command-line/subcommand parsers for the ncfp script."""
 
+from __future__ import annotations
+
 import sys
 import time
-
+from argparse import (
+    ArgumentDefaultsHelpFormatter,
+    ArgumentParser,
+    ArgumentTypeError,
+    Namespace,
+)
 from pathlib import Path
 
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from ncbi_cds_from_protein.fetchers import FETCHERS
+from ncbi_cds_from_protein.httpcache import HTTP_CACHE_MODES
+from ncbi_cds_from_protein.indexes import LINK_FORMATS
+from ncbi_cds_from_protein.sequences import IPG_POLICIES
+
+
+def parse_shard(value: str) -> tuple:
+    """Return (i, N) from an --shard argument of the form i/N."""
+    try:
+        idx, nshards = (int(_) for _ in value.split("/"))
+    except ValueError:
+        msg = f"shard must be of the form i/N, not {value!r}"
+        raise ArgumentTypeError(msg) from None
+    if not 1 <= idx <= nshards:
+        msg = f"shard {value!r} is not one of 1/{nshards}..N/N"
+        raise ArgumentTypeError(msg)
+    return idx, nshards
 
 
 # Process command-line for ncbi_cds_from_protein script
@@ -110,6 +133,49 @@ def parse_cmdline(args=None):
         type=int,
         help="batch size for EPost submissions",
     )
+    parser.add_argument(
+        "--postsize",
+        dest="postsize",
+        action="store",
+        default=None,
+        type=int,
+        help=(
+            "post up to this many UIDs per EPost history and page through it "
+            "with batchsize records per EFetch (resumable with --keepcache)"
+        ),
+    )
+    parser.add_argument(
+        "--max_links_per_protein",
+        dest="max_links",
+        action="store",
+        default=None,
+        type=int,
+        help=(
+            "keep at most this many ELinked nucleotide records per protein "
+            "query, ranked by ESummary (partial last, then shortest, then RefSeq)"
+        ),
+    )
+    parser.add_argument(
+        "--link_index",
+        dest="link_index",
+        action="store",
+        default=None,
+        type=Path,
+        help=(
+            "look up nucleotide records linked to protein queries in this "
+            "offline index (built with ncfp-index links), before using ELink"
+        ),
+    )
+    parser.add_argument(
+        "--link_history",
+        dest="link_history",
+        action="store_true",
+        default=False,
+        help=(
+            "keep ELinked nucleotide UIDs on the NCBI History server, and "
+            "summarise and fetch headers for them from there"
+        ),
+    )
     parser.add_argument(
         "-r",
         "--retries",
@@ -135,6 +201,46 @@ def parse_cmdline(args=None):
         type=str,
         help="stem for output sequence files",
     )
+    parser.add_argument(
+        "--bgzip",
+        dest="bgzip",
+        action="store_true",
+        default=False,
+        help="write bgzip-compressed output sequence files, with .fai/.gzi indexes",
+    )
+    parser.add_argument(
+        "--uniprot_ttl",
+        dest="uniprot_ttl",
+        action="store",
+        default=30,
+        type=float,
+        help=(
+            "days before a UniProt accession with no cached cross-references "
+            "is looked up again"
+        ),
+    )
+    parser.add_argument(
+        "--uniprot_index",
+        dest="uniprot_index",
+        action="store",
+        default=None,
+        type=Path,
+        help=(
+            "look up UniProt cross-references in this offline index (built "
+            "with ncfp-index uniprot), instead of the UniProt service"
+        ),
+    )
+    parser.add_argument(
+        "--local_genbank",
+        dest="local_genbank",
+        action="store",
+        default=None,
+        type=Path,
+        help=(
+            "read GenBank records from flatfiles (uncompressed or bgzipped) "
+            "under this directory, before downloading from NCBI"
+        ),
+    )
     parser.add_argument(
         "--keepcache",
         dest="keepcache",
@@ -171,6 +277,180 @@ def parse_cmdline(args=None):
         default=False,
         help=("Allow for an alternative start codon in the first sequence position"),
     )
+    parser.add_argument(
+        "--coded_by",
+        dest="coded_by",
+        action="store_true",
+        default=False,
+        help=(
+            "resolve NCBI protein inputs to CDS regions using GenPept coded_by "
+            "qualifiers, without downloading full GenBank records"
+        ),
+    )
+    parser.add_argument(
+        "--ipg",
+        dest="ipg",
+        action="store_true",
+        default=False,
+        help=(
+            "resolve WP_ protein inputs to a representative CDS region from "
+            "their Identical Protein Group report"
+        ),
+    )
+    parser.add_argument(
+        "--ipg_policy",
+        dest="ipg_policy",
+        action="store",
+        default="refseq",
+        choices=sorted(IPG_POLICIES),
+        help="choice of representative CDS for --ipg: preferred source, or first",
+    )
+    parser.add_argument(
+        "--region_fetch",
+        dest="region_fetch",
+        action="store_true",
+        default=False,
+        help=(
+            "locate each CDS with a feature table, and fetch only that region "
+            "of the shortest GenBank record"
+        ),
+    )
+    parser.add_argument(
+        "--region_padding",
+        dest="region_padding",
+        action="store",
+        default=100,
+        type=int,
+        help="number of bases either side of the CDS to fetch with --region_fetch",
+    )
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action="store_true",
+        default=False,
+        help=(
+            "triage input sequences in chunks and read them again for CDS "
+            "extraction, rather than holding them all in memory"
+        ),
+    )
+    parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        action="store_true",
+        default=False,
+        help=(
+            "pass input sequences through all stages in batches, overlapping "
+            "searches, downloads and CDS extraction for different batches"
+        ),
+    )
+    parser.add_argument(
+        "--pipeline_workers",
+        dest="pipeline_workers",
+        action="store",
+        default=4,
+        type=int,
+        help="number of threads searching for batches with --pipeline",
+    )
+    # A sharded run processes a fixed partition of the input, so cannot also
+    # claim batches from a work queue
+    partition = parser.add_mutually_exclusive_group()
+    partition.add_argument(
+        "--shard",
+        dest="shard",
+        action="store",
+        default=None,
+        type=parse_shard,
+        help=(
+            "process only the ith of N partitions of the input sequences "
+            "(i/N), writing cache and output files for the shard; combine "
+            "shards with ncfp-merge"
+        ),
+    )
+    partition.add_argument(
+        "--worker",
+        dest="worker",
+        action="store_true",
+        default=False,
+        help=(
+            "claim batches of input sequences from a shared work queue, with "
+            "other workers, until all batches are done"
+        ),
+    )
+    parser.add_argument(
+        "--queue",
+        dest="queue",
+        action="store",
+        default=None,
+        type=Path,
+        help=(
+            "path to shared work queue database for --worker "
+            "(default: ncfp_queue.sqlite3 in the output directory)"
+        ),
+    )
+    parser.add_argument(
+        "--queue_batchsize",
+        dest="queue_batchsize",
+        action="store",
+        default=1000,
+        type=int,
+        help="number of input sequences in each work queue batch",
+    )
+    parser.add_argument(
+        "--lease",
+        dest="lease",
+        action="store",
+        default=600,
+        type=float,
+        help=(
+            "seconds before a batch claimed by a worker that has stopped "
+            "responding can be claimed by another worker"
+        ),
+    )
+    parser.add_argument(
+        "--cpus",
+        dest="cpus",
+        action="store",
+        default=1,
+        type=int,
+        help=(
+            "number of processes extracting CDS from GenBank records "
+            "(default: 1, extract in the main process)"
+        ),
+    )
+    parser.add_argument(
+        "--fetcher",
+        dest="fetcher",
+        action="store",
+        default="entrez",
+        choices=sorted(FETCHERS),
+        help="backend used to make NCBI E-utility requests",
+    )
+    parser.add_argument(
+        "--eutils_url",
+        dest="eutils_url",
+        action="store",
+        default=None,
+        help="base URL of E-utilities to use instead of NCBI (e.g. a mirror)",
+    )
+    parser.add_argument(
+        "--http_cache",
+        dest="http_cache",
+        action="store",
+        default=None,
+        type=Path,
+        help="directory in which to record/replay NCBI and UniProt responses",
+    )
+    parser.add_argument(
+        "--http_cache_mode",
+        dest="http_cache_mode",
+        action="store",
+        default="read-through",
+        choices=HTTP_CACHE_MODES,
+        help=(
+            "use of --http_cache: read-through (replay, recording misses), "
+            "record (always request), or replay (never request)"
+        ),
+    )
     parser.add_argument(
         "-l",
         "--logfile",
@@ -209,3 +489,204 @@ def parse_cmdline(args=None):
     else:
         args = map(str, args)  # Ensure that args look like what we get from CLI
     return parser.parse_args(args)
+
+
+def add_common_index_arguments(parser: ArgumentParser) -> None:
+    """Add logging and progress arguments to an ncfp-index subcommand parser."""
+    parser.add_argument(
+        "--batchsize",
+        dest="batchsize",
+        action="store",
+        default=100000,
+        type=int,
+        help="number of rows to hold in memory between index writes",
+    )
+    parser.add_argument(
+        "-l",
+        "--logfile",
+        dest="logfile",
+        action="store",
+        default=None,
+        type=Path,
+        help="path to logfile",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        default=False,
+        help="report verbosely",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        default=False,
+        help="report debug-level information",
+    )
+    parser.add_argument(
+        "--disabletqdm",
+        dest="disabletqdm",
+        action="store_true",
+        default=False,
+        help="disable progress bar (for testing)",
+    )
+
+
+def parse_index_cmdline(args: None | list[str] = None) -> Namespace:
+    """Parse command-line arguments for the ncfp-index script."""
+    parser = ArgumentParser(
+        prog="ncfp-index", formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    subparsers = parser.add_subparsers(
+        title="subcommands", dest="subcommand", required=True
+    )
+
+    # Subcommand: build UniProt accession index from idmapping_selected.tab
+    parser_uniprot = subparsers.add_parser(
+        "uniprot",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help="index UniProt idmapping_selected.tab(.gz) for --uniprot_index",
+    )
+    parser_uniprot.add_argument(
+        action="store",
+        dest="infnames",
+        nargs=1,
+        help="path to UniProt idmapping_selected.tab(.gz)",
+        type=Path,
+    )
+    parser_uniprot.add_argument(
+        action="store",
+        dest="indexpath",
+        help="path to write index",
+        type=Path,
+    )
+    add_common_index_arguments(parser_uniprot)
+
+    # Subcommand: build protein to nucleotide link index from NCBI mapping files
+    parser_links = subparsers.add_parser(
+        "links",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help="index NCBI protein to nucleotide mapping files for --link_index",
+    )
+    parser_links.add_argument(
+        action="store",
+        dest="infnames",
+        nargs="+",
+        help="paths to mapping files (optionally gzipped)",
+        type=Path,
+    )
+    parser_links.add_argument(
+        action="store",
+        dest="indexpath",
+        help="path to write index",
+        type=Path,
+    )
+    parser_links.add_argument(
+        "--format",
+        dest="format",
+        action="store",
+        default="gene2accession",
+        choices=sorted(LINK_FORMATS),
+        help="format of mapping files (gene2accession/gene2refseq, or IPG reports)",
+    )
+    add_common_index_arguments(parser_links)
+
+    # Parse arguments, ensuring that args look like what we get from CLI
+    args = sys.argv[1:] if args is None else map(str, args)
+    return parser.parse_args(args)
+
+
+def parse_merge_cmdline(args: None | list[str] = None) -> Namespace:
+    """Parse command-line arguments for the ncfp-merge script."""
+    parser = ArgumentParser(
+        prog="ncfp-merge", formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        action="store",
+        dest="infname",
+        help="path to the input FASTA sequence file given to every shard",
+        type=Path,
+    )
+    parser.add_argument(
+        action="store",
+        dest="outdirname",
+        help="path to directory to write merged output",
+        type=Path,
+    )
+    parser.add_argument(
+        action="store",
+        dest="sharddirs",
+        nargs="+",
+        help="paths to shard output directories",
+        type=Path,
+    )
+    parser.add_argument(
+        "--caches",
+        dest="caches",
+        action="store",
+        nargs="+",
+        default=[],
+        type=Path,
+        help="paths to shard caches to merge",
+    )
+    parser.add_argument(
+        "--cachepath",
+        dest="cachepath",
+        action="store",
+        default=None,
+        type=Path,
+        help="path to write merged cache (required with --caches)",
+    )
+    parser.add_argument(
+        "--filestem",
+        dest="filestem",
+        action="store",
+        default="ncfp",
+        type=str,
+        help="stem for shard and merged output sequence files",
+    )
+    parser.add_argument(
+        "--skippedfile",
+        dest="skippedfname",
+        action="store",
+        default="skipped.fasta",
+        type=str,
+        help="filename for shard and merged skipped sequences",
+    )
+    parser.add_argument(
+        "--bgzip",
+        dest="bgzip",
+        action="store_true",
+        default=False,
+        help="write bgzip-compressed merged output sequence files, with .fai/.gzi indexes",
+    )
+    parser.add_argument(
+        "-l",
+        "--logfile",
+        dest="logfile",
+        action="store",
+        default=None,
+        type=Path,
+        help="path to logfile",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        default=False,
+        help="report verbosely",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        default=False,
+        help="report debug-level information",
+    )
+
+    # Parse arguments, ensuring that args look like what we get from CLI
+    args = sys.argv[1:] if args is None else map(str, args)
+    return parser.parse_args(args)
@@ -39,24 +39,180 @@
 
 from __future__ import annotations
 
+import hashlib
 import logging
 import re
 import sqlite3
-from typing import TYPE_CHECKING, Iterable
+from collections import defaultdict
+from typing import TYPE_CHECKING, NamedTuple, TextIO
 
+from Bio.Seq import Seq
+from Bio.SeqFeature import CompoundLocation, Location, SeqFeature, SimpleLocation
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.SeqRecord import SeqRecord
 from bioservices import UniProt
 from tqdm.auto import tqdm
 
 import ncbi_cds_from_protein
 
-from .caches import add_input_sequence, has_query
+from .caches import (
+    add_input_sequence,
+    add_seq_alias,
+    add_seq_keys,
+    add_uniprot_xrefs,
+    find_seq_key,
+    get_uniprot_xrefs,
+    has_query,
+)
+from .httpcache import CachedUniProt
+from .indexes import get_uniprot_index_xrefs
 
 if TYPE_CHECKING:
     from argparse import Namespace
+    from collections.abc import Iterable, Iterator
     from pathlib import Path
 
-    from Bio.SeqFeature import SeqFeature
+    from .fetchers import Fetcher
+    from .httpcache import ResponseCache
+
+# Order of preference for IPG report sources, by representative CDS policy
+IPG_POLICIES = {
+    "refseq": ("RefSeq", "INSDC"),
+    "insdc": ("INSDC", "RefSeq"),
+    "first": (),
+}
+
+# UniProt cross-reference columns, and number of accessions per batched query
+UNIPROT_XREF_COLUMNS = "accession,xref_embl,gene_orf,xref_geneid,xref_refseq"
+UNIPROT_BATCHSIZE = 200
+
+
+class UniProtXref(NamedTuple):
+    """Cross-references for a UniProt accession (empty strings if absent)."""
+
+    embl: str  # EMBL accessions, separated by semicolons
+    orf: str  # ORF gene name
+    geneid: str  # NCBI GeneIDs, separated by semicolons
+    refseq: str  # RefSeq protein IDs, separated by semicolons
+
+
+class QueryRecord(NamedTuple):
+    """ID of an input sequence, in place of its SeqRecord in stages 2 to 5.
+
+    The search and download stages only use the ID of each input, so when
+    input is streamed (--stream) the sequences are not kept in memory.
+    """
+
+    id: str
+
+
+class InputRecord:
+    """Input FASTA sequence, in place of a SeqRecord.
+
+    Only the ID and description of each input sequence are used before CDS
+    extraction, where the sequence is compared with the translated CDS, so
+    input is parsed with SimpleFastaParser into these compact records. A
+    SeqRecord is built with to_seqrecord() only when the sequence is written.
+    """
+
+    __slots__ = ("description", "id", "sequence")
+
+    def __init__(self, id: str, description: str, sequence: str) -> None:  # noqa: A002
+        """Instantiate record, with the attribute names of a SeqRecord."""
+        self.id = id
+        self.description = description
+        self.sequence = sequence
+
+    def __repr__(self) -> str:
+        """Return representation of the record, without its sequence."""
+        return f"InputRecord(id={self.id!r}, description={self.description!r})"
+
+    @property
+    def seq(self) -> Seq:
+        """Return the input sequence as a Seq object."""
+        return Seq(self.sequence)
+
+    def to_seqrecord(self) -> SeqRecord:
+        """Return the input sequence as a SeqRecord, as SeqIO.parse() would."""
+        return SeqRecord(
+            Seq(self.sequence),
+            id=self.id,
+            name=self.id,
+            description=self.description,
+        )
+
+
+def parse_input_fasta(handle: TextIO) -> Iterator[InputRecord]:
+    """Generate InputRecords from a FASTA format stream.
+
+    :param handle:  open FASTA format stream
+
+    IDs and descriptions are split from the header line as by
+    SeqIO.parse(handle, "fasta").
+    """
+    for title, sequence in SimpleFastaParser(handle):
+        try:
+            seqid = title.split(None, 1)[0]
+        except IndexError:
+            seqid = ""
+        yield InputRecord(seqid, title, sequence)
+
+
+def as_seqrecord(record: SeqRecord | InputRecord) -> SeqRecord:
+    """Return the passed input sequence record as a SeqRecord.
+
+    :param record:  SeqRecord or InputRecord describing an input sequence
+    """
+    if isinstance(record, InputRecord):
+        return record.to_seqrecord()
+    return record
+
+
+def sequence_keys(record: SeqRecord | InputRecord) -> list[str]:
+    """Return keys identifying the protein described by an input sequence.
+
+    :param record:  SeqRecord or InputRecord describing an input sequence
+
+    Input sequences with the same ID, once any Stockholm domain location is
+    stripped, describe the same protein. Full-length input sequences (with
+    no domain location) with the same ungapped, uppercase sequence describe
+    identical proteins, whatever their IDs.
+    """
+    seqid = strip_stockholm_from_seqid(record.id)
+    keys = [f"id:{seqid}"]
+    if seqid == record.id:
+        seq = str(record.seq).replace("-", "").upper()
+        keys.append(f"seq:{hashlib.sha256(seq.encode()).hexdigest()}")
+    return keys
+
+
+def shard_index(seqid: str, nshards: int) -> int:
+    """Return the zero-based shard to which an input sequence belongs.
+
+    :param seqid:  input sequence ID
+    :param nshards:  number of shards
+
+    The shard depends only on the ID, once any Stockholm domain location is
+    stripped, so that every run (on any host) puts an input sequence, and
+    all its domains, in the same shard.
+    """
+    digest = hashlib.sha256(strip_stockholm_from_seqid(seqid).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % nshards
+
+
+def select_shard(
+    records: Iterable[SeqRecord | InputRecord], shard: tuple[int, int]
+) -> Iterable[SeqRecord | InputRecord]:
+    """Generate the input sequences in one shard of the input.
+
+    :param records:  iterable of input sequence records
+    :param shard:  (i, N) for the ith of N shards, counting from 1
+    """
+    idx, nshards = shard
+    for record in records:
+        if shard_index(record.id, nshards) == idx - 1:
+            yield record
+
 
 # regexes for parsing out Uniprot
 re_uniprot_head = re.compile(r".*\|.*\|.*")
@@ -102,13 +258,68 @@ def uniprot_to_embl(query_acc: str, u_service: UniProt) -> tuple[str, str]:
 
     Returns empty string in each case if no match found
     """
-    result = u_service.search(query_acc, columns="xref_embl")
-    qstring = result.split("\n")[1].strip()[:-1] if "\n" in result else ""
-
-    result = u_service.search(query_acc, columns="gene_orf")
-    pstring = result.split("\n")[1].strip() if "\n" in result else ""
+    xref = uniprot_xrefs([query_acc], u_service)[query_acc]
+    return xref.embl, xref.orf
+
+
+def uniprot_xrefs(
+    accessions: Iterable[str],
+    u_service: UniProt,
+    batchsize: int = UNIPROT_BATCHSIZE,
+) -> dict[str, UniProtXref]:
+    """Return cross-references for each passed UniProt accession.
+
+    :param accessions:  UniProt accessions to query
+    :param u_service:  UniProt service object
+    :param batchsize:  number of accessions per UniProt query
+
+    Accessions are queried in batches, with a single search of the form
+    "accession:X OR accession:Y" returning all the cross-reference columns
+    needed, as TSV. Accessions missing from a batch's results (e.g. secondary
+    accessions, which UniProt reports under their primary accession) are
+    queried individually. Accessions with no UniProt entry map to a
+    UniProtXref of empty strings.
+    """
+    logger = logging.getLogger(__name__)
 
-    return qstring, pstring
+    accessions = list(dict.fromkeys(accessions))  # unique, in order
+    xrefs = {}
+    for idx in range(0, len(accessions), batchsize):
+        batch = accessions[idx : idx + batchsize]
+        logger.debug("Querying UniProt for %d accessions", len(batch))
+        result = u_service.search(
+            " OR ".join(f"accession:{acc}" for acc in batch),
+            columns=UNIPROT_XREF_COLUMNS,
+            size=500,
+        )
+        xrefs.update(parse_uniprot_xrefs(result))
+    for acc in accessions:
+        if acc not in xrefs:
+            logger.debug("UniProt accession %s not in batch results", acc)
+            result = u_service.search(f"accession:{acc}", columns=UNIPROT_XREF_COLUMNS)
+            rows = list(parse_uniprot_xrefs(result).values())
+            xrefs[acc] = rows[0] if rows else UniProtXref("", "", "", "")
+    return {acc: xrefs[acc] for acc in accessions}
+
+
+def parse_uniprot_xrefs(result: str) -> dict[str, UniProtXref]:
+    """Return UniProt cross-references by accession, from TSV search output.
+
+    :param result:  UniProt TSV search result, with UNIPROT_XREF_COLUMNS
+
+    Trailing semicolons are removed from multi-valued cross-references.
+    bioservices returns a string without a header if there is no match.
+    """
+    xrefs = {}
+    for line in result.split("\n")[1:]:
+        if not line.strip():
+            continue
+        fields = (line.split("\t") + [""] * 5)[:5]
+        acc, embl, orf, geneid, refseq = (field.strip() for field in fields)
+        xrefs[acc] = UniProtXref(
+            embl.rstrip(";"), orf, geneid.rstrip(";"), refseq.rstrip(";")
+        )
+    return xrefs
 
 
 # Process collection of SeqRecords into cache and skipped/kept
@@ -116,28 +327,87 @@ def process_sequences(
     records: Iterable[SeqRecord],
     cachepath: Path,
     disabletqdm: bool = True,
+    xrefpath: Path | None = None,
+    xref_ttl: float = 30,
+    uniprot_index: Path | None = None,
+    fetcher: Fetcher | None = None,
+    http_cache: ResponseCache | None = None,
 ) -> tuple[list[SeqRecord], list[SeqRecord]]:
     """Triage SeqRecords into those that can/cannot be used.
 
     This function also caches all inputs into the SQLite cache
     at cachepath
 
+    Input sequences that duplicate a protein already taken forward (see
+    sequence_keys()) are recorded as aliases of that representative in the
+    cache, and are neither kept nor skipped: only the representative is
+    searched for, and its CDS is shared with every duplicate at extraction.
+
     :param records:  collection of SeqRecords
     :param cachepath: path to local sequence cache
     :param disabletqdm:  turn off tqdm progress bar
+    :param xrefpath:  path to persistent UniProt cross-reference cache
+    :param xref_ttl:  age (in days) after which cached UniProt misses expire
+    :param uniprot_index:  path to offline UniProt index, used instead of the
+        UniProt service (see ncfp-index uniprot)
+    :param fetcher:  Fetcher backend for GeneID lookups (default: EntrezFetcher)
+    :param http_cache:  ResponseCache for UniProt responses
     """
     logger = logging.getLogger(__name__)
     logger.info("Processing sequences...")
 
-    kept, skipped = [], []
-
-    u_service = UniProt()
+    kept, skipped, nduplicates = [], [], 0
+
+    # UniProt cross-references are looked up in batches, before triage,
+    # once per UniProt accession
+    records = list(records)
+    u_accessions = list(
+        dict.fromkeys(
+            record.id.split("|")[1]
+            for record in records
+            if guess_seqtype(record) == "UniProt"
+            and re.search(re_uniprot_gn, record.description) is not None
+        )
+    )
+    if uniprot_index is not None:
+        u_xrefs = {acc: UniProtXref("", "", "", "") for acc in u_accessions}
+        # The index holds no ORF gene names, so the protein IDs of the EMBL
+        # CDS are used as the protein query in their place
+        for acc, (embl, embl_cds, geneid, refseq) in get_uniprot_index_xrefs(
+            uniprot_index, u_accessions
+        ).items():
+            u_xrefs[acc] = UniProtXref(embl, embl_cds, geneid, refseq)
+    else:
+        u_xrefs = {}
+        if xrefpath is not None:
+            u_xrefs = {
+                acc: UniProtXref(*row)
+                for acc, row in get_uniprot_xrefs(
+                    xrefpath, u_accessions, xref_ttl
+                ).items()
+            }
+            logger.info("Found %d UniProt cross-references in cache", len(u_xrefs))
+        u_missing = [acc for acc in u_accessions if acc not in u_xrefs]
+        if u_missing:
+            u_service = UniProt() if http_cache is None else CachedUniProt(http_cache)
+            fetched = uniprot_xrefs(u_missing, u_service)
+            if xrefpath is not None:
+                add_uniprot_xrefs(xrefpath, fetched)
+            u_xrefs.update(fetched)
 
     for record in tqdm(
         records,
         desc="1/5 Process input sequences",
         disable=disabletqdm,
     ):
+        # Duplicates of a protein that has been taken forward are not triaged
+        keys = sequence_keys(record)
+        canonical = find_seq_key(cachepath, keys)
+        if canonical is not None and canonical[0] != record.id:
+            logger.debug("Record %s duplicates %s", record.id, canonical[0])
+            add_seq_alias(cachepath, record.id, *canonical)
+            nduplicates += 1
+            continue
         seqtype = guess_seqtype(record)
         if seqtype == "UniParc":
             logger.warning(
@@ -166,15 +436,13 @@ def process_sequences(
             # Get the UniProt ID from the accession and use this to query the API
             query_acc = record.id.split("|")[1]
             logger.debug(
-                "Querying UniProt with %s to match xref_embl",
+                "Using UniProt cross-references for %s to match xref_embl",
                 query_acc,
             )
             # Use the UniProt record ID as the query to the EMBL ID, retrieving
             # the EMBL record accession, and the ORF gene name
-            # bioservices 1.12 now returns a string without trailing \n if there is
-            # no match, so we need to account for this for each of qstring, pstring,
-            # and gstring
-            qstring, pstring = uniprot_to_embl(query_acc, u_service)
+            xref = u_xrefs[query_acc]
+            qstring, pstring = xref.embl, xref.orf
             if qstring == "":
                 logger.warning(
                     "Uniprot record %s has no EMBL cross-reference",
@@ -184,8 +452,7 @@ def process_sequences(
                 # a fallback. This refers to a gene database record at NCBI, which
                 # then must be queried to get the nucleotide cross-reference.
                 logger.debug("Trying xref_geneid as last resort")
-                gresult = u_service.search(query_acc, columns="xref_geneid")
-                gstring = gresult.split("\n")[1].strip()[:-1] if "\n" in gresult else ""
+                gstring = xref.geneid
 
                 if gstring == "":
                     logger.warning(
@@ -202,6 +469,7 @@ def process_sequences(
                     "acc",
                     "text",
                     10,
+                    fetcher=fetcher,
                 )  # NOTE: hard-coded retry count
                 acc = [
                     _.strip().split()[1]
@@ -219,8 +487,7 @@ def process_sequences(
                 # We also need the xref_refseq entry to get a protein ID for
                 # the query.
                 logger.debug("Finding protein entry from GeneID %s", gstring)
-                presult = u_service.search(gstring, columns="xref_refseq")
-                pstring = presult.split("\n")[1].strip()[:-1]
+                pstring = xref.refseq
                 if pstring == "":
                     logger.warning(
                         "Could not identify RefSeq protein ID for %s (skipping)",
@@ -256,9 +523,15 @@ def process_sequences(
         # If the record has no query terms, skip it
         if has_query(cachepath, record.id):
             kept.append(record)
+            add_seq_keys(cachepath, keys, record.id, record.description)
         else:
             skipped.append(record)
 
+    if nduplicates:
+        logger.info(
+            "%d sequences duplicate another input protein (sharing its CDS)",
+            nduplicates,
+        )
     return kept, skipped
 
 
@@ -409,3 +682,200 @@ def strip_stockholm_from_seqid(seqid: str) -> str:
     seqid        - seqid to strip
     """
     return seqid.split("/")[0]
+
+
+def parse_coded_by(coded_by: str) -> None | Location:
+    """Return location of a GenPept coded_by qualifier, or None.
+
+    coded_by     - coded_by qualifier, e.g. complement(NC_000913.3:5683..6459)
+
+    The returned location keeps the nucleotide accession as the ref
+    attribute of each part. None is returned if the location cannot be
+    parsed, or if it spans more than one nucleotide record (trans-splicing).
+    """
+    logger = logging.getLogger(__name__)
+
+    # Long qualifiers are wrapped in GenPept records, and the parser joins the
+    # wrapped lines with spaces
+    coded_by = "".join(coded_by.split())
+    try:
+        location = Location.fromstring(coded_by)
+    except ValueError:
+        logger.warning("Could not parse coded_by location %s", coded_by)
+        return None
+    if len({part.ref for part in location.parts}) != 1 or location.parts[0].ref is None:
+        logger.warning("coded_by location %s is not on a single record", coded_by)
+        return None
+    return location
+
+
+def build_region_record(
+    seq: Seq,
+    nt_acc: str,
+    offset: int,
+    location: Location,
+    qualifiers: dict,
+) -> SeqRecord:
+    """Return SeqRecord for part of a nucleotide record, with a single CDS.
+
+    :param seq:  nucleotide sequence of the region
+    :param nt_acc:  accession of the nucleotide record the region comes from
+    :param offset:  (zero-based) start of the region on the nucleotide record
+    :param location:  CDS location on the nucleotide record
+    :param qualifiers:  qualifiers for the CDS feature
+
+    The CDS location is moved to the coordinates of the region, so that the
+    returned record can be used in place of the full GenBank record when
+    extracting the CDS.
+    """
+    parts = [
+        SimpleLocation(int(part.start) - offset, int(part.end) - offset, part.strand)
+        for part in location.parts
+    ]
+    cdsloc = parts[0] if len(parts) == 1 else CompoundLocation(parts)
+    record = SeqRecord(
+        seq=seq,
+        id=nt_acc,
+        name=nt_acc.split(".", maxsplit=1)[0],
+        description=f"{nt_acc} region {offset + 1}..{offset + len(seq)}",
+        annotations={"molecule_type": "DNA"},
+    )
+    record.features.append(SeqFeature(cdsloc, type="CDS", qualifiers=qualifiers))
+    return record
+
+
+def parse_feature_table(handle: TextIO) -> dict[str, list[tuple]]:
+    """Return features from an NCBI feature table (EFetch rettype=ft).
+
+    handle       - text stream containing one or more feature tables
+
+    Returns a dictionary keyed by nucleotide accession, whose values are
+    lists of (feature type, intervals, qualifiers) tuples. Intervals are
+    (start, stop) pairs of 1-based positions as given in the table, so that
+    stop < start on the minus strand, and qualifiers is a dictionary of
+    lists of values. Partial-position markers (< and >) are removed.
+    """
+    features = defaultdict(list)
+    accession = None
+    for rawline in handle:
+        line = rawline.rstrip("\n")
+        if not line.strip():
+            continue
+        if line.startswith(">Feature"):
+            # e.g. >Feature ref|NC_000913.3|
+            seqid = line.split(maxsplit=1)[1]
+            accession = [_ for _ in seqid.split("|") if _][-1]
+            continue
+        fields = line.split("\t")
+        if fields[0]:  # New feature, or a further interval of the last one
+            start, stop = [int(_.lstrip("<>")) for _ in fields[:2]]
+            feature_key = (fields[2:3] or [""])[0]
+            if feature_key:
+                features[accession].append((feature_key, [(start, stop)], {}))
+            else:
+                features[accession][-1][1].append((start, stop))
+        else:  # Qualifier line, e.g. \t\t\tprotein_id\tref|NP_414542.1|
+            key, val = [*fields[3:], ""][:2]
+            features[accession][-1][2].setdefault(key, []).append(val)
+    return dict(features)
+
+
+def feature_table_location(intervals: list[tuple[int, int]]) -> str:
+    """Return GenBank-style location string for feature table intervals.
+
+    intervals    - list of (start, stop) 1-based positions, stop < start
+                   on the minus strand
+    """
+    if intervals[0][0] > intervals[0][1]:  # minus strand
+        parts = [f"{stop}..{start}" for start, stop in reversed(intervals)]
+        location = parts[0] if len(parts) == 1 else f"join({','.join(parts)})"
+        return f"complement({location})"
+    parts = [f"{start}..{stop}" for start, stop in intervals]
+    return parts[0] if len(parts) == 1 else f"join({','.join(parts)})"
+
+
+def find_feature_table_cds(
+    features: list[tuple],
+    protein_id: str,
+    locus_tag: None | str,
+) -> None | tuple:
+    """Return the CDS feature for a protein from parsed feature table features.
+
+    features     - list of (feature type, intervals, qualifiers) tuples
+    protein_id   - protein accession to search for in CDS protein_id
+    locus_tag    - locus tag to search for in CDS or gene features
+
+    Protein IDs in feature tables are qualified with the source database
+    (e.g. ref|NP_414542.1|). A match to the protein ID is preferred, but if
+    there is none the CDS within a gene with the passed locus tag is used.
+    """
+    cds_features = [_ for _ in features if _[0] == "CDS"]
+    for feature in cds_features:
+        for val in feature[2].get("protein_id", []):
+            ids = [_ for _ in val.split("|") if _]
+            if protein_id in ids or protein_id in [_.split(".")[0] for _ in ids]:
+                return feature
+    if not locus_tag:
+        return None
+    for feature in features:
+        if locus_tag not in feature[2].get("locus_tag", []):
+            continue
+        if feature[0] == "CDS":
+            return feature
+        # Use the CDS that lies within the span of the gene feature
+        span = sorted(pos for interval in feature[1] for pos in interval)
+        for cds in cds_features:
+            cds_span = sorted(pos for interval in cds[1] for pos in interval)
+            if span[0] <= cds_span[0] and cds_span[-1] <= span[-1]:
+                return cds
+    return None
+
+
+def parse_ipg_report(handle: TextIO) -> dict[str, list[dict[str, str]]]:
+    """Return rows of an NCBI Identical Protein Group report, by protein.
+
+    handle       - text stream of tabular IPG report (EFetch rettype=ipg)
+
+    Returns a dictionary keyed by protein accession, whose values are the
+    rows (as dictionaries keyed by column name) of the IPG that contains
+    that protein, in report order. Each protein in a group maps to the same
+    list of rows.
+    """
+    groups = defaultdict(list)
+    header = None
+    for line in handle:
+        fields = line.rstrip("\n").split("\t")
+        if not line.strip():
+            continue
+        if fields[0] == "Id":  # header line, repeated for each batch
+            header = fields
+            continue
+        row = dict(zip(header, fields))
+        groups[row["Id"]].append(row)
+    return {row["Protein"]: rows for rows in groups.values() for row in rows}
+
+
+def choose_ipg_cds(rows: list[dict[str, str]], policy: str) -> None | dict[str, str]:
+    """Return the representative CDS row from an IPG, or None.
+
+    rows         - IPG report rows, as returned by parse_ipg_report()
+    policy       - one of the keys of IPG_POLICIES
+
+    Only rows with a nucleotide accession and coordinates are considered.
+    Rows are preferred in the order of sources given for the policy, and
+    then in report order.
+    """
+    sources = IPG_POLICIES[policy]
+    candidates = [
+        row
+        for row in rows
+        if row.get("Nucleotide Accession") and row.get("Start") and row.get("Stop")
+    ]
+    if not candidates:
+        return None
+    return min(
+        candidates,
+        key=lambda row: (
+            sources.index(row["Source"]) if row["Source"] in sources else len(sources)
+        ),
+    )
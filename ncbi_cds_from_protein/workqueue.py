@@ -0,0 +1,374 @@
+# (c) The James Hutton Institute 2017-2019
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute for Pharmacy and Biomedical Sciences,
+# Cathedral Street,
+# Glasgow,
+# G1 1XQ
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2017-2019 The James Hutton Institute
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Share batches of input sequences between ncfp worker processes.
+
+The work queue is an SQLite database on a filesystem shared by all workers
+(local disk, or NFS with working POSIX locks), so that no server or message
+broker is needed. Each batch is a range of input sequences, or the final
+merge of all batch outputs, and is in one of three states:
+
+- pending: not yet claimed by a worker
+- claimed: being processed by a worker, which holds a lease on it until an
+  expiry time, renewed while the worker is alive
+- done: processed, with its output committed
+
+A worker claims the first pending batch, or the first claimed batch whose
+lease has expired (because its worker died), in a single write transaction.
+The merge batch can only be claimed once every other batch is done.
+"""
+
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, NamedTuple
+
+from ncbi_cds_from_protein import NCFPException
+
+if TYPE_CHECKING:
+    from pathlib import Path
+    from typing import Self
+
+# Seconds to wait for another worker's write transaction on the queue
+QUEUE_TIMEOUT = 60
+
+# Create work queue tables. The queue describes one input file, split into
+# batches of a fixed size, recorded in queue_meta. Each batch records the
+# index of its first input sequence, and the byte offset of that sequence in
+# the (decompressed) input file, so that workers can seek to it.
+SQL_CREATE_QUEUE = """
+    CREATE TABLE IF NOT EXISTS queue_meta (key TEXT PRIMARY KEY NOT NULL,
+                                           value TEXT NOT NULL
+                                          );
+    CREATE TABLE IF NOT EXISTS queue_batch (batch INTEGER PRIMARY KEY NOT NULL,
+                                            stage TEXT NOT NULL,
+                                            start INTEGER NOT NULL,
+                                            size INTEGER NOT NULL,
+                                            position INTEGER,
+                                            status TEXT NOT NULL,
+                                            worker TEXT,
+                                            expires REAL,
+                                            attempts INTEGER NOT NULL
+                                           );
+"""
+
+# Get a work queue property
+SQL_GET_QUEUE_META = """
+    SELECT value FROM queue_meta WHERE key=?;
+"""
+
+# Set a work queue property, if it is not already set
+SQL_ADD_QUEUE_META = """
+    INSERT OR IGNORE INTO queue_meta (key, value) VALUES (?, ?);
+"""
+
+# Add a batch to the work queue, if it is not already there
+SQL_ADD_BATCH = """
+    INSERT OR IGNORE INTO queue_batch (batch, stage, start, size, position, status,
+                                       attempts)
+           VALUES (?, ?, ?, ?, ?, 'pending', 0);
+"""
+
+# Get the first batch that can be claimed: pending, or with an expired lease.
+# The merge batch can only be claimed when all extract batches are done.
+SQL_GET_CLAIMABLE_BATCH = """
+    SELECT batch, stage, start, size, position, attempts FROM queue_batch
+           WHERE (status='pending' OR (status='claimed' AND expires<?))
+                 AND (stage='extract'
+                      OR NOT EXISTS (SELECT 1 FROM queue_batch
+                                     WHERE stage='extract' AND status!='done'))
+           ORDER BY batch LIMIT 1;
+"""
+
+# Claim a batch for a worker, until the lease expires
+SQL_CLAIM_BATCH = """
+    UPDATE queue_batch SET status='claimed', worker=?, expires=?, attempts=attempts+1
+           WHERE batch=?;
+"""
+
+# Extend the lease on a batch, if the worker still holds it
+SQL_RENEW_LEASE = """
+    UPDATE queue_batch SET expires=?
+           WHERE batch=? AND worker=? AND status='claimed';
+"""
+
+# Mark a batch done, if the worker still holds it
+SQL_COMPLETE_BATCH = """
+    UPDATE queue_batch SET status='done', expires=NULL
+           WHERE batch=? AND worker=? AND status='claimed';
+"""
+
+# Return a batch to the queue, if the worker still holds it
+SQL_RELEASE_BATCH = """
+    UPDATE queue_batch SET status='pending', worker=NULL, expires=NULL
+           WHERE batch=? AND worker=? AND status='claimed';
+"""
+
+# Count batches in each state
+SQL_COUNT_BATCHES = """
+    SELECT status, COUNT(*) FROM queue_batch GROUP BY status;
+"""
+
+# Get all extract batches, in input order
+SQL_GET_EXTRACT_BATCHES = """
+    SELECT batch FROM queue_batch WHERE stage='extract' ORDER BY batch;
+"""
+
+
+class Batch(NamedTuple):
+    """Batch of work claimed from the queue."""
+
+    batch: int
+    stage: str
+    start: int
+    size: int
+    position: None | int
+    attempts: int
+
+
+def connect_queue(queuepath: Path) -> sqlite3.Connection:
+    """Return a connection to the work queue.
+
+    :param queuepath:  path to the work queue database
+
+    Transactions are started explicitly, so that a claim is a single write
+    transaction, serialised between workers by the database lock.
+    """
+    return sqlite3.connect(str(queuepath), timeout=QUEUE_TIMEOUT, isolation_level=None)
+
+
+def initialise_queue(
+    queuepath: Path,
+    digest: str,
+    nrecords: int,
+    batchsize: int,
+    positions: list[int],
+) -> int:
+    """Create the work queue for an input file, if needed, returning its size.
+
+    :param queuepath:  path to the work queue database
+    :param digest:  digest of the input sequences
+    :param nrecords:  number of input sequences
+    :param batchsize:  number of input sequences in each batch
+    :param positions:  byte offset of the first input sequence in each batch
+
+    Every worker calls this with the same input: the first creates the
+    batches, and later workers check that their input matches the queue.
+    Returns the number of extract batches.
+    """
+    meta = {"digest": digest, "nrecords": str(nrecords), "batchsize": str(batchsize)}
+    nbatches = (nrecords + batchsize - 1) // batchsize
+    conn = connect_queue(queuepath)
+    try:
+        conn.executescript(SQL_CREATE_QUEUE)
+        conn.execute("BEGIN IMMEDIATE")
+        for key, value in meta.items():
+            conn.execute(SQL_ADD_QUEUE_META, (key, value))
+            (queued,) = conn.execute(SQL_GET_QUEUE_META, (key,)).fetchone()
+            if queued != value:
+                conn.execute("ROLLBACK")
+                msg = (
+                    f"Work queue {queuepath} has {key} {queued}, not {value}: "
+                    "it was created for a different input or batch size"
+                )
+                raise NCFPException(msg)
+        for batch in range(nbatches):
+            start = batch * batchsize
+            size = min(batchsize, nrecords - start)
+            conn.execute(
+                SQL_ADD_BATCH, (batch, "extract", start, size, positions[batch])
+            )
+        conn.execute(SQL_ADD_BATCH, (nbatches, "merge", nrecords, 0, None))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return nbatches
+
+
+def claim_batch(queuepath: Path, worker: str, ttl: float) -> None | Batch:
+    """Claim the next batch for a worker, returning None if none is claimable.
+
+    :param queuepath:  path to the work queue database
+    :param worker:  name of the worker
+    :param ttl:  seconds until the lease on the batch expires
+    """
+    logger = logging.getLogger(__name__)
+
+    now = time.time()
+    conn = connect_queue(queuepath)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(SQL_GET_CLAIMABLE_BATCH, (now,)).fetchone()
+        if row is not None:
+            conn.execute(SQL_CLAIM_BATCH, (worker, now + ttl, row[0]))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    batch = Batch(*row)
+    if batch.attempts:
+        logger.warning(
+            "Reclaiming batch %d after %d earlier attempts", batch.batch, batch.attempts
+        )
+    return batch
+
+
+def renew_lease(queuepath: Path, batch: int, worker: str, ttl: float) -> bool:
+    """Extend a worker's lease on a batch, returning False if it was lost.
+
+    :param queuepath:  path to the work queue database
+    :param batch:  number of the claimed batch
+    :param worker:  name of the worker
+    :param ttl:  seconds from now until the lease expires
+    """
+    conn = connect_queue(queuepath)
+    try:
+        cur = conn.execute(SQL_RENEW_LEASE, (time.time() + ttl, batch, worker))
+    finally:
+        conn.close()
+    return cur.rowcount == 1
+
+
+def complete_batch(queuepath: Path, batch: int, worker: str) -> bool:
+    """Mark a batch done, returning False if the worker no longer held it.
+
+    :param queuepath:  path to the work queue database
+    :param batch:  number of the claimed batch
+    :param worker:  name of the worker
+    """
+    conn = connect_queue(queuepath)
+    try:
+        cur = conn.execute(SQL_COMPLETE_BATCH, (batch, worker))
+    finally:
+        conn.close()
+    return cur.rowcount == 1
+
+
+def release_batch(queuepath: Path, batch: int, worker: str) -> None:
+    """Return a claimed batch to the queue, for another worker to claim.
+
+    :param queuepath:  path to the work queue database
+    :param batch:  number of the claimed batch
+    :param worker:  name of the worker
+    """
+    conn = connect_queue(queuepath)
+    try:
+        conn.execute(SQL_RELEASE_BATCH, (batch, worker))
+    finally:
+        conn.close()
+
+
+def count_batches(queuepath: Path) -> dict[str, int]:
+    """Return the number of batches in each state.
+
+    :param queuepath:  path to the work queue database
+    """
+    conn = connect_queue(queuepath)
+    try:
+        return dict(conn.execute(SQL_COUNT_BATCHES).fetchall())
+    finally:
+        conn.close()
+
+
+def get_extract_batches(queuepath: Path) -> list[int]:
+    """Return the numbers of all extract batches, in input order.
+
+    :param queuepath:  path to the work queue database
+    """
+    conn = connect_queue(queuepath)
+    try:
+        return [row[0] for row in conn.execute(SQL_GET_EXTRACT_BATCHES)]
+    finally:
+        conn.close()
+
+
+class Lease:
+    """Context manager renewing a worker's lease on a batch while it runs.
+
+    The lease is renewed in a background thread, three times per TTL, so
+    that it expires soon after the worker dies, but not while it is alive.
+    If the lease is lost (another worker reclaimed the batch), lost is set.
+    """
+
+    def __init__(self, queuepath: Path, batch: int, worker: str, ttl: float) -> None:
+        """Instantiate class.
+
+        :param queuepath:  path to the work queue database
+        :param batch:  number of the claimed batch
+        :param worker:  name of the worker
+        :param ttl:  seconds until the lease expires, if not renewed
+        """
+        self.queuepath = queuepath
+        self.batch = batch
+        self.worker = worker
+        self.ttl = ttl
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._renew, name=f"ncfp-lease-{batch}", daemon=True
+        )
+
+    def __enter__(self) -> Self:
+        """Start renewing the lease, until leaving the context."""
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        """Stop renewing the lease."""
+        self._stop.set()
+        self._thread.join()
+
+    def _renew(self) -> None:
+        """Renew the lease until stopped, or until it is lost."""
+        logger = logging.getLogger(__name__)
+
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                held = renew_lease(self.queuepath, self.batch, self.worker, self.ttl)
+            except sqlite3.Error:
+                logger.warning(
+                    "Could not renew lease on batch %d", self.batch, exc_info=True
+                )
+                continue
+            if not held:
+                logger.warning("Lease on batch %d was lost", self.batch)
+                self.lost = True
+                return
@@ -95,7 +95,11 @@ setuptools.setup(
     install_requires=["biopython", "bioservices", "tqdm"],
     python_requires="~=3.5",
     entry_points={
-        "console_scripts": ["ncfp = ncbi_cds_from_protein.scripts.ncfp:run_main"]
+        "console_scripts": [
+            "ncfp = ncbi_cds_from_protein.scripts.ncfp:run_main",
+            "ncfp-index = ncbi_cds_from_protein.scripts.ncfp_index:run_main",
+            "ncfp-merge = ncbi_cds_from_protein.scripts.ncfp_merge:run_main",
+        ]
     },
     classifiers=[
         "Development Status :: 4 - Beta",
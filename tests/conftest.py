@@ -175,3 +175,9 @@ def path_uniprot_stockholm_small_use_proteinid_targets():
 def path_single_cds_targets():
     """Path to targets for records with single CDS sequences."""
     yield TARGETPATH / "single_cds"
+
+
+@pytest.fixture
+def path_gene2accession() -> Path:
+    """Path to small extract of NCBI gene2accession, for link indexes."""
+    return FIXTUREPATH / "indexes" / "gene2accession_small.tsv"
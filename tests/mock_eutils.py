@@ -0,0 +1,449 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Local mock NCBI E-utilities server, for offline load and retry testing.
+
+MockEUtils serves ESearch, ELink, EPost, EFetch and ESummary responses for
+a SyntheticNCBI dataset of protein and nucleotide records, over HTTP on
+localhost. Latency, HTTP 429 (throttling) and 5xx responses, and truncated
+payloads can be injected at configurable rates. ncfp is pointed at the
+server with --eutils_url (or EntrezFetcher(base_url=...)):
+
+    dataset = SyntheticNCBI(100)
+    with MockEUtils(dataset, latency=0.05, error_rate=0.1) as server:
+        dataset.write_fasta(inpath)
+        run_main([str(inpath), str(outdir), email, "--eutils_url", server.url])
+
+Responses to ESummary requests (used by --link_history and
+--max_links_per_protein) can only be parsed once the mock ESummary DTD has
+been installed with install_esummary_dtd().
+
+Each protein XP_<n>.1 is linked to nucleotide UID <n>, accession NT_<n>.1,
+which holds a single CDS for the protein.
+"""
+
+from __future__ import annotations
+
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import parse_qs, urlparse
+
+from Bio.Seq import Seq
+from Bio.SeqFeature import SeqFeature, SimpleLocation
+from Bio.SeqRecord import SeqRecord
+
+if TYPE_CHECKING:
+    from typing import Self
+
+# DOCTYPE declarations for XML responses. These DTDs are distributed with
+# Biopython, except for ESummary. Bio.Entrez will only download DTDs from
+# NCBI, so the ESummary DTD must be installed in its local DTD directory
+# with install_esummary_dtd()
+ELINK_DOCTYPE = (
+    '<!DOCTYPE eLinkResult PUBLIC "-//NLM//DTD elink 20101123//EN" '
+    '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20101123/elink.dtd">'
+)
+EPOST_DOCTYPE = (
+    '<!DOCTYPE ePostResult PUBLIC "-//NLM//DTD epost 20090526//EN" '
+    '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20090526/epost.dtd">'
+)
+ESEARCH_DOCTYPE = (
+    '<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+    '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">'
+)
+ESUMMARY_DTD_NAME = "ncfp_mock_esummary.dtd"
+ESUMMARY_DOCTYPE = (
+    '<!DOCTYPE eSummaryResult PUBLIC "-//NLM//DTD esummary ncfp mock//EN" '
+    f'"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/{ESUMMARY_DTD_NAME}">'
+)
+ESUMMARY_DTD = """<!ELEMENT eSummaryResult (DocumentSummarySet)>
+<!ELEMENT DocumentSummarySet (DbBuild?, DocumentSummary*)>
+<!ATTLIST DocumentSummarySet status CDATA #IMPLIED>
+<!ELEMENT DbBuild (#PCDATA)>
+<!ELEMENT DocumentSummary (Caption?, AccessionVersion?, Slen?, SourceDb?,
+    Completeness?)>
+<!ATTLIST DocumentSummary uid CDATA #IMPLIED>
+<!ELEMENT Caption (#PCDATA)>
+<!ELEMENT AccessionVersion (#PCDATA)>
+<!ELEMENT Slen (#PCDATA)>
+<!ELEMENT SourceDb (#PCDATA)>
+<!ELEMENT Completeness (#PCDATA)>
+"""
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" ?>\n'
+
+# Amino acids and codons used to build synthetic coding sequences
+CODONS = {
+    "A": "GCT",
+    "C": "TGT",
+    "D": "GAT",
+    "E": "GAA",
+    "F": "TTT",
+    "G": "GGT",
+    "H": "CAT",
+    "I": "ATT",
+    "K": "AAA",
+    "L": "CTG",
+    "N": "AAT",
+    "P": "CCG",
+    "Q": "CAG",
+    "R": "CGT",
+    "S": "TCT",
+    "T": "ACC",
+    "V": "GTT",
+    "W": "TGG",
+    "Y": "TAT",
+}
+
+
+def install_esummary_dtd(dtd_dir: str | Path) -> None:
+    """Write the mock ESummary DTD to dtd_dir.
+
+    dtd_dir     - Bio.Entrez local DTD directory (DataHandler.local_dtd_dir)
+    """
+    with (Path(dtd_dir) / ESUMMARY_DTD_NAME).open("w") as ofh:
+        ofh.write(ESUMMARY_DTD)
+
+
+class SyntheticNCBI:
+    """Synthetic NCBI protein and linked nucleotide records."""
+
+    def __init__(
+        self, count: int, protlen: int = 100, flank: int = 60, seed: int = 0
+    ) -> None:
+        """Instantiate class.
+
+        count   - number of proteins (and nucleotide records)
+        protlen - length of each protein, in residues
+        flank   - bases of non-coding sequence either side of each CDS
+        seed    - random seed, so that datasets are reproducible
+        """
+        rng = random.Random(seed)  # noqa: S311 - reproducible test data
+        self.proteins = {}  # protein accession: (UID, protein sequence)
+        self.uids = {}  # nucleotide UID: accession
+        self.genbank = {}  # nucleotide accession: GenBank text
+        for idx in range(1, count + 1):
+            protacc, uid, ntacc = f"XP_{idx:06d}.1", str(idx), f"NT_{idx:06d}.1"
+            protein = "M" + "".join(
+                rng.choice(list(CODONS)) for _ in range(protlen - 1)
+            )
+            cds = "ATG" + "".join(CODONS[aa] for aa in protein[1:]) + "TAA"
+            seq = (
+                "".join(rng.choice("ACGT") for _ in range(flank))
+                + cds
+                + "".join(rng.choice("ACGT") for _ in range(flank))
+            )
+            record = SeqRecord(
+                Seq(seq),
+                id=ntacc,
+                name=ntacc.split(".", maxsplit=1)[0],
+                description=f"Synthetic organism record {idx}, complete sequence",
+                annotations={
+                    "molecule_type": "DNA",
+                    "data_file_division": "SYN",
+                    "date": "01-JAN-2020",
+                    "accessions": [ntacc.split(".", maxsplit=1)[0]],
+                    "organism": "Synthetic organism",
+                    "taxonomy": ["Synthetica"],
+                },
+                features=[
+                    SeqFeature(
+                        SimpleLocation(0, len(seq), strand=1),
+                        type="source",
+                        qualifiers={"organism": ["Synthetic organism"]},
+                    ),
+                    SeqFeature(
+                        SimpleLocation(flank, flank + len(cds), strand=1),
+                        type="CDS",
+                        qualifiers={
+                            "protein_id": [protacc],
+                            "translation": [protein],
+                        },
+                    ),
+                ],
+            )
+            self.proteins[protacc] = (uid, protein)
+            self.uids[uid] = ntacc
+            self.genbank[ntacc] = record.format("gb")
+
+    def write_fasta(self, path: Path) -> None:
+        """Write the proteins to path as NCBI-style FASTA input for ncfp."""
+        with path.open("w") as ofh:
+            for protacc, (_, protein) in self.proteins.items():
+                ofh.write(f">{protacc} synthetic protein [Synthetic organism]\n")
+                ofh.write(f"{protein}\n")
+
+    def accession(self, qid: str) -> str:
+        """Return the nucleotide accession for a UID or accession."""
+        return self.uids.get(qid, qid)
+
+
+class MockEUtilsHandler(BaseHTTPRequestHandler):
+    """Request handler for MockEUtils."""
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        """Do not log requests to stderr."""
+
+    def do_GET(self) -> None:
+        """Respond to a GET request."""
+        url = urlparse(self.path)
+        self.respond(url.path, parse_qs(url.query))
+
+    def do_POST(self) -> None:
+        """Respond to a POST request (sent by Bio.Entrez for long ID lists)."""
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.respond(urlparse(self.path).path, parse_qs(body.decode()))
+
+    def respond(self, path: str, params: dict[str, list[str]]) -> None:
+        """Send the response to a request, injecting failures."""
+        server = self.server.mock
+        service = path.strip("/").split(".")[0]
+        failure = server.request(service)
+        if failure is not None:
+            self.send_error(failure)
+            return
+        try:
+            body, ctype = server.dispatch(service, params)
+        except (KeyError, IndexError, ValueError):
+            self.send_error(400)
+            return
+        if server.truncate():
+            # Declare the full length, but close the connection part way
+            self.send_data(200, body[: len(body) // 2], ctype, length=len(body))
+            self.close_connection = True
+            return
+        self.send_data(200, body, ctype)
+
+    def send_data(
+        self, code: int, body: bytes, ctype: str, length: None | int = None
+    ) -> None:
+        """Send a response body."""
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(length or len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockEUtils:
+    """Mock E-utilities HTTP server, running in a background thread."""
+
+    def __init__(  # noqa: PLR0913 - one rate per failure mode
+        self,
+        dataset: SyntheticNCBI,
+        *,
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        error_rate: float = 0.0,
+        truncate_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        """Instantiate class.
+
+        dataset         - SyntheticNCBI records to serve
+        latency         - delay (seconds) before each response
+        throttle_rate   - fraction of requests answered with HTTP 429
+        error_rate      - fraction of requests answered with HTTP 500/502/503
+        truncate_rate   - fraction of responses cut off part way through
+        seed            - random seed for failure injection
+        """
+        self.dataset = dataset
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.requests = Counter()  # requests received, by E-utility
+        self.failures = Counter()  # injected failures, by HTTP status
+        self._rng = random.Random(seed)  # noqa: S311 - reproducible failures
+        self._lock = threading.Lock()
+        self._histories = []  # History server queries: lists of UIDs
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the running server."""
+        return f"http://127.0.0.1:{self._httpd.server_port}"
+
+    def start(self) -> Self:
+        """Start serving in a background thread."""
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), MockEUtilsHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the server."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> Self:
+        """Start the server on entering the context."""
+        return self.start()
+
+    def __exit__(self, *exc: object) -> None:
+        """Stop the server on leaving the context."""
+        self.stop()
+
+    def request(self, service: str) -> None | int:
+        """Count a request, wait for the latency, and return any failure code."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests[service] += 1
+            draw = self._rng.random()
+            if draw < self.throttle_rate:
+                code = 429
+            elif draw < self.throttle_rate + self.error_rate:
+                code = self._rng.choice((500, 502, 503))
+            else:
+                return None
+            self.failures[code] += 1
+            return code
+
+    def truncate(self) -> bool:
+        """Return True if the current response should be truncated."""
+        with self._lock:
+            truncate = self._rng.random() < self.truncate_rate
+            if truncate:
+                self.failures["truncated"] += 1
+            return truncate
+
+    def add_history(self, uids: list[str]) -> str:
+        """Hold a list of UIDs on the History server, returning its QueryKey."""
+        with self._lock:
+            self._histories.append(list(uids))
+            return str(len(self._histories))
+
+    def query_ids(self, params: dict[str, list[str]]) -> list[str]:
+        """Return the IDs requested with id, or with WebEnv/query_key paging."""
+        if "id" in params:
+            return [qid for value in params["id"] for qid in value.split(",")]
+        uids = self._histories[int(params["query_key"][0]) - 1]
+        start = int(params.get("retstart", ["0"])[0])
+        count = int(params.get("retmax", [str(len(uids))])[0])
+        return uids[start : start + count]
+
+    def dispatch(self, service: str, params: dict[str, list[str]]) -> tuple[bytes, str]:
+        """Return (body, content type) for an E-utility request."""
+        return getattr(self, service)(params)
+
+    def esearch(self, params: dict[str, list[str]]) -> tuple[bytes, str]:
+        """ESearch: nucleotide accessions are found by UID."""
+        term = params["term"][0]
+        ids = [uid for uid, acc in self.dataset.uids.items() if acc == term]
+        idlist = "".join(f"<Id>{uid}</Id>" for uid in ids)
+        body = (
+            f"{XML_HEADER}{ESEARCH_DOCTYPE}\n<eSearchResult><Count>{len(ids)}</Count>"
+            f"<RetMax>{len(ids)}</RetMax><RetStart>0</RetStart>"
+            f"<IdList>{idlist}</IdList><TranslationSet/>"
+            f"<QueryTranslation>{term}</QueryTranslation></eSearchResult>\n"
+        )
+        return body.encode(), "text/xml"
+
+    def elink(self, params: dict[str, list[str]]) -> tuple[bytes, str]:
+        """ELink protein_nuccore: one LinkSet per id parameter."""
+        linksets = []
+        for qid in params["id"]:
+            uids = [self.dataset.proteins[_][0] for _ in qid.split(",")]
+            if params.get("cmd", [""])[0] == "neighbor_history":
+                key = self.add_history(uids)
+                links = (
+                    "<LinkSetDbHistory><DbTo>nuccore</DbTo>"
+                    "<LinkName>protein_nuccore</LinkName>"
+                    f"<QueryKey>{key}</QueryKey></LinkSetDbHistory>"
+                    "<WebEnv>MOCK_WEBENV</WebEnv>"
+                )
+            else:
+                links = (
+                    "<LinkSetDb><DbTo>nuccore</DbTo><LinkName>protein_nuccore</LinkName>"
+                    + "".join(f"<Link><Id>{uid}</Id></Link>" for uid in uids)
+                    + "</LinkSetDb>"
+                )
+            linksets.append(
+                f"<LinkSet><DbFrom>protein</DbFrom><IdList><Id>{qid}</Id></IdList>"
+                f"{links}</LinkSet>"
+            )
+        body = f"{XML_HEADER}{ELINK_DOCTYPE}\n<eLinkResult>{''.join(linksets)}</eLinkResult>\n"
+        return body.encode(), "text/xml"
+
+    def epost(self, params: dict[str, list[str]]) -> tuple[bytes, str]:
+        """EPost: hold the posted IDs as a History query."""
+        key = self.add_history(self.query_ids(params))
+        body = (
+            f"{XML_HEADER}{EPOST_DOCTYPE}\n<ePostResult><QueryKey>{key}</QueryKey>"
+            "<WebEnv>MOCK_WEBENV</WebEnv></ePostResult>\n"
+        )
+        return body.encode(), "text/xml"
+
+    def esummary(self, params: dict[str, list[str]]) -> tuple[bytes, str]:
+        """ESummary (version 2.0) of nucleotide records."""
+        docs = []
+        for uid in self.query_ids(params):
+            acc = self.dataset.accession(uid)
+            slen = self.dataset.genbank[acc].split()[2]
+            docs.append(
+                f'<DocumentSummary uid="{uid}"><Caption>{acc.split(".")[0]}</Caption>'
+                f"<AccessionVersion>{acc}</AccessionVersion><Slen>{slen}</Slen>"
+                "<SourceDb>insd</SourceDb><Completeness>complete</Completeness>"
+                "</DocumentSummary>"
+            )
+        body = (
+            f"{XML_HEADER}{ESUMMARY_DOCTYPE}\n<eSummaryResult>"
+            f'<DocumentSummarySet status="OK">{"".join(docs)}</DocumentSummarySet>'
+            "</eSummaryResult>\n"
+        )
+        return body.encode(), "text/xml"
+
+    def efetch(self, params: dict[str, list[str]]) -> tuple[bytes, str]:
+        """EFetch nucleotide records as accessions, GenBank or FASTA text."""
+        rettype = params["rettype"][0]
+        accs = [self.dataset.accession(qid) for qid in self.query_ids(params)]
+        if rettype == "acc":
+            body = "".join(f"{acc}\n" for acc in accs)
+        elif rettype in ("gb", "gbwithparts"):
+            body = "".join(self.dataset.genbank[acc] for acc in accs)
+        else:
+            msg = f"Unsupported rettype {rettype}"
+            raise ValueError(msg)
+        return body.encode(), "text/plain"
@@ -39,6 +39,7 @@
 """Test command-line parsing for ncfp program"""
 
 import io
+import re
 
 import pytest
 
@@ -101,15 +102,17 @@ def mock_uniprot_download_and_log(monkeypatch):
     Returns the result expected from l125 of sequences.py, for each query of
     the path_uniprot_stockholm_small dataset
 
-    u_service.search(match.group(0), columns="database(EMBL)")  # type: ignore
+    u_service.search("accession:X OR ...", columns=UNIPROT_XREF_COLUMNS)
     """
 
-    def mock_search(*args, **kwargs):
+    def mock_search(_self: UniProt, query: str, **_kwargs: object) -> str:
         """Mock call to UniProt.search() method.
 
         This output specific to the download_and_log() test
         """
-        return "Cross-reference (EMBL)\nCM000618;\n"
+        accessions = re.findall(r"(?<=accession:)[^\s]+", query)
+        rows = [f"{acc}\tCM000618;\t\t\t" for acc in accessions]
+        return "\n".join(["Entry\tEMBL\tORF\tGeneID\tRefSeq", *rows]) + "\n"
 
     monkeypatch.setattr(UniProt, "search", mock_search)
 
@@ -0,0 +1,146 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Test reading compressed input, and writing indexed bgzipped output."""
+
+from __future__ import annotations
+
+import gzip
+import io
+import lzma
+import struct
+from typing import TYPE_CHECKING
+
+import pytest
+from Bio import SeqIO, bgzf
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from ncbi_cds_from_protein.compression import (
+    BgzfFastaWriter,
+    bgzf_block,
+    fasta_positions,
+    open_text_file,
+    open_text_stream,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+FASTA = ">XP_000001.1 protein 1\nMKTAYIAKQR\n>XP_000002.1 protein 2\nMKT\n"
+
+# Empty BGZF block used as the end-of-file marker, from the SAM specification
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def bgzip_bytes(data: bytes) -> bytes:
+    """Return data compressed as BGZF blocks."""
+    return bgzf_block(data[:5]) + bgzf_block(data[5:]) + bgzf_block(b"")
+
+
+@pytest.mark.parametrize(
+    "compress",
+    [lambda data: data, gzip.compress, bgzip_bytes, lzma.compress],
+    ids=["plain", "gzip", "bgzip", "xz"],
+)
+def test_open_text(compress: Callable[[bytes], bytes], tmp_path: Path) -> None:
+    """Compressed input is recognised by magic bytes, in files and streams."""
+    data = compress(FASTA.encode())
+    path = tmp_path / "input"  # no extension, to rely on magic bytes
+    path.write_bytes(data)
+    with open_text_file(path) as instream:
+        assert instream.read() == FASTA
+    # Streams without peek(), such as stdin, are buffered first
+    assert open_text_stream(io.BytesIO(data)).read() == FASTA
+    # Reading can start at the position of any record
+    positions = list(fasta_positions(io.BytesIO(FASTA.encode())))
+    assert positions == [0, 34]
+    with open_text_file(path, positions[1]) as instream:
+        assert instream.read() == FASTA[34:]
+
+
+def test_bgzf_eof() -> None:
+    """The empty BGZF block is the standard end-of-file marker."""
+    assert bgzf_block(b"") == BGZF_EOF
+
+
+def test_bgzf_fasta_writer(tmp_path: Path) -> None:
+    """Records are compressed to BGZF, with valid .fai and .gzi indexes."""
+    records = [
+        SeqRecord(Seq("ACGT" * (idx % 50 + 1)), id=f"NT_{idx:06d}.1", description="")
+        for idx in range(5000)
+    ]
+    path = tmp_path / "ncfp_nt.fasta.gz"
+    with BgzfFastaWriter(path) as writer:
+        for idx, record in enumerate(records):
+            writer.write_record(record)
+            if idx % 1000 == 0:
+                writer.flush()
+
+    # Decompressed output is as SeqIO.write would have written it
+    expected = io.StringIO()
+    SeqIO.write(records, expected, "fasta")
+    with gzip.open(path, "rt") as ifh:
+        text = ifh.read()
+    assert text == expected.getvalue()
+    assert path.read_bytes().endswith(BGZF_EOF)
+
+    # .fai offsets locate each sequence in the uncompressed data
+    with path.with_name(f"{path.name}.fai").open() as ifh:
+        rows = [line.rstrip("\n").split("\t") for line in ifh]
+    assert len(rows) == len(records)
+    for (name, seqlen, seqoffset, linebases, linewidth), record in zip(rows, records):
+        length, offset = int(seqlen), int(seqoffset)
+        assert (name, int(linebases), int(linewidth)) == (
+            record.id,
+            min(length, 60),
+            min(length, 60) + 1,
+        )
+        nlines = -(-length // int(linebases))
+        seq = text[offset : offset + length + nlines].replace("\n", "")
+        assert seq == str(record.seq)
+
+    # .gzi lists every BGZF block but the first, and not the EOF marker
+    with path.open("rb") as ifh:
+        blocks = [(start, size) for start, _, _, size in bgzf.BgzfBlocks(ifh)]
+    with path.with_name(f"{path.name}.gzi").open("rb") as ifh:
+        (count,) = struct.unpack("<Q", ifh.read(8))
+        gzidx = [struct.unpack("<QQ", ifh.read(16)) for _ in range(count)]
+    uoffsets = [sum(size for _, size in blocks[:idx]) for idx in range(len(blocks))]
+    expected_gzidx = list(zip([start for start, _ in blocks], uoffsets))[1:-1]
+    assert count > 1
+    assert gzidx == expected_gzidx
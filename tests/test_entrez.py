@@ -0,0 +1,580 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Test Entrez stage functions offline, with mocked NCBI responses."""
+
+from __future__ import annotations
+
+import io
+import threading
+import time
+from argparse import Namespace
+from typing import TYPE_CHECKING, Any, NoReturn
+
+import pytest
+from Bio import Entrez
+from Bio.Seq import Seq
+from Bio.SeqFeature import SeqFeature, SimpleLocation
+from Bio.SeqRecord import SeqRecord
+
+from ncbi_cds_from_protein import NCFPException
+from ncbi_cds_from_protein.caches import (
+    add_input_sequence,
+    add_ncbi_uids,
+    get_fetch_checkpoint,
+    get_nogbhead_nt_uids,
+    get_nt_noacc_uids,
+    get_nt_uids,
+    has_gbregion,
+    has_ncbi_uid,
+    initialise_dbcache,
+    set_fetch_checkpoint,
+    update_nt_uid_acc,
+)
+from ncbi_cds_from_protein.entrez import (
+    efetch_pages_with_retries,
+    fetch_coded_by_regions,
+    fetch_gb_headers,
+    search_nt_ids,
+    search_nt_ids_history,
+)
+from ncbi_cds_from_protein.fetchers import (
+    EntrezFetcher,
+    RateLimiter,
+    SingleFlightFetcher,
+    get_fetcher,
+)
+from ncbi_cds_from_protein.scripts.ncfp import extract_cds_features
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+    from pathlib import Path
+
+# Synthetic nucleotide record, and a CDS on its minus strand with an intron
+NT_SEQ = Seq("ATGAAACCCGGGTTTAAACCCGGGTTTCATTTAAAGGGCCCAAAGGGTTTCCCAATGCCCTAG")
+CODED_BY = "complement(join(NT_000001.1:4..15,NT_000001.1:25..45))"
+CDS_SEQ = (NT_SEQ[3:15] + NT_SEQ[24:45]).reverse_complement()
+
+
+def epost_result(key: str) -> io.BytesIO:
+    """Return EPost XML response with the passed query key."""
+    return io.BytesIO(
+        b'<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE ePostResult '
+        b'PUBLIC "-//NLM//DTD epost 20090526//EN" '
+        b'"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20090526/epost.dtd">\n'
+        b"<ePostResult>\n\t<QueryKey>" + key.encode() + b"</QueryKey>\n"
+        b"\t<WebEnv>MOCK_WEBENV</WebEnv>\n</ePostResult>\n"
+    )
+
+
+@pytest.fixture
+def cachepath(tmp_path: Path) -> Path:
+    """Path to a new, empty, local cache."""
+    path = tmp_path / "ncfpcache_test.sqlite3"
+    initialise_dbcache(path)
+    return path
+
+
+@pytest.fixture
+def mock_entrez_paging(
+    monkeypatch: pytest.MonkeyPatch,
+) -> list[tuple[list[str], int, int]]:
+    """Mock EPost/EFetch so that each fetched page reports the IDs it covers.
+
+    Returns a list that records (posted IDs, retstart, retmax) for each EFetch.
+    """
+    posts, calls = {}, []
+
+    def mock_epost(**kwargs: str) -> io.BytesIO:
+        """Record posted IDs against a new query key."""
+        key = str(len(posts) + 1)
+        posts[key] = kwargs["id"].split(",")
+        return epost_result(key)
+
+    def mock_efetch(**kwargs: Any) -> io.StringIO:
+        """Return the IDs in the requested page of the posted history."""
+        qids = posts[kwargs["query_key"]]
+        start, count = kwargs["retstart"], kwargs["retmax"]
+        calls.append((qids, start, count))
+        return io.StringIO("\n".join(qids[start : start + count]))
+
+    monkeypatch.setattr(Entrez, "epost", mock_epost)
+    monkeypatch.setattr(Entrez, "efetch", mock_efetch)
+    return calls
+
+
+class DocSum(dict):
+    """ESummary document, with the UID attribute set by Entrez.read()."""
+
+    def __init__(self, uid: str, **fields: str) -> None:
+        """Instantiate document summary, with AccessionVersion from the UID."""
+        super().__init__(AccessionVersion=f"NT_{uid}.1", **fields)
+        self.attributes = {"uid": uid}
+
+
+@pytest.fixture
+def mock_entrez_links(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Mock ELink and ESummary for a protein linked to five nucleotide records.
+
+    Entrez.read() is mocked to return the already-parsed mock responses.
+    """
+    docsums = [
+        DocSum("1", Slen="5000", SourceDb="insd", Completeness="complete"),
+        DocSum("2", Slen="900", SourceDb="insd", Completeness="partial"),
+        DocSum("3", Slen="2000", SourceDb="insd", Completeness=""),
+        DocSum("4", Slen="2000", SourceDb="refseq", Completeness="complete"),
+        DocSum("5", Slen="8000", SourceDb="refseq", Completeness="complete"),
+    ]
+    links = [
+        {"LinkSetDb": [{"Link": [{"Id": doc.attributes["uid"]} for doc in docsums]}]}
+    ]
+
+    monkeypatch.setattr(Entrez, "read", lambda handle: handle)
+    monkeypatch.setattr(Entrez, "elink", lambda **_kwargs: links)
+    monkeypatch.setattr(
+        Entrez,
+        "esummary",
+        lambda **_kwargs: {"DocumentSummarySet": {"DocumentSummary": docsums}},
+    )
+
+
+@pytest.fixture
+def mock_entrez_link_history(monkeypatch: pytest.MonkeyPatch) -> list[list[str]]:
+    """Mock batched ELink history, and ESummary/EFetch from the history.
+
+    The first protein query is linked to two nucleotide records, and the
+    second to none. LinkSets are returned out of order, identified by
+    protein UID. Returns a list that records the IDs passed to ELink.
+    """
+    ntrecords = [
+        SeqRecord(
+            NT_SEQ,
+            id=f"NT_{uid}.1",
+            name=f"NT_{uid}",
+            description="synthetic nucleotide",
+            annotations={
+                "molecule_type": "DNA",
+                "organism": "Synthetic organism",
+                "taxonomy": ["Bacteria"],
+                "date": "01-JAN-2020",
+            },
+        )
+        for uid in ("1", "2")
+    ]
+    docsums = [DocSum(uid, Slen=str(len(NT_SEQ))) for uid in ("1", "2")]
+    aadocsums = [DocSum(uid) for uid in ("101", "102")]
+    for idx, docsum in enumerate(aadocsums, 1):
+        docsum["AccessionVersion"] = f"XP_00000{idx}.1"
+    elinks = []
+
+    def mock_elink(**kwargs: Any) -> list[dict[str, Any]]:
+        """Return one LinkSet per query ID, with a History query if linked."""
+        elinks.append(kwargs["id"])
+        return [
+            {"IdList": ["102"], "WebEnv": "MOCK_WEBENV"},
+            {
+                "IdList": ["101"],
+                "WebEnv": "MOCK_WEBENV",
+                "LinkSetDbHistory": [{"QueryKey": "1"}],
+            },
+        ]
+
+    def mock_esummary(**kwargs: Any) -> dict[str, dict[str, list[DocSum]]]:
+        """Return protein summaries, or a page of summaries of the History query."""
+        if kwargs["db"] == "protein":
+            return {"DocumentSummarySet": {"DocumentSummary": aadocsums}}
+        start, count = kwargs["retstart"], kwargs["retmax"]
+        return {
+            "DocumentSummarySet": {"DocumentSummary": docsums[start : start + count]}
+        }
+
+    def mock_efetch(**kwargs: Any) -> io.StringIO:
+        """Return a page of GenBank records from the History query."""
+        start, count = kwargs["retstart"], kwargs["retmax"]
+        return io.StringIO(
+            "".join(rec.format("gb") for rec in ntrecords[start : start + count])
+        )
+
+    monkeypatch.setattr(Entrez, "read", lambda handle: handle)
+    monkeypatch.setattr(Entrez, "elink", mock_elink)
+    monkeypatch.setattr(Entrez, "esummary", mock_esummary)
+    monkeypatch.setattr(Entrez, "efetch", mock_efetch)
+    return elinks
+
+
+@pytest.fixture
+def mock_entrez_coded_by(monkeypatch: pytest.MonkeyPatch) -> list[tuple[int, int]]:
+    """Mock EPost/EFetch of a GenPept record, and of a nucleotide region.
+
+    Returns a list that records the (seq_start, seq_stop) of region EFetches.
+    """
+    gprecord = SeqRecord(
+        CDS_SEQ.translate(),
+        id="XP_000001.1",
+        name="XP_000001",
+        description="synthetic protein",
+        annotations={"molecule_type": "protein"},
+    )
+    gprecord.features.append(
+        SeqFeature(
+            SimpleLocation(0, len(gprecord)),
+            type="CDS",
+            qualifiers={"locus_tag": ["SYN_0001"], "coded_by": [CODED_BY]},
+        )
+    )
+    regions = []
+
+    def mock_efetch(**kwargs: Any) -> io.StringIO:
+        """Return GenPept record for protein history, or nucleotide region."""
+        if kwargs["db"] == "protein":
+            return io.StringIO(gprecord.format("gb"))
+        regions.append((kwargs["seq_start"], kwargs["seq_stop"]))
+        region = NT_SEQ[kwargs["seq_start"] - 1 : kwargs["seq_stop"]]
+        return io.StringIO(f">{kwargs['id']}\n{region}\n")
+
+    monkeypatch.setattr(Entrez, "epost", lambda **_kwargs: epost_result("1"))
+    monkeypatch.setattr(Entrez, "efetch", mock_efetch)
+    return regions
+
+
+def test_efetch_pages(
+    cachepath: Path, mock_entrez_paging: list[tuple[list[str], int, int]]
+) -> None:
+    """Paged EFetch covers every ID once, across multiple EPost histories."""
+    qids = [f"uid{idx}" for idx in range(7)]
+    pages = efetch_pages_with_retries(
+        cachepath, "test", qids, "nucleotide", "fasta", "text", 1, 2, 4
+    )
+    fetched = [line for page in pages for line in page.read().split()]
+
+    assert fetched == qids
+    assert [(start, count) for _, start, count in mock_entrez_paging] == [
+        (0, 2),
+        (2, 2),
+        (0, 2),
+        (2, 1),
+    ]
+    assert get_fetch_checkpoint(cachepath, "test") is None
+
+
+@pytest.mark.usefixtures("mock_entrez_paging")
+def test_efetch_pages_resume(cachepath: Path) -> None:
+    """Interrupted paged EFetch resumes from the last committed page."""
+    qids = [f"uid{idx}" for idx in range(5)]
+    pages = efetch_pages_with_retries(
+        cachepath, "test", qids, "nucleotide", "fasta", "text", 1, 2, 10
+    )
+    # Consume two pages, then abandon the stage as if it had been interrupted
+    next(pages)
+    next(pages)
+    pages.close()
+    assert get_fetch_checkpoint(cachepath, "test") == (qids, 2)
+
+    # The checkpoint is resumed with the IDs it recorded
+    pages = efetch_pages_with_retries(
+        cachepath, "test", qids, "nucleotide", "fasta", "text", 1, 2, 10
+    )
+    fetched = [line for page in pages for line in page.read().split()]
+
+    assert fetched == qids[2:]
+    assert get_fetch_checkpoint(cachepath, "test") is None
+
+
+@pytest.mark.usefixtures("mock_entrez_paging")
+def test_efetch_pages_checkpoint_mismatch(cachepath: Path) -> None:
+    """A checkpoint for different IDs is discarded, and the fetch restarts."""
+    set_fetch_checkpoint(cachepath, "test", ["uid0", "uid1", "uid2"], 2)
+    qids = [f"uid{idx}" for idx in range(5, 8)]
+    pages = efetch_pages_with_retries(
+        cachepath, "test", qids, "nucleotide", "fasta", "text", 1, 2, 10
+    )
+    fetched = [line for page in pages for line in page.read().split()]
+
+    assert fetched == qids
+    assert get_fetch_checkpoint(cachepath, "test") is None
+
+
+def test_fetch_gb_headers_resume(
+    cachepath: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """An interrupted GenBank header stage resumes from its committed page."""
+    uids = [f"uid{idx}" for idx in range(5)]
+    add_input_sequence(cachepath, "XP_000001.1", "XP_000001.1", None)
+    add_ncbi_uids(cachepath, "XP_000001.1", uids)
+    for idx, uid in enumerate(uids):
+        update_nt_uid_acc(cachepath, uid, f"NT_00000{idx}.1")
+    posts, calls, interrupted = {}, [], []
+
+    def mock_epost(**kwargs: str) -> io.BytesIO:
+        """Record posted IDs against a new query key."""
+        key = str(len(posts) + 1)
+        posts[key] = kwargs["id"].split(",")
+        return epost_result(key)
+
+    def mock_efetch(**kwargs: Any) -> io.StringIO:
+        """Return GenBank headers for the requested page, failing once on the second."""
+        qids = posts[kwargs["query_key"]]
+        start, count = kwargs["retstart"], kwargs["retmax"]
+        calls.append((qids, start))
+        if start > 0 and not interrupted:
+            interrupted.append(start)
+            raise KeyboardInterrupt
+        records = [
+            SeqRecord(
+                Seq("ATG"),
+                id=f"NT_00000{uid[3:]}.1",
+                name=f"NT_00000{uid[3:]}",
+                annotations={
+                    "molecule_type": "DNA",
+                    "organism": "Synthetic",
+                    "taxonomy": ["Synthetic"],
+                    "date": "01-JAN-2000",
+                },
+            )
+            for uid in qids[start : start + count]
+        ]
+        return io.StringIO("".join(record.format("gb") for record in records))
+
+    monkeypatch.setattr(Entrez, "epost", mock_epost)
+    monkeypatch.setattr(Entrez, "efetch", mock_efetch)
+    with pytest.raises(KeyboardInterrupt):
+        fetch_gb_headers(cachepath, 1, 2, postsize=10)
+    posted = calls[0][0]
+    assert get_fetch_checkpoint(cachepath, "gb_headers") == (posted, 2)
+    assert len(get_nogbhead_nt_uids(cachepath)) == len(uids) - 2
+
+    # The rerun posts the recorded IDs, and starts at the committed page
+    calls.clear()
+    addedrows, failcount = fetch_gb_headers(cachepath, 1, 2, postsize=10)
+    assert calls == [(posted, 2), (posted, 4)]
+    assert len(addedrows) == len(uids) - 2
+    assert failcount == 0
+    assert get_nogbhead_nt_uids(cachepath) == []
+    assert get_fetch_checkpoint(cachepath, "gb_headers") is None
+
+
+class PagingFetcher(EntrezFetcher):
+    """Fetcher serving posted IDs back as EFetch pages, without Bio.Entrez."""
+
+    name = "paging"
+
+    def __init__(self) -> None:
+        """Instantiate fetcher, with no posted IDs."""
+        self.posts = []
+
+    def post(self, db: str, ids: Sequence[str]) -> dict[str, Any]:  # noqa: ARG002
+        """Hold the posted IDs as a new History query."""
+        self.posts.append(list(ids))
+        return {"WebEnv": "MOCK_WEBENV", "QueryKey": str(len(self.posts))}
+
+    def fetch(self, db: str, rettype: str, retmode: str, **params: Any) -> str:  # noqa: ARG002
+        """Return the requested page of a posted History query."""
+        qids = self.posts[int(params["query_key"]) - 1]
+        start, count = params["retstart"], params["retmax"]
+        return "\n".join(qids[start : start + count])
+
+
+def test_fetcher_backend(cachepath: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Stage helpers make their requests through the passed fetcher."""
+
+    def no_entrez(*_args: object, **_kwargs: object) -> NoReturn:
+        msg = "Bio.Entrez should not be called"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr(Entrez, "epost", no_entrez)
+    monkeypatch.setattr(Entrez, "efetch", no_entrez)
+
+    fetcher = PagingFetcher()
+    qids = [f"uid{idx}" for idx in range(5)]
+    pages = efetch_pages_with_retries(
+        cachepath, "test", qids, "nucleotide", "fasta", "text", 1, 2, 4, fetcher=fetcher
+    )
+    fetched = [line for page in pages for line in page.read().split()]
+
+    assert fetched == qids
+    assert fetcher.posts == [qids[:4], qids[4:]]
+
+
+def test_get_fetcher() -> None:
+    """Fetchers are looked up by name, and unknown names are rejected."""
+    assert isinstance(get_fetcher("entrez"), EntrezFetcher)
+    with pytest.raises(NCFPException):
+        get_fetcher("nonexistent")
+
+
+def test_base_url_requests(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Requests to a base URL carry Entrez settings, with ELink IDs repeated."""
+    monkeypatch.setattr(Entrez, "email", "ncfptest@dev.null")
+    fetcher = EntrezFetcher(base_url="http://localhost/eutils/")
+
+    request = fetcher.build_request(
+        "elink", {"dbfrom": "protein", "id": ["P1", "P2"], "cmd": None}
+    )
+    assert request.get_method() == "GET"
+    assert request.full_url.startswith("http://localhost/eutils/elink.fcgi?")
+    assert "email=ncfptest%40dev.null" in request.full_url
+    assert "id=P1&id=P2" in request.full_url
+    assert "cmd" not in request.full_url
+
+    request = fetcher.build_request("epost", {"db": "protein", "id": ["P1", "P2"]})
+    assert request.get_method() == "POST"
+    assert b"id=P1%2CP2" in request.data
+
+    with pytest.raises(NCFPException):
+        EntrezFetcher(base_url="file:///etc/eutils")
+
+
+def test_rate_limiter(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Requests from concurrent threads are spaced out to the Entrez limit."""
+    monkeypatch.setattr(Entrez, "api_key", "MOCK_API_KEY")
+    limiter = RateLimiter()
+    times = []
+
+    def send() -> None:
+        limiter.wait()
+        times.append(time.monotonic())
+
+    threads = [threading.Thread(target=send) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    times.sort()
+    gaps = [times[idx + 1] - times[idx] for idx in range(len(times) - 1)]
+    assert min(gaps) > 0.09  # 10 requests/s with an API key
+
+
+def test_single_flight() -> None:
+    """Concurrent identical EFetches are sent once, and share the result."""
+    release = threading.Event()
+    requests = []
+
+    class SlowFetcher(EntrezFetcher):
+        def fetch(self, db: str, rettype: str, retmode: str, **params: Any) -> str:  # noqa: ARG002
+            requests.append(params["id"])
+            release.wait(5)
+            return f">{params['id']}\nACGT\n"
+
+    fetcher = SingleFlightFetcher(SlowFetcher())
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda qid=qid: results.append(
+                fetcher.fetch("nucleotide", "fasta", "text", id=qid, seq_start=None)
+            )
+        )
+        for qid in ["NT_1", "NT_1", "NT_1", "NT_2"]
+    ]
+    for thread in threads:
+        thread.start()
+    # Wait until the duplicate requests are waiting on the in-flight request
+    for _ in range(400):
+        if sum(fetcher.flight.hits.values()) == 2:
+            break
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(requests) == ["NT_1", "NT_2"]
+    assert sorted(results) == [">NT_1\nACGT\n"] * 3 + [">NT_2\nACGT\n"]
+    assert fetcher.flight.hits["efetch"] == 2
+    assert fetcher.flight.calls["efetch"] == 2
+
+
+@pytest.mark.usefixtures("mock_entrez_links")
+def test_max_links(cachepath: Path) -> None:
+    """Only the top-ranked linked UIDs are cached, with their accessions."""
+    record = SeqRecord(Seq("M"), id="XP_000001.1", description="")
+    add_input_sequence(cachepath, record.id, record.id, None)
+
+    search_nt_ids([record], cachepath, 1, max_links=2)
+
+    # Shorter records first, RefSeq breaking ties, and partial records last
+    assert sorted(get_nt_uids(cachepath)) == ["3", "4"]
+    assert get_nt_noacc_uids(cachepath) == []
+
+
+def test_link_history(
+    cachepath: Path, mock_entrez_link_history: list[list[str]]
+) -> None:
+    """Batched ELink history populates UIDs, accessions and GenBank headers."""
+    records = [
+        SeqRecord(Seq("M"), id=seqid, description="")
+        for seqid in ("XP_000001.1/1-10", "XP_000001.1/20-30", "XP_000002.1")
+    ]
+    for record in records:
+        add_input_sequence(cachepath, record.id, record.id, None)
+
+    addedrows, noresult = search_nt_ids_history(records, cachepath, 1, 100)
+
+    # Both domains of the first protein get its links, matched by protein UID
+    assert mock_entrez_link_history == [["XP_000001.1", "XP_000002.1"]]
+    assert (len(addedrows), noresult) == (2, 1)
+    assert [has_ncbi_uid(cachepath, record.id) for record in records] == [
+        True,
+        True,
+        False,
+    ]
+    assert sorted(get_nt_uids(cachepath)) == ["1", "2"]
+    assert get_nt_noacc_uids(cachepath) == []
+    assert get_nogbhead_nt_uids(cachepath) == []
+
+
+def test_coded_by_regions(
+    cachepath: Path, mock_entrez_coded_by: list[tuple[int, int]]
+) -> None:
+    """GenPept coded_by regions are cached, and yield the correct CDS."""
+    record = SeqRecord(CDS_SEQ.translate(), id="XP_000001.1", description="")
+    add_input_sequence(cachepath, record.id, record.id, None)
+
+    addedrows, countfail = fetch_coded_by_regions([record], cachepath, 1, 100)
+
+    assert (len(addedrows), countfail) == (1, 0)
+    assert has_gbregion(cachepath, record.id)
+    # Only the span of the joined location is fetched
+    assert mock_entrez_coded_by == [(4, 45)]
+
+    args = Namespace(
+        stockholm=False,
+        unify_seqid=False,
+        use_protein_ids=False,
+        alternative_start_codon=False,
+    )
+    ((_, ntrecord),) = extract_cds_features([record], cachepath, args)
+    assert ntrecord.id == "SYN_0001"
+    assert ntrecord.seq == CDS_SEQ
@@ -0,0 +1,184 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Test recording and replay of E-utility and UniProt responses."""
+
+from __future__ import annotations
+
+import io
+from typing import TYPE_CHECKING, Any, NoReturn
+
+import pytest
+from Bio import Entrez
+
+from ncbi_cds_from_protein.caches import initialise_dbcache
+from ncbi_cds_from_protein.entrez import efetch_batches_with_retries
+from ncbi_cds_from_protein.fetchers import EntrezFetcher
+from ncbi_cds_from_protein.httpcache import (
+    CachedUniProt,
+    NCFPCacheMissException,
+    ResponseCache,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def epost_result(key: str) -> io.BytesIO:
+    """Return EPost XML response with the passed query key."""
+    return io.BytesIO(
+        b'<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE ePostResult '
+        b'PUBLIC "-//NLM//DTD epost 20090526//EN" '
+        b'"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20090526/epost.dtd">\n'
+        b"<ePostResult>\n\t<QueryKey>" + key.encode() + b"</QueryKey>\n"
+        b"\t<WebEnv>MOCK_WEBENV</WebEnv>\n</ePostResult>\n"
+    )
+
+
+@pytest.fixture
+def mock_entrez_network(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """Mock EPost/EFetch, counting the requests made.
+
+    Each fetched history returns its IDs, one per line.
+    """
+    posts, calls = {}, []
+
+    def mock_epost(**kwargs: str) -> io.BytesIO:
+        """Record posted IDs against a new query key."""
+        calls.append("epost")
+        key = str(len(posts) + 1)
+        posts[key] = kwargs["id"].split(",")
+        return epost_result(key)
+
+    def mock_efetch(**kwargs: Any) -> io.StringIO:
+        """Return the IDs in the posted history."""
+        calls.append("efetch")
+        return io.StringIO("\n".join(posts[kwargs["query_key"]]))
+
+    monkeypatch.setattr(Entrez, "epost", mock_epost)
+    monkeypatch.setattr(Entrez, "efetch", mock_efetch)
+    return calls
+
+
+def test_response_cache_modes(tmp_path: Path) -> None:
+    """Responses are stored and returned according to the cache mode."""
+    params = {"db": "nucleotide", "id": ["1", "2"], "retmax": None}
+    cache = ResponseCache(tmp_path, "read-through")
+    assert cache.fetch("test", params, lambda: "first") == b"first"
+    assert cache.fetch("test", params, lambda: "second") == b"first"
+    # Parameters with no value are not part of the key
+    assert cache.key("test", params) == cache.key(
+        "test", {"id": [1, 2], "db": "nucleotide"}
+    )
+
+    cache = ResponseCache(tmp_path, "record")
+    assert cache.fetch("test", params, lambda: "second") == b"second"
+
+    cache = ResponseCache(tmp_path, "replay")
+    assert cache.fetch("test", params, lambda: "third") == b"second"
+    with pytest.raises(NCFPCacheMissException):
+        cache.fetch("test", {"db": "protein"}, lambda: "third")
+    assert (cache.hits, cache.requests) == (1, 0)
+
+
+def test_response_cache_parse(tmp_path: Path) -> None:
+    """Responses that do not parse are not cached, and are requested again."""
+    cache = ResponseCache(tmp_path, "read-through")
+
+    def parse(data: bytes) -> str:
+        if data.startswith(b"<"):
+            msg = "error page"
+            raise ValueError(msg)
+        return data.decode()
+
+    with pytest.raises(ValueError, match="error page"):
+        cache.fetch("test", {"id": "1"}, lambda: "<html>", parse=parse)
+    assert cache.fetch("test", {"id": "1"}, lambda: "LOCUS", parse=parse) == "LOCUS"
+    assert cache.fetch("test", {"id": "1"}, lambda: "<html>", parse=parse) == "LOCUS"
+    assert (cache.hits, cache.requests) == (1, 2)
+
+
+def test_entrez_history_not_cached(
+    tmp_path: Path, mock_entrez_network: list[str]
+) -> None:
+    """EPost responses are not cached in read-through mode."""
+    fetcher = EntrezFetcher(http_cache=ResponseCache(tmp_path, "read-through"))
+    assert fetcher.post("nucleotide", ["uid1"])["QueryKey"] == "1"
+    assert fetcher.post("nucleotide", ["uid1"])["QueryKey"] == "2"
+    assert mock_entrez_network == ["epost"] * 2
+    assert not list(tmp_path.iterdir())
+
+
+def test_entrez_replay(tmp_path: Path, mock_entrez_network: list[str]) -> None:
+    """A rerun in replay mode makes no E-utility requests."""
+    cachepath = tmp_path / "ncfpcache.sqlite3"
+    initialise_dbcache(cachepath)
+    qids = [f"uid{idx}" for idx in range(5)]
+
+    def run(mode: str) -> list[str]:
+        fetcher = EntrezFetcher(http_cache=ResponseCache(tmp_path / "http", mode))
+        handles = efetch_batches_with_retries(
+            qids, "nucleotide", "fasta", "text", 1, 2, fetcher=fetcher
+        )
+        return [line for handle in handles for line in handle.read().split()]
+
+    assert run("record") == qids
+    assert mock_entrez_network == ["epost"] * 3 + ["efetch"] * 3
+    assert run("replay") == qids
+    assert len(mock_entrez_network) == 6
+
+
+def test_uniprot_replay(tmp_path: Path) -> None:
+    """Cached UniProt searches do not create a UniProt service."""
+    cache = ResponseCache(tmp_path, "read-through")
+    searches = []
+
+    class MockUniProt:
+        def search(self, query: str, **_kwargs: object) -> str:
+            searches.append(query)
+            return "Entry\tEMBL\nP00001\tABC00001.1;"
+
+    assert (
+        CachedUniProt(cache, MockUniProt).search("accession:P00001").startswith("Entry")
+    )
+
+    def no_service() -> NoReturn:
+        msg = "UniProt service created for cached response"
+        raise AssertionError(msg)
+
+    result = CachedUniProt(cache, no_service).search("accession:P00001")
+    assert result == "Entry\tEMBL\nP00001\tABC00001.1;"
+    assert searches == ["accession:P00001"]
@@ -0,0 +1,350 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Test building and querying offline identifier indexes."""
+
+from __future__ import annotations
+
+import gzip
+import logging
+import os
+import random
+import time
+from argparse import Namespace
+from typing import TYPE_CHECKING, Any, NoReturn
+
+import pytest
+from Bio import Entrez, SeqIO, bgzf
+from Bio.Seq import Seq
+from Bio.SeqFeature import SeqFeature, SimpleLocation
+from Bio.SeqRecord import SeqRecord
+
+from ncbi_cds_from_protein import NCFPException, sequences
+from ncbi_cds_from_protein.caches import (
+    add_input_sequence,
+    add_ncbi_uids,
+    find_record_cds,
+    get_aa_query,
+    get_nogbhead_nt_uids,
+    get_nt_noacc_uids,
+    get_nt_uids,
+    initialise_dbcache,
+    update_nt_uid_acc,
+)
+from ncbi_cds_from_protein.entrez import (
+    fetch_gb_headers,
+    fetch_shortest_genbank,
+    search_nt_ids_index,
+)
+from ncbi_cds_from_protein.indexes import (
+    SQL_ADD_LINK_INDEX,
+    SQL_CREATE_LINK_INDEX,
+    build_index,
+    get_link_index_accessions,
+    get_uniprot_index_xrefs,
+    open_local_genbank,
+)
+from ncbi_cds_from_protein.scripts import ncfp, ncfp_index
+from ncbi_cds_from_protein.sequences import process_sequences
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from pathlib import Path
+
+
+def idmapping_line(
+    acc: str, geneid: str = "", refseq: str = "", embl: str = "", embl_cds: str = ""
+) -> str:
+    """Return a 22-column idmapping_selected.tab line."""
+    fields = [""] * 22
+    fields[0], fields[1] = acc, f"{acc}_SYN"
+    fields[2], fields[3], fields[16], fields[17] = geneid, refseq, embl, embl_cds
+    return "\t".join(fields) + "\n"
+
+
+@pytest.fixture
+def path_idmapping(tmp_path: Path) -> Path:
+    """Path to a small gzipped idmapping_selected.tab file."""
+    path = tmp_path / "idmapping_selected.tab.gz"
+    with gzip.open(path, "wt") as ofh:
+        ofh.write(
+            idmapping_line("P00001", embl="AB000001; AB000002", embl_cds="BAA00001.1")
+        )
+        ofh.write(idmapping_line("P00002", geneid="100", refseq="NP_000002.1"))
+        ofh.write(idmapping_line("P00003"))  # no cross-references
+    return path
+
+
+@pytest.fixture
+def path_uniprot_index(path_idmapping: Path, tmp_path: Path) -> Path:
+    """Path to UniProt index built with ncfp-index uniprot."""
+    path = tmp_path / "uniprot.idx"
+    ncfp_index.run_main(["uniprot", path_idmapping, path, "--batchsize", 2])
+    return path
+
+
+@pytest.fixture
+def path_link_index(path_gene2accession: Path, tmp_path: Path) -> Path:
+    """Path to link index built with ncfp-index links."""
+    path = tmp_path / "links.idx"
+    ncfp_index.run_main(["links", path_gene2accession, path])
+    return path
+
+
+def genbank_records(accessions: Iterable[str]) -> list[SeqRecord]:
+    """Return synthetic nucleotide SeqRecords with the passed accessions."""
+    return [
+        SeqRecord(
+            Seq("ATG" * (idx + 10)),
+            id=acc,
+            name=acc.split(".")[0],
+            description="synthetic nucleotide",
+            annotations={
+                "molecule_type": "DNA",
+                "organism": "Synthetic organism",
+                "taxonomy": ["Bacteria"],
+                "date": "01-JAN-2020",
+            },
+        )
+        for idx, acc in enumerate(accessions)
+    ]
+
+
+@pytest.fixture
+def path_local_genbank(tmp_path: Path) -> Path:
+    """Path to directory of bgzipped and uncompressed GenBank files."""
+    path = tmp_path / "genbank"
+    (path / "division").mkdir(parents=True)
+    with bgzf.open(path / "division" / "gbsyn1.seq.gz", "wt") as ofh:
+        SeqIO.write(genbank_records(["NT_000001.1", "NT_000002.1"]), ofh, "gb")
+    SeqIO.write(genbank_records(["NT_000003.1"]), path / "gbsyn2.gbff", "gb")
+    return path
+
+
+def test_uniprot_index(path_uniprot_index: Path) -> None:
+    """UniProt index maps accessions to cross-references."""
+    xrefs = get_uniprot_index_xrefs(path_uniprot_index, ["P00001", "P00002", "P00003"])
+
+    assert xrefs == {
+        "P00001": ("AB000001;AB000002", "BAA00001.1", "", ""),
+        "P00002": ("", "", "100", "NP_000002.1"),
+    }
+    assert not path_uniprot_index.with_name("uniprot.idx.partial").exists()
+
+
+def test_uniprot_index_process_sequences(
+    path_uniprot_index: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """UniProt inputs use the offline index, not the UniProt service."""
+
+    def mock_uniprot() -> NoReturn:
+        """Fail if the UniProt service is used."""
+        msg = "UniProt service used with --uniprot_index"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr(sequences, "UniProt", mock_uniprot)
+    cachepath = tmp_path / "ncfpcache.sqlite3"
+    initialise_dbcache(cachepath)
+    seqid = "tr|P00001|P00001_SYN"
+    record = SeqRecord(Seq("M"), id=seqid, description=f"{seqid} GN=syn")
+
+    kept, skipped = process_sequences(
+        [record], cachepath, uniprot_index=path_uniprot_index
+    )
+
+    assert (kept, skipped) == ([record], [])
+    assert get_aa_query(cachepath, seqid) == ("BAA00001.1",)
+
+
+def test_uniprot_index_match_cds() -> None:
+    """The EMBL protein ID from the UniProt index identifies the input's CDS."""
+    gbrecord = SeqRecord(Seq("ATGAAATAGATGCCCTAG"), id="AB000001.1")
+    for start, protein_id in ((0, "BAA00000.1"), (9, "BAA00001.1")):
+        gbrecord.features.append(
+            SeqFeature(
+                SimpleLocation(start, start + 9, strand=1),
+                type="CDS",
+                qualifiers={"protein_id": [protein_id]},
+            )
+        )
+    seqid = "tr|P00001|P00001_SYN"
+    record = SeqRecord(Seq("MP"), id=seqid, description=f"{seqid} GN=syn")
+    query = ncfp.CDSQuery(record, seqid, record.description, ("BAA00001.1",), None)
+    options = Namespace(
+        stockholm=False,
+        unify_seqid=False,
+        alternative_start_codon=False,
+        use_protein_ids=False,
+    )
+
+    ntseq = ncfp.match_record_cds(query, gbrecord, options)
+
+    assert ntseq is not None
+    assert (ntseq.id, str(ntseq.seq)) == ("BAA00001.1", "ATGCCCTAG")
+
+
+def test_link_index(path_link_index: Path) -> None:
+    """Link index maps proteins to their RNA and genomic nucleotide records."""
+    links = get_link_index_accessions(
+        path_link_index, ["NP_570602.2", "AAH35719.1", "NP_414543.1", "XP_000001.1"]
+    )
+
+    assert links == {
+        "NP_570602.2": ["NC_000019.10", "NM_130786.4", "NT_187693.1"],
+        "AAH35719.1": ["BC035719.1"],
+        "NP_414543.1": ["NC_000913.3"],
+    }
+
+
+class SummaryFetcher:
+    """Fetcher summarising nucleotide accessions, with their length as UID."""
+
+    def __init__(self, lengths: dict[str, int]) -> None:
+        """Instantiate fetcher, with the length of each accession."""
+        self.lengths = lengths
+        self.queries = []
+
+    def summary(self, db: str, **params: Any) -> list[tuple[str, dict[str, Any]]]:  # noqa: ARG002
+        """Return (UID, summary) for each accession, recording the query."""
+        self.queries.append(params["id"])
+        return [
+            (
+                str(self.lengths[acc]),
+                {"AccessionVersion": acc, "Slen": self.lengths[acc]},
+            )
+            for acc in params["id"].split(",")
+        ]
+
+
+def test_search_nt_ids_index(path_link_index: Path, tmp_path: Path) -> None:
+    """Indexed proteins are cached with accessions; misses are left for ELink."""
+    cachepath = tmp_path / "ncfpcache.sqlite3"
+    initialise_dbcache(cachepath)
+    records = [
+        SeqRecord(Seq("M"), id=seqid, description="")
+        for seqid in ("NP_570602.2", "XP_000001.1")
+    ]
+    for record in records:
+        add_input_sequence(cachepath, record.id, record.id, None)
+
+    fetcher = SummaryFetcher(
+        {"NC_000019.10": 58617616, "NM_130786.4": 1764, "NT_187693.1": 175055}
+    )
+    addedrows, noresult = search_nt_ids_index(
+        records, cachepath, path_link_index, 1, max_links=2, fetcher=fetcher
+    )
+
+    assert (len(addedrows), noresult) == (2, 1)
+    # Accessions are resolved to UIDs, and the shortest records are kept
+    assert fetcher.queries == ["NC_000019.10,NM_130786.4,NT_187693.1"]
+    assert sorted(get_nt_uids(cachepath)) == ["175055", "1764"]
+    assert get_nt_noacc_uids(cachepath) == []
+
+
+@pytest.mark.skipif(
+    not os.environ.get("NCFP_BENCHMARK"), reason="set NCFP_BENCHMARK to run"
+)
+def test_link_index_benchmark(tmp_path: Path) -> None:
+    """Benchmark 1M lookups against a link index of 1M proteins."""
+    path = tmp_path / "links.idx"
+    nproteins = 1000000
+    build_index(
+        path,
+        SQL_CREATE_LINK_INDEX,
+        SQL_ADD_LINK_INDEX,
+        ((f"WP_{idx:09d}.1", f"NZ_{idx // 10:08d}.1") for idx in range(nproteins)),
+    )
+    rng = random.Random(0)  # noqa: S311 - reproducible benchmark queries
+    queries = [f"WP_{rng.randrange(2 * nproteins):09d}.1" for _ in range(1000000)]
+
+    time0 = time.perf_counter()
+    links = get_link_index_accessions(path, queries)
+    elapsed = time.perf_counter() - time0
+
+    logging.getLogger(__name__).info(
+        "1M link index lookups: %.2fs (%d unique hits)", elapsed, len(links)
+    )
+    assert elapsed < 60
+
+
+def test_local_genbank(
+    path_local_genbank: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Headers and full records are read from local GenBank files, not NCBI."""
+
+    def mock_epost(*_args: object, **_kwargs: object) -> NoReturn:
+        """Fail if NCBI is used."""
+        msg = "NCBI used for local GenBank record"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr(Entrez, "epost", mock_epost)
+    local_genbank = open_local_genbank(path_local_genbank, tmp_path / "local.idx")
+    assert sorted(local_genbank) == ["NT_000001.1", "NT_000002.1", "NT_000003.1"]
+
+    cachepath = tmp_path / "ncfpcache.sqlite3"
+    initialise_dbcache(cachepath)
+    add_input_sequence(cachepath, "XP_000001.1", "XP_000001.1", None)
+    add_ncbi_uids(cachepath, "XP_000001.1", ["1", "3"])
+    update_nt_uid_acc(cachepath, "1", "NT_000001.1")
+    update_nt_uid_acc(cachepath, "3", "NT_000003.1")
+
+    addedrows, _ = fetch_gb_headers(cachepath, 1, 100, local_genbank=local_genbank)
+    assert len(addedrows) == 2
+    assert get_nogbhead_nt_uids(cachepath) == []
+
+    addedrows, _ = fetch_shortest_genbank(
+        cachepath, 1, 100, local_genbank=local_genbank
+    )
+    assert len(addedrows) == 1
+    (row,) = find_record_cds(cachepath, "XP_000001.1")
+    assert row[-1].startswith("LOCUS       NT_000001")
+
+
+def test_local_genbank_rebuild(path_local_genbank: Path, tmp_path: Path) -> None:
+    """The local GenBank index is rebuilt when files are added."""
+    indexpath = tmp_path / "local.idx"
+    assert len(open_local_genbank(path_local_genbank, indexpath)) == 3
+    SeqIO.write(genbank_records(["NT_000004.1"]), path_local_genbank / "new.gb", "gb")
+    assert len(open_local_genbank(path_local_genbank, indexpath)) == 4
+
+
+def test_local_genbank_gzip(tmp_path: Path) -> None:
+    """Plain gzip GenBank files cannot be indexed."""
+    with gzip.open(tmp_path / "gbsyn1.seq.gz", "wt") as ofh:
+        SeqIO.write(genbank_records(["NT_000001.1"]), ofh, "gb")
+
+    with pytest.raises(NCFPException):
+        open_local_genbank(tmp_path, tmp_path / "local.idx")
@@ -0,0 +1,356 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Test ncfp end-to-end against the local mock E-utilities server."""
+
+from __future__ import annotations
+
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from typing import TYPE_CHECKING, NoReturn
+
+import pytest
+from Bio import Entrez, SeqIO
+from Bio.Entrez.Parser import DataHandler
+from mock_eutils import MockEUtils, SyntheticNCBI, install_esummary_dtd
+
+from ncbi_cds_from_protein.compression import fasta_positions
+from ncbi_cds_from_protein.scripts import ncfp, ncfp_merge
+from ncbi_cds_from_protein.workqueue import claim_batch, count_batches, initialise_queue
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from Bio.SeqRecord import SeqRecord
+
+pytestmark = pytest.mark.usefixtures("mock_entrez_settings")
+
+
+@pytest.fixture
+def mock_entrez_settings(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Install the mock ESummary DTD, outside the user's DTD cache.
+
+    An API key is set so that Bio.Entrez rate limits requests to 10/s.
+    """
+    monkeypatch.setattr(DataHandler, "local_dtd_dir", str(tmp_path))
+    install_esummary_dtd(tmp_path)
+    monkeypatch.setattr(Entrez, "api_key", "MOCK_API_KEY")
+    monkeypatch.setattr(Entrez, "sleep_between_tries", 0)
+
+
+def run_mock_ncfp(
+    tmp_path: Path, dataset: SyntheticNCBI, server: MockEUtils, *options: str
+) -> list[SeqRecord]:
+    """Run ncfp on the dataset against the server, returning the CDS records."""
+    inpath = tmp_path / "input.fasta"
+    dataset.write_fasta(inpath)
+    outdir = tmp_path / "output"
+    argv = [str(inpath), str(outdir), "ncfptest@dev.null"]
+    argv += ["-d", str(tmp_path / "cache"), "--disabletqdm", "--eutils_url", server.url]
+    assert ncfp.run_main([*argv, *options]) == 0
+    return list(SeqIO.parse(outdir / "ncfp_nt.fasta", "fasta"))
+
+
+def test_mock_eutils(tmp_path: Path) -> None:
+    """The ncfp program recovers every CDS from the mock E-utilities."""
+    dataset = SyntheticNCBI(5)
+    with MockEUtils(dataset) as server:
+        cds = run_mock_ncfp(tmp_path, dataset, server)
+
+    assert [str(rec.seq.translate(to_stop=True)) for rec in cds] == [
+        protein for _, protein in dataset.proteins.values()
+    ]
+    assert server.requests["elink"] == 5
+
+
+def test_mock_eutils_stream(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Streamed input gives the same output, triaged in chunks."""
+    monkeypatch.setattr(ncfp, "STREAM_CHUNKSIZE", 2)
+    dataset = SyntheticNCBI(5)
+    with MockEUtils(dataset) as server:
+        cds = run_mock_ncfp(tmp_path, dataset, server, "--stream")
+
+    assert [str(rec.seq.translate(to_stop=True)) for rec in cds] == [
+        protein for _, protein in dataset.proteins.values()
+    ]
+    aa = SeqIO.parse(tmp_path / "output" / "ncfp_aa.fasta", "fasta")
+    assert [rec.id for rec in aa] == list(dataset.proteins)
+
+
+@pytest.mark.parametrize("options", [(), ("--stream",)], ids=["load", "stream"])
+def test_mock_eutils_pipeline(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, options: tuple[str, ...]
+) -> None:
+    """Pipelined batches give the same output, in input order."""
+    monkeypatch.setattr(ncfp, "PIPELINE_BATCHSIZE", 2)
+    monkeypatch.setattr(ncfp, "PIPELINE_QUEUE_SIZE", 2)
+    dataset = SyntheticNCBI(7)
+    with MockEUtils(dataset) as server:
+        cds = run_mock_ncfp(tmp_path, dataset, server, "--pipeline", *options)
+
+    assert [str(rec.seq.translate(to_stop=True)) for rec in cds] == [
+        protein for _, protein in dataset.proteins.values()
+    ]
+    aa = SeqIO.parse(tmp_path / "output" / "ncfp_aa.fasta", "fasta")
+    assert [rec.id for rec in aa] == list(dataset.proteins)
+    assert server.requests["elink"] == 7
+
+
+def test_mock_eutils_compressed(tmp_path: Path) -> None:
+    """Gzipped input is read, and bgzipped output written with indexes."""
+    dataset = SyntheticNCBI(5)
+    plainpath = tmp_path / "input.fasta"
+    dataset.write_fasta(plainpath)
+    inpath = tmp_path / "input.fasta.gz"
+    with plainpath.open("rb") as ifh, gzip.open(inpath, "wb") as ofh:
+        shutil.copyfileobj(ifh, ofh)
+    outdir = tmp_path / "output"
+    argv = [str(inpath), str(outdir), "ncfptest@dev.null", "--bgzip"]
+    argv += ["-d", str(tmp_path / "cache"), "--disabletqdm"]
+    with MockEUtils(dataset) as server:
+        assert ncfp.run_main([*argv, "--eutils_url", server.url]) == 0
+
+    with gzip.open(outdir / "ncfp_aa.fasta.gz", "rt") as ifh:
+        assert [rec.id for rec in SeqIO.parse(ifh, "fasta")] == list(dataset.proteins)
+    with gzip.open(outdir / "ncfp_nt.fasta.gz", "rt") as ifh:
+        assert len(list(SeqIO.parse(ifh, "fasta"))) == 5
+    for suffix in ("aa", "nt"):
+        assert (
+            len((outdir / f"ncfp_{suffix}.fasta.gz.fai").read_text().split("\n")) == 6
+        )
+        assert (outdir / f"ncfp_{suffix}.fasta.gz.gzi").is_file()
+
+
+def test_mock_eutils_resume(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    """A rerun with --keepcache skips the stages that completed."""
+    dataset = SyntheticNCBI(5)
+    with MockEUtils(dataset) as server:
+        run_mock_ncfp(tmp_path, dataset, server, "-c", "resume")
+        nrequests = sum(server.requests.values())
+        caplog.clear()
+        cds = run_mock_ncfp(tmp_path, dataset, server, "-c", "resume", "--keepcache")
+
+    assert len(cds) == 5
+    assert sum(server.requests.values()) == nrequests
+    skipped = [msg for msg in caplog.messages if "completed by an earlier run" in msg]
+    assert len(skipped) == 5  # process, search, accessions, headers, records
+
+
+def test_mock_eutils_duplicates(tmp_path: Path) -> None:
+    """Duplicate proteins are searched for once, and share their CDS."""
+    dataset = SyntheticNCBI(3)
+    protein = dataset.proteins["XP_000001.1"][1]
+    inpath = tmp_path / "input.fasta"
+    dataset.write_fasta(inpath)
+    with inpath.open("a") as ofh:
+        ofh.write(f">DUP_000001.1 identical to XP_000001.1\n{protein}\n")
+    outdir = tmp_path / "output"
+    argv = [str(inpath), str(outdir), "ncfptest@dev.null"]
+    argv += ["-d", str(tmp_path / "cache"), "--disabletqdm"]
+    with MockEUtils(dataset) as server:
+        assert ncfp.run_main([*argv, "--eutils_url", server.url]) == 0
+
+    assert server.requests["elink"] == 3
+    aa = list(SeqIO.parse(outdir / "ncfp_aa.fasta", "fasta"))
+    nt = list(SeqIO.parse(outdir / "ncfp_nt.fasta", "fasta"))
+    assert [rec.id for rec in aa] == [*dataset.proteins, "DUP_000001.1"]
+    assert nt[-1].id == nt[0].id
+    assert nt[-1].seq == nt[0].seq
+
+
+@pytest.mark.parametrize("cpus", [1, 2])
+def test_mock_eutils_stockholm_duplicates(tmp_path: Path, cpus: int) -> None:
+    """Stockholm domains of one protein share its CDS, trimmed to each domain."""
+    dataset = SyntheticNCBI(2)
+    inpath = tmp_path / "input.fasta"
+    with inpath.open("w") as ofh:
+        for protacc, (_, protein) in dataset.proteins.items():
+            for start, end in ((1, 30), (41, 70)):
+                ofh.write(f">{protacc}/{start}-{end}\n{protein[start - 1 : end]}\n")
+    outdir = tmp_path / "output"
+    argv = [str(inpath), str(outdir), "ncfptest@dev.null", "-s"]
+    argv += ["-d", str(tmp_path / "cache"), "--disabletqdm", "--cpus", str(cpus)]
+    with MockEUtils(dataset) as server:
+        assert ncfp.run_main([*argv, "--eutils_url", server.url]) == 0
+
+    assert server.requests["elink"] == 2
+    aa = list(SeqIO.parse(outdir / "ncfp_aa.fasta", "fasta"))
+    nt = list(SeqIO.parse(outdir / "ncfp_nt.fasta", "fasta"))
+    assert len(aa) == len(nt) == 4
+    assert [rec.id.split("/")[-1] for rec in nt] == ["1-90", "121-210"] * 2
+    for aarec, ntrec in zip(aa, nt):
+        assert ntrec.seq.translate() == aarec.seq
+
+
+@pytest.mark.parametrize("options", [(), ("--pipeline",)], ids=["serial", "pipeline"])
+def test_mock_eutils_cpus(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, options: tuple[str, ...]
+) -> None:
+    """CDS extracted in worker processes are written in input order."""
+    monkeypatch.setattr(ncfp, "EXTRACT_CHUNKSIZE", 3)
+    dataset = SyntheticNCBI(7)
+    with MockEUtils(dataset) as server:
+        cds = run_mock_ncfp(tmp_path, dataset, server, "--cpus", "2", *options)
+
+    assert [str(rec.seq.translate(to_stop=True)) for rec in cds] == [
+        protein for _, protein in dataset.proteins.values()
+    ]
+    aa = SeqIO.parse(tmp_path / "output" / "ncfp_aa.fasta", "fasta")
+    assert [rec.id for rec in aa] == list(dataset.proteins)
+
+
+def test_mock_eutils_cpus_fallback(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """CDS are extracted serially if worker processes cannot be started."""
+
+    def no_processes(*_args: object, **_kwargs: object) -> NoReturn:
+        msg = "no processes"
+        raise OSError(msg)
+
+    monkeypatch.setattr(ncfp, "ProcessPoolExecutor", no_processes)
+    dataset = SyntheticNCBI(3)
+    with MockEUtils(dataset) as server:
+        cds = run_mock_ncfp(tmp_path, dataset, server, "--cpus", "2")
+
+    assert len(cds) == 3
+
+
+def test_mock_eutils_shards(tmp_path: Path) -> None:
+    """Shards of a run are merged into the unsharded output and cache."""
+    dataset = SyntheticNCBI(7)
+    inpath = tmp_path / "input.fasta"
+    dataset.write_fasta(inpath)
+    outdir = tmp_path / "shards"
+    argv = [str(inpath), str(outdir), "ncfptest@dev.null", "-c", "run"]
+    argv += ["-d", str(tmp_path / "cache"), "--disabletqdm"]
+    with MockEUtils(dataset) as server:
+        for shard in ("1/3", "2/3", "3/3"):
+            argv_shard = [*argv, "--shard", shard, "--eutils_url", server.url]
+            assert ncfp.run_main(argv_shard) == 0
+
+    caches = sorted((tmp_path / "cache").glob("ncfpcache_run_shard_*.sqlite3"))
+    assert len(caches) == 3
+    mergedpath = tmp_path / "merged" / "ncfpcache.sqlite3"
+    argv = [inpath, tmp_path / "merged", outdir, "--cachepath", mergedpath]
+    assert ncfp_merge.run_main([*argv, "--caches", *caches]) == 0
+
+    aa = SeqIO.parse(tmp_path / "merged" / "ncfp_aa.fasta", "fasta")
+    assert [rec.id for rec in aa] == list(dataset.proteins)
+    nt = SeqIO.parse(tmp_path / "merged" / "ncfp_nt.fasta", "fasta")
+    assert [str(rec.seq.translate(to_stop=True)) for rec in nt] == [
+        protein for _, protein in dataset.proteins.values()
+    ]
+    conn = sqlite3.connect(str(mergedpath))
+    assert conn.execute("SELECT COUNT(*) FROM seqdata").fetchone()[0] == 7
+    assert conn.execute("SELECT COUNT(*) FROM gb_full").fetchone()[0] == 7
+    conn.close()
+
+
+def test_mock_eutils_worker(tmp_path: Path) -> None:
+    """A worker reclaims an abandoned batch, and merges output in input order.
+
+    Batches are read from their offsets in the gzip compressed input.
+    """
+    dataset = SyntheticNCBI(5)
+    fastapath = tmp_path / "input.fasta"
+    dataset.write_fasta(fastapath)
+    inpath = tmp_path / "input.fasta.gz"
+    inpath.write_bytes(gzip.compress(fastapath.read_bytes()))
+    outdir = tmp_path / "output"
+    outdir.mkdir()
+    queuepath = outdir / "ncfp_queue.sqlite3"
+    digest, ninputs = ncfp.input_digest(ncfp.iter_input_sequences(inpath))
+    with fastapath.open("rb") as instream:
+        positions = list(fasta_positions(instream, 2))
+    initialise_queue(queuepath, digest, ninputs, 2, positions)
+    # A worker died holding the first batch, and its lease has expired
+    claim_batch(queuepath, "dead", -1)
+    argv = [str(inpath), str(outdir), "ncfptest@dev.null", "--worker"]
+    argv += ["-d", str(tmp_path / "cache"), "--disabletqdm", "--queue_batchsize", 2]
+    with MockEUtils(dataset) as server:
+        assert ncfp.run_main([*argv, "--eutils_url", server.url]) == 0
+        # A worker joining a finished queue has nothing to do
+        assert ncfp.run_main([*argv, "--eutils_url", server.url]) == 0
+
+    assert server.requests["elink"] == 5
+    assert count_batches(queuepath) == {"done": 4}
+    aa = SeqIO.parse(outdir / "ncfp_aa.fasta", "fasta")
+    assert [rec.id for rec in aa] == list(dataset.proteins)
+    nt = SeqIO.parse(outdir / "ncfp_nt.fasta", "fasta")
+    assert [str(rec.seq.translate(to_stop=True)) for rec in nt] == [
+        protein for _, protein in dataset.proteins.values()
+    ]
+
+
+def test_mock_eutils_failures(tmp_path: Path) -> None:
+    """The ncfp program retries through throttling, server errors and truncated payloads."""
+    dataset = SyntheticNCBI(5)
+    with MockEUtils(
+        dataset, throttle_rate=0.1, error_rate=0.1, truncate_rate=0.1, seed=1
+    ) as server:
+        cds = run_mock_ncfp(tmp_path, dataset, server, "--link_history", "-r", "20")
+
+    assert len(cds) == 5
+    assert sum(server.failures.values()) > 0
+    # Linked records were summarised from ELink histories
+    assert server.requests["esummary"] >= 5
+
+
+@pytest.mark.skipif(
+    not os.environ.get("NCFP_BENCHMARK"), reason="set NCFP_BENCHMARK to run"
+)
+@pytest.mark.parametrize("options", [(), ("--link_history",)])
+def test_mock_eutils_benchmark(tmp_path: Path, options: tuple[str, ...]) -> None:
+    """Benchmark ncfp on 200 proteins, with 50ms latency and 2% errors."""
+    dataset = SyntheticNCBI(200)
+    with MockEUtils(dataset, latency=0.05, error_rate=0.02) as server:
+        time0 = time.perf_counter()
+        cds = run_mock_ncfp(tmp_path, dataset, server, *options)
+        elapsed = time.perf_counter() - time0
+
+    logging.getLogger(__name__).info(
+        "ncfp %s: %.2fs, %d requests %s",
+        " ".join(options),
+        elapsed,
+        sum(server.requests.values()),
+        dict(server.requests),
+    )
+    assert len(cds) == 200
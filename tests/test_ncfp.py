@@ -38,16 +38,23 @@
 # THE SOFTWARE.
 """Test commandline entry for the ncfp program."""
 
+import re
 import time
-
 from argparse import Namespace
+from itertools import islice
+from pathlib import Path
 
 import pytest
-
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 from bioservices import UniProt
+from utils import check_files, modify_namespace
 
+from ncbi_cds_from_protein import NCFPException
+from ncbi_cds_from_protein.caches import initialise_dbcache
 from ncbi_cds_from_protein.scripts import ncfp
-from utils import check_files, modify_namespace
+from ncbi_cds_from_protein.sequences import InputRecord
 
 
 @pytest.fixture
@@ -57,17 +64,19 @@ def mock_uniprot_download_and_log(monkeypatch):
     Returns the result expected from l125 of sequences.py, for each query of
     the path_uniprot_stockholm_small dataset
 
-    u_service.search(match.group(0), columns="database(EMBL)")  # type: ignore
+    u_service.search("accession:X OR ...", columns=UNIPROT_XREF_COLUMNS)
     """
 
-    def mock_search(*args, **kwargs):
+    def mock_search(_self: UniProt, query: str, **_kwargs: object) -> str:
         """Mock call to UniProt.search() method.
 
         This output specific to the download_and_log() test
 
         This mock updated to reflect UniProt API changes in June 2022
         """
-        return "EMBL\nCM000618;\n"
+        accessions = re.findall(r"(?<=accession:)[^\s]+", query)
+        rows = [f"{acc}\tCM000618;\t\t\t" for acc in accessions]
+        return "\n".join(["Entry\tEMBL\tORF\tGeneID\tRefSeq", *rows]) + "\n"
 
     monkeypatch.setattr(UniProt, "search", mock_search)
 
@@ -76,36 +85,35 @@ def mock_uniprot_download_and_log(monkeypatch):
 def mock_basic_uniprot(monkeypatch):
     """Mock remote service call to UniProt for test_basic_uniprot test.
 
-    Returns the result expected from l.129 of sequences.py, for each query of
-    the path_uniprot_stockholm_small dataset
+    Returns the EMBL cross-reference expected for each query of the
+    path_uniprot dataset, in input order, from the batched query
 
-    u_service.search(match.group(0), columns="xref_embl")  # type: ignore
+    u_service.search("accession:X OR ...", columns=UNIPROT_XREF_COLUMNS)
 
     This mock updated to reflect UniProt API changes in June 2022
     """
     qstring_results = iter(
         [
-            "EMBL\nJNBS01004944;\n",
-            "EMBL\nJNBS01000225;\n",
-            "EMBL\nAZIL01000691;\n",
-            "EMBL\nGL833138;\n",
-            "EMBL\nJNBR01001477;\n",
-            "EMBL\nJNBS01001796;\n",
-            "EMBL\nJNBS01000295;\n",
-            "EMBL\nKI913977;\n",
-            "EMBL\nFN648069;\n",
+            "JNBS01004944;",
+            "JNBS01000225;",
+            "AZIL01000691;",
+            "GL833138;",
+            "JNBR01001477;",
+            "JNBS01001796;",
+            "JNBS01000295;",
+            "KI913977;",
+            "FN648069;",
         ]
     )
 
-    def mock_search(*args, **kwargs):
+    def mock_search(_self: UniProt, query: str, **_kwargs: object) -> str:
         """Mock call to UniProt.search() method.
 
         This output specific to the test_basic_uniprot() test
         """
-        if kwargs["columns"] == "xref_embl":
-            return next(qstring_results)
-        else:
-            return "\n"
+        accessions = re.findall(r"(?<=accession:)[^\s]+", query)
+        rows = [f"{acc}\t{next(qstring_results)}\t\t\t" for acc in accessions]
+        return "\n".join(["Entry\tEMBL\tORF\tGeneID\tRefSeq", *rows]) + "\n"
 
     monkeypatch.setattr(UniProt, "search", mock_search)
 
@@ -121,14 +129,39 @@ def namespace_base(email_address, path_ncbi, tmp_path):
         cachedir=tmp_path / ".ncfp_cache",
         cachestem=time.strftime("%Y-%m-%d-%H-%m-%S"),
         batchsize=100,
+        postsize=None,
+        max_links=None,
+        link_history=False,
         retries=10,
         limit=None,
         filestem="ncfp",
+        bgzip=False,
         keepcache=False,
+        uniprot_ttl=30,
+        uniprot_index=None,
+        local_genbank=None,
         skippedfname="skipped.fasta",
         use_protein_ids=False,
         unify_seqid=False,
         alternative_start_codon=False,
+        coded_by=False,
+        ipg=False,
+        ipg_policy="refseq",
+        region_fetch=False,
+        region_padding=100,
+        stream=False,
+        pipeline=False,
+        pipeline_workers=4,
+        cpus=1,
+        shard=None,
+        worker=False,
+        queue=None,
+        queue_batchsize=1000,
+        lease=600,
+        fetcher="entrez",
+        eutils_url=None,
+        http_cache=None,
+        http_cache_mode="read-through",
         logfile=None,
         verbose=False,
         disabletqdm=True,
@@ -413,3 +446,78 @@ def test_single_cds(
         path_single_cds_targets,
         ("ncfp_aa.fasta", "ncfp_nt.fasta"),
     )
+
+
+def test_paired_sequence_writer(tmp_path: Path) -> None:
+    """Matched pairs are written in lock-step, and kept if extraction fails."""
+
+    def write_pairs(writer: ncfp.PairedSequenceWriter) -> None:
+        """Write three matched pairs, then fail."""
+        for idx in range(3):
+            aaseq = InputRecord(f"XP_{idx}.1", f"XP_{idx}.1 protein {idx}", "MK")
+            ntseq = SeqRecord(Seq("ATGAAA"), id=f"NT_{idx}.1", description="")
+            writer.write(aaseq, ntseq)
+        msg = "extraction failed"
+        raise RuntimeError(msg)
+
+    writer = ncfp.PairedSequenceWriter(tmp_path, "ncfp", flush_interval=2)
+    with pytest.raises(RuntimeError, match="extraction failed"), writer:
+        write_pairs(writer)
+
+    aaseqs = list(SeqIO.parse(tmp_path / "ncfp_aa.fasta", "fasta"))
+    ntseqs = list(SeqIO.parse(tmp_path / "ncfp_nt.fasta", "fasta"))
+    assert writer.count == 3
+    assert [(aa.id, nt.id) for aa, nt in zip(aaseqs, ntseqs)] == [
+        (f"XP_{idx}.1", f"NT_{idx}.1") for idx in range(3)
+    ]
+    assert aaseqs[0].description == "XP_0.1 protein 0"
+
+
+def test_paired_records_mismatch() -> None:
+    """Output files with different numbers of records are not paired."""
+    aaseqs = [SeqRecord(Seq("MK"), id=f"XP_{idx}.1") for idx in range(3)]
+    ntseqs = [SeqRecord(Seq("ATGAAA"), id=f"NT_{idx}.1") for idx in range(2)]
+    pairs = ncfp.iter_paired_records(aaseqs, ntseqs)
+    assert [(aa.id, nt.id) for aa, nt in islice(pairs, 2)] == [
+        ("XP_0.1", "NT_0.1"),
+        ("XP_1.1", "NT_1.1"),
+    ]
+    with pytest.raises(NCFPException, match="different numbers of records"):
+        next(pairs)
+
+
+def test_run_state(tmp_path: Path) -> None:
+    """Stages after one that is run, or that failed, are not skipped."""
+    cachepath = tmp_path / "ncfpcache.sqlite3"
+    initialise_dbcache(cachepath)
+    runstate = ncfp.RunState(cachepath, "run1")
+    assert not runstate.skip("process")
+    for stage, countfail in (("process", 0), ("search", 0), ("headers", 2)):
+        runstate.complete(stage, countfail)
+
+    runstate = ncfp.RunState(cachepath, "run1")
+    assert runstate.completed == {"process", "search"}
+    assert runstate.skip("process")
+    assert not runstate.skip("accessions")
+    assert not runstate.skip("search")  # an earlier stage was run
+    assert ncfp.RunState(cachepath, "run2").completed == set()
+
+
+def test_worker_cache(tmp_path: Path) -> None:
+    """Workers sharing a cache directory do not overwrite the shared cache."""
+    args = Namespace(
+        cachedir=tmp_path,
+        cachestem="run",
+        keepcache=False,
+        shard=None,
+        worker=False,
+    )
+    cachepath = ncfp.initialise_cache(args)
+    runstate = ncfp.RunState(cachepath, "run1")
+    runstate.complete("process", 0)
+
+    args.worker = True
+    workerpath = ncfp.initialise_cache(args)
+    assert workerpath != cachepath
+    assert workerpath.name == f"ncfpcache_run_{ncfp.worker_name()}.sqlite3"
+    assert ncfp.RunState(cachepath, "run1").completed == {"process"}
@@ -0,0 +1,327 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Test sequence and annotation parsing functions."""
+
+from __future__ import annotations
+
+import io
+import logging
+import os
+import time
+import tracemalloc
+from typing import TYPE_CHECKING, ClassVar
+
+import pytest
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from ncbi_cds_from_protein import sequences
+from ncbi_cds_from_protein.caches import initialise_dbcache, initialise_xrefcache
+from ncbi_cds_from_protein.sequences import (
+    choose_ipg_cds,
+    feature_table_location,
+    find_feature_table_cds,
+    parse_coded_by,
+    parse_feature_table,
+    parse_input_fasta,
+    parse_ipg_report,
+    process_sequences,
+    select_shard,
+    sequence_keys,
+    shard_index,
+    uniprot_xrefs,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+    from pathlib import Path
+    from typing import TextIO
+
+    from ncbi_cds_from_protein.sequences import InputRecord
+
+FEATURE_TABLE = (
+    ">Feature ref|NC_000001.1|\n"
+    "190\t255\tgene\n"
+    "\t\t\tgene\tsynA\n"
+    "\t\t\tlocus_tag\tSYN_0001\n"
+    "190\t255\tCDS\n"
+    "\t\t\tproduct\tsynthetic protein A\n"
+    "\t\t\tprotein_id\tref|NP_000001.1|\n"
+    "900\t<337\tgene\n"
+    "\t\t\tlocus_tag\tSYN_0002\n"
+    "900\t801\tCDS\n"
+    "500\t337\n"
+    "\t\t\tproduct\tsynthetic protein B\n"
+    "\t\t\tpseudo\n"
+)
+
+IPG_REPORT = (
+    "Id\tSource\tNucleotide Accession\tStart\tStop\tStrand\tProtein\t"
+    "Protein Name\tOrganism\tStrain\tAssembly\n"
+    "1001\tINSDC\tCP000001.1\t100\t399\t-\tAAA00001.1\tsynA\tSyn sp.\t\t\n"
+    "1001\tRefSeq\tNZ_CP000001.1\t100\t399\t-\tWP_000000001.1\tsynA\tSyn sp.\t\t\n"
+    "1001\tRefSeq\t\t\t\t\tWP_000000001.1\tsynA\tSyn sp.\t\t\n"
+    "Id\tSource\tNucleotide Accession\tStart\tStop\tStrand\tProtein\t"
+    "Protein Name\tOrganism\tStrain\tAssembly\n"
+    "1002\tRefSeq\t\t\t\t\tWP_000000002.1\tsynB\tSyn sp.\t\t\n"
+)
+
+
+def test_parse_feature_table() -> None:
+    """Feature table intervals and qualifiers are parsed for each feature."""
+    features = parse_feature_table(io.StringIO(FEATURE_TABLE))
+
+    assert list(features) == ["NC_000001.1"]
+    assert [(ftype, intervals) for ftype, intervals, _ in features["NC_000001.1"]] == [
+        ("gene", [(190, 255)]),
+        ("CDS", [(190, 255)]),
+        ("gene", [(900, 337)]),
+        ("CDS", [(900, 801), (500, 337)]),
+    ]
+    assert features["NC_000001.1"][3][2] == {
+        "product": ["synthetic protein B"],
+        "pseudo": [""],
+    }
+
+
+def test_find_feature_table_cds() -> None:
+    """CDS is found by protein ID, or by locus tag of the enclosing gene."""
+    features = parse_feature_table(io.StringIO(FEATURE_TABLE))["NC_000001.1"]
+
+    assert find_feature_table_cds(features, "NP_000001", None) is features[1]
+    assert find_feature_table_cds(features, "XP_1.1", "SYN_0002") is features[3]
+    assert find_feature_table_cds(features, "XP_1.1", None) is None
+    assert (
+        feature_table_location(features[3][1]) == "complement(join(337..500,801..900))"
+    )
+
+
+def test_parse_coded_by() -> None:
+    """coded_by locations on a single record are parsed, wrapping is ignored."""
+    location = parse_coded_by(
+        "complement(join(NC_000001.1:1..100,NC_000001.1:20 0..300))"
+    )
+
+    assert [part.ref for part in location.parts] == ["NC_000001.1"] * 2
+    assert [(int(part.start), int(part.end)) for part in location.parts] == [
+        (199, 300),
+        (0, 100),
+    ]
+    assert parse_coded_by("join(NC_000001.1:1..100,NC_000002.1:1..100)") is None
+
+
+def test_choose_ipg_cds() -> None:
+    """Representative IPG CDS follows the source policy, and needs coordinates."""
+    groups = parse_ipg_report(io.StringIO(IPG_REPORT))
+
+    assert groups["WP_000000001.1"] is groups["AAA00001.1"]
+    assert choose_ipg_cds(groups["WP_000000001.1"], "refseq")["Protein"] == (
+        "WP_000000001.1"
+    )
+    assert choose_ipg_cds(groups["WP_000000001.1"], "insdc")["Protein"] == (
+        "AAA00001.1"
+    )
+    assert choose_ipg_cds(groups["WP_000000001.1"], "first")["Source"] == "INSDC"
+    assert choose_ipg_cds(groups["WP_000000002.1"], "refseq") is None
+
+
+class MockUniProt:
+    """UniProt service returning cross-references for primary accessions."""
+
+    PRIMARY: ClassVar[dict[str, str]] = {
+        "P00001": "AB000001;AB000002;",
+        "P00002": "",
+        "P00003": "AB000003;",
+    }
+
+    def __init__(self) -> None:
+        """Instantiate service, with no queries made."""
+        self.queries = []
+
+    def search(self, query: str, **_kwargs: object) -> str:
+        """Return TSV rows for the primary accessions in the query."""
+        self.queries.append(query)
+        rows = [
+            f"{acc}\t{embl}\tORF{acc[-1]}\t{'100;' if not embl else ''}\t"
+            for acc, embl in self.PRIMARY.items()
+            if f"accession:{acc}" in query
+        ]
+        if not rows:  # bioservices returns no header for an empty result
+            return ""
+        return "\n".join(["Entry\tEMBL\tORF\tGeneID\tRefSeq", *rows]) + "\n"
+
+
+def test_uniprot_xrefs() -> None:
+    """UniProt cross-references are fetched in batches, and parsed per accession."""
+    u_service = MockUniProt()
+    xrefs = uniprot_xrefs(
+        ["P00001", "P00002", "P00001", "P00003", "Q99999"], u_service, batchsize=2
+    )
+
+    # Two batched queries, then a single query for the accession not returned
+    assert u_service.queries == [
+        "accession:P00001 OR accession:P00002",
+        "accession:P00003 OR accession:Q99999",
+        "accession:Q99999",
+    ]
+    assert list(xrefs) == ["P00001", "P00002", "P00003", "Q99999"]
+    assert xrefs["P00001"] == ("AB000001;AB000002", "ORF1", "", "")
+    assert xrefs["P00002"] == ("", "ORF2", "100", "")
+    assert xrefs["Q99999"] == ("", "", "", "")
+
+
+def test_uniprot_xref_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """UniProt cross-references are reused from cache, and misses expire."""
+    u_service = MockUniProt()
+    monkeypatch.setattr(sequences, "UniProt", lambda: u_service)
+    xrefpath = tmp_path / "uniprot_xref.sqlite3"
+    initialise_xrefcache(xrefpath)
+    records = []
+    for idx, acc in enumerate(("P00001", "Q99999")):
+        seqid = f"tr|{acc}|{acc}_SYN"
+        records.append(SeqRecord(Seq("M"), id=seqid, description=f"{seqid} GN=s{idx}"))
+
+    def run(ttl: float) -> list[str]:
+        """Triage records into a new cache, returning UniProt queries made."""
+        cachepath = tmp_path / "ncfpcache.sqlite3"
+        initialise_dbcache(cachepath)
+        u_service.queries.clear()
+        kept, _ = process_sequences(records, cachepath, xrefpath=xrefpath, xref_ttl=ttl)
+        assert [record.id for record in kept] == ["tr|P00001|P00001_SYN"]
+        return u_service.queries
+
+    assert run(30) == ["accession:P00001 OR accession:Q99999", "accession:Q99999"]
+    assert run(30) == []  # found entry, and unexpired miss, both cached
+    assert run(0) == ["accession:Q99999", "accession:Q99999"]  # expired miss
+
+
+def test_parse_input_fasta() -> None:
+    """InputRecords have the IDs, descriptions and sequences of SeqIO.parse()."""
+    fasta = (
+        ">tr|A0A000|A0A000_SYN Synthetic protein OS=Syn sp. GN=synA\n"
+        "MKT-AY\nIAKQR\n"
+        ">XP_000001.1/2-10\n"
+        "mktayiakqr\n"
+        ">\n"
+        "MKT\n"
+    )
+    records = list(parse_input_fasta(io.StringIO(fasta)))
+    expected = list(SeqIO.parse(io.StringIO(fasta), "fasta"))
+    assert [(rec.id, rec.description, str(rec.seq)) for rec in records] == [
+        (rec.id, rec.description, str(rec.seq)) for rec in expected
+    ]
+    assert records[0].seq.replace("-", "").upper() == "MKTAYIAKQR"
+
+    # Materialised SeqRecords are written as the input was read
+    outputs = []
+    for recs in ([rec.to_seqrecord() for rec in records], expected):
+        outfh = io.StringIO()
+        SeqIO.write(recs, outfh, "fasta")
+        outputs.append(outfh.getvalue())
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.skipif(
+    not os.environ.get("NCFP_BENCHMARK"), reason="set NCFP_BENCHMARK to run"
+)
+def test_parse_input_fasta_benchmark(tmp_path: Path) -> None:
+    """Benchmark parse time and peak memory for a large synthetic FASTA file.
+
+    The file size defaults to 1GB, and can be set in MB with
+    NCFP_BENCHMARK_FASTA_MB.
+    """
+    size = int(os.environ.get("NCFP_BENCHMARK_FASTA_MB", "1024")) * 1024 * 1024
+    path = tmp_path / "large.fasta"
+    seqlines = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVK\n" * 6
+    with path.open("w") as ofh:
+        idx = 0
+        while ofh.tell() < size:
+            ofh.write(f">XP_{idx:09d}.1 synthetic protein {idx} [Syn sp.]\n")
+            ofh.write(seqlines)
+            idx += 1
+
+    def measure(
+        parser: Callable[[TextIO], Iterable[InputRecord | SeqRecord]],
+    ) -> tuple[int, float, int]:
+        """Return records, time taken and peak memory to parse the file."""
+        tracemalloc.start()
+        time0 = time.perf_counter()
+        with path.open("r") as instream:
+            records = list(parser(instream))
+        elapsed = time.perf_counter() - time0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return len(records), elapsed, peak
+
+    results = {}
+    for name, parser in (
+        ("InputRecord", parse_input_fasta),
+        ("SeqRecord", lambda handle: SeqIO.parse(handle, "fasta")),
+    ):
+        results[name] = measure(parser)
+        logging.getLogger(__name__).info(
+            "%s: %d records from %dMB in %.2fs, peak memory %.0fMB",
+            name,
+            results[name][0],
+            size // 1024 // 1024,
+            results[name][1],
+            results[name][2] / 1024 / 1024,
+        )
+    assert results["InputRecord"][0] == results["SeqRecord"][0] == idx
+    assert results["InputRecord"][2] < results["SeqRecord"][2]
+
+
+def test_sequence_keys() -> None:
+    """Domains share an ID key, and full-length sequences a sequence key."""
+    full = SeqRecord(Seq("MKT-AY"), id="XP_000001.1")
+    copy = SeqRecord(Seq("mktay"), id="DUP_000001.1")
+    domain = SeqRecord(Seq("MKT"), id="XP_000001.1/1-3")
+    assert sequence_keys(full)[1] == sequence_keys(copy)[1]
+    assert sequence_keys(domain) == ["id:XP_000001.1"]
+    assert sequence_keys(full)[0] == "id:XP_000001.1"
+
+
+def test_select_shard() -> None:
+    """Shards partition the input, keeping each protein's domains together."""
+    records = [SeqRecord(Seq("MKTAY"), id=f"XP_{i:06d}.1") for i in range(100)]
+    shards = [list(select_shard(records, (i, 4))) for i in range(1, 5)]
+    assert sorted(rec.id for shard in shards for rec in shard) == [
+        rec.id for rec in records
+    ]
+    assert all(shards)
+    assert shard_index("XP_000001.1/1-30", 4) == shard_index("XP_000001.1", 4)
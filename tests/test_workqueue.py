@@ -0,0 +1,119 @@
+# (c) University of Strathclyde 2019-present
+# Author: Leighton Pritchard
+#
+# Contact:
+# leighton.pritchard@strath.ac.uk
+#
+# Leighton Pritchard,
+# Strathclyde Institute of Pharmaceutical and Biomedical Sciences
+# The University of Strathclyde
+# 161 Cathedral Street
+# Glasgow
+# G4 0RE
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Copyright (c) 2019-present University of Strathclyde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Test work queue shared between ncfp workers."""
+
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING
+
+import pytest
+
+from ncbi_cds_from_protein import NCFPException
+from ncbi_cds_from_protein.scripts.parsers import parse_cmdline
+from ncbi_cds_from_protein.workqueue import (
+    Lease,
+    claim_batch,
+    complete_batch,
+    count_batches,
+    initialise_queue,
+    release_batch,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture
+def queuepath(tmp_path: Path) -> Path:
+    """Path to a work queue of 5 input sequences in batches of 2."""
+    path = tmp_path / "queue.sqlite3"
+    assert initialise_queue(path, "digest", 5, 2, [0, 100, 200]) == 3
+    return path
+
+
+def test_queue_claims(queuepath: Path) -> None:
+    """Batches are claimed in order, and merge only once all are done."""
+    batches = [claim_batch(queuepath, "w1", 60) for _ in range(3)]
+    assert [(b.batch, b.start, b.size, b.position) for b in batches] == [
+        (0, 0, 2, 0),
+        (1, 2, 2, 100),
+        (2, 4, 1, 200),
+    ]
+    assert claim_batch(queuepath, "w2", 60) is None
+    for batch in batches[:2]:
+        assert complete_batch(queuepath, batch.batch, "w1")
+    assert claim_batch(queuepath, "w2", 60) is None
+    release_batch(queuepath, 2, "w1")
+    assert claim_batch(queuepath, "w2", 60).batch == 2
+    assert not complete_batch(queuepath, 2, "w1")
+    assert complete_batch(queuepath, 2, "w2")
+    merge = claim_batch(queuepath, "w2", 60)
+    assert (merge.batch, merge.stage) == (3, "merge")
+    assert complete_batch(queuepath, merge.batch, "w2")
+    assert count_batches(queuepath) == {"done": 4}
+
+
+def test_queue_lease_expiry(queuepath: Path) -> None:
+    """A batch whose lease expires is reclaimed, and the old lease is lost."""
+    assert claim_batch(queuepath, "dead", -1).batch == 0
+    batch = claim_batch(queuepath, "w1", 60)
+    assert (batch.batch, batch.attempts) == (0, 1)
+    assert not complete_batch(queuepath, 0, "dead")
+
+
+def test_queue_lease_renewal(queuepath: Path) -> None:
+    """A lease is renewed while held, so the batch is not reclaimed."""
+    batch = claim_batch(queuepath, "w1", 0.3)
+    with Lease(queuepath, batch.batch, "w1", 0.3) as lease:
+        time.sleep(0.5)
+        assert claim_batch(queuepath, "w2", 60).batch == 1
+    assert not lease.lost
+    assert complete_batch(queuepath, batch.batch, "w1")
+
+
+def test_queue_input_mismatch(queuepath: Path) -> None:
+    """A worker with different input cannot join the queue."""
+    assert initialise_queue(queuepath, "digest", 5, 2, [0, 100, 200]) == 3
+    with pytest.raises(NCFPException):
+        initialise_queue(queuepath, "other", 5, 2, [0, 100, 200])
+
+
+def test_worker_shard_rejected() -> None:
+    """Workers share the whole input, so cannot also be run on a shard."""
+    with pytest.raises(SystemExit):
+        parse_cmdline(["in.fasta", "out", "me@dev.null", "--worker", "--shard", "1/2"])